@@ -0,0 +1,386 @@
+'''Web APIs: fetching many JSON documents quickly and politely'''
+
+
+# pygal_hn_api_example.py asks the Hacker News API for 100 items one after
+# another with requests.get(). Each call opens a new connection (a TCP
+# handshake, plus a TLS handshake for https), sends one request, waits for
+# the answer and hangs up, so the total is the sum of 100 round trips.
+
+# The pieces here make that about as long as the slowest few requests:
+
+# - Session keeps connections open and reuses them (HTTP keep-alive), one
+#   per thread per host, so the handshakes are paid once per thread.
+# - fetch_all() runs the requests on a pool of threads, so up to `workers`
+#   are waiting on the network at once instead of one.
+# - TokenBucket keeps the request rate under a limit: tokens drip into a
+#   bucket at `rate` per second, each request takes one, and when the
+#   bucket's empty the caller waits. The bucket's size allows short bursts.
+# - get_json() retries when a request fails in a way that might go away
+#   (a dropped connection, 429 Too Many Requests, 503 ...), waiting longer
+#   after each try (exponential backoff) plus a random bit (jitter) so the
+#   threads don't all retry at the same moment. A Retry-After header from
+#   the server wins.
+# - JSONCache keeps each document in a file for max_age seconds, so running
+#   the program again doesn't fetch anything that's still recent.
+
+#   items = fetch_items(ids, cache=JSONCache('.hn_cache', max_age=600))
+
+# (requests.Session does keep-alive too; this uses http.client so it works
+# with just the standard library.)
+
+# see also: pygal_hn_api_example.py, concurrency.py, http_cache.py
+
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+HN_API = 'https://hacker-news.firebaseio.com/v0/'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    '''Allow rate calls per second on average, in bursts of up to capacity.'''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        '''Wait until a token is free, and take it.'''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPStatusError(Exception):
+
+    def __init__(self, status, url, retry_after=None):
+        super().__init__('HTTP {} for {}'.format(status, url))
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Response():
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Session():
+    '''HTTP requests over kept-open connections, safe to share by threads.'''
+
+    def __init__(self, headers=None, timeout=30):
+        self.headers = headers or {}
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0}
+
+    def _connection(self, scheme, host):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get((scheme, host))
+        if conn is None:
+            kind = (http.client.HTTPSConnection if scheme == 'https'
+                    else http.client.HTTPConnection)
+            conn = connections[scheme, host] = kind(host,
+                                                    timeout=self.timeout)
+            with self._lock:
+                self.stats['connections'] += 1
+        return conn
+
+    def _drop(self, scheme, host):
+        conn = self._local.connections.pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    def request(self, method, url, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        all_headers = dict(self.headers, **(headers or {}))
+        for attempt in (1, 2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, headers=all_headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self._drop(parts.scheme, parts.netloc)
+                # the server may have closed an idle connection; a fresh one
+                # gets one more go, anything else is a real failure
+                if not reused or attempt == 2:
+                    raise
+        if response.will_close:
+            self._drop(parts.scheme, parts.netloc)
+        with self._lock:
+            self.stats['requests'] += 1
+        return Response(response.status, response.headers, body)
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers)
+
+    def close(self):
+        # only this thread's connections; the others go when their
+        # threads do
+        for key in list(getattr(self._local, 'connections', {})):
+            self._drop(*key)
+
+
+def _retry_after(response):
+    # How long the server asked us to wait, if it said. Retry-After is the
+    # standard; GitHub and others instead say when the limit resets.
+    value = response.headers.get('Retry-After')
+    if value and value.isdigit():
+        return float(value)
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        try:
+            reset = float(response.headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return None
+        return max(0.0, reset - time.time())
+    return None
+
+
+def get_with_retries(session, url, headers=None, limiter=None, retries=4,
+                     backoff=0.5, ok=(200,)):
+    '''GET url, retrying failures that may be temporary.
+
+    Returns the Response if its status is in ok, otherwise raises
+    HTTPStatusError. Any response that says when to try again (like
+    GitHub's 403 when the rate limit has run out) counts as temporary.
+    '''
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.take()
+        try:
+            response = session.get(url, headers)
+            if response.status in ok:
+                return response
+            raise HTTPStatusError(response.status, url,
+                                  _retry_after(response))
+        except (HTTPStatusError, http.client.HTTPException, OSError) as err:
+            permanent = (isinstance(err, HTTPStatusError)
+                         and err.status not in RETRY_STATUS
+                         and err.retry_after is None)
+            if permanent or attempt == retries:
+                raise
+            delay = getattr(err, 'retry_after', None)
+            if delay is None:
+                delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            time.sleep(delay)
+
+
+def get_json(session, url, limiter=None, retries=4, backoff=0.5):
+    '''GET url's JSON, retrying failures that may be temporary.'''
+    return get_with_retries(session, url, None, limiter, retries,
+                            backoff).json()
+
+
+class JSONCache():
+    '''JSON documents in files, each good for max_age seconds.'''
+
+    def __init__(self, directory, max_age=3600):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def get(self, key):
+        '''The cached document, or None if there isn't a recent one.'''
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path) as fob:
+                return json.load(fob)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, data):
+        # write to a temporary name and rename it into place, so a reader
+        # never sees half a file (see config_cache.py)
+        path = self._path(key)
+        temp = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                     threading.get_ident())
+        with open(temp, 'w') as fob:
+            json.dump(data, fob)
+        os.replace(temp, path)
+
+
+def fetch_all(urls, workers=32, rate=100, session=None, cache=None,
+              keys=None):
+    '''GET every URL's JSON, in parallel. Returns the results in order.
+
+    With a cache, keys gives the name each result is cached under (by
+    default the URL itself, which makes an awkward file name).
+    '''
+    session = session or Session()
+    limiter = TokenBucket(rate, capacity=workers) if rate else None
+    keys = keys or [urllib.parse.quote(url, safe='') for url in urls]
+
+    def fetch(url, key):
+        if cache is not None:
+            data = cache.get(key)
+            if data is not None:
+                return data
+        data = get_json(session, url, limiter)
+        if cache is not None and data is not None:
+            cache.put(key, data)
+        return data
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(fetch, urls, keys))
+
+
+def fetch_items(ids, base_url=HN_API, **options):
+    '''Hacker News items by ID (None for deleted ones), in order.'''
+    urls = ['{}item/{}.json'.format(base_url, item_id) for item_id in ids]
+    return fetch_all(urls, keys=['item-{}'.format(item_id) for item_id in
+                                 ids], **options)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A mock of the Hacker News API on a local server. Each item takes 50-150 ms
+# to come back, a few take 400 ms, and one request in 20 fails with a 503
+# the first time. The 100 items are fetched the way
+# pygal_hn_api_example.py does, then with fetch_items(), then again from
+# the cache.
+
+def serve_mock_api(items=500, port=0, seed=1):
+    '''Start the mock HN API on a thread. Returns (base URL, server).'''
+    import http.server
+
+    rand = random.Random(seed)
+    latency = {i: rand.uniform(0.05, 0.15) for i in range(items)}
+    for i in rand.sample(range(items), items // 50):
+        latency[i] = 0.4
+    flaky = rand.sample(range(items), items // 20)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            with server.lock:
+                server.connections += 1
+
+        def do_GET(self):
+            with server.lock:
+                server.requests += 1
+            if self.path.endswith('/topstories.json'):
+                return self._send(200, list(range(items)))
+            try:
+                item_id = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+            except ValueError:
+                return self._send(404, None)
+            time.sleep(latency.get(item_id, 0.05))
+            with server.lock:
+                fail = item_id in server.flaky
+                server.flaky.discard(item_id)
+            if fail:
+                return self._send(503, {'error': 'try again'})
+            if item_id >= items:
+                return self._send(200, None)
+            self._send(200, {'id': item_id, 'type': 'story',
+                             'title': 'Story number {}'.format(item_id),
+                             'descendants': (item_id * 37) % 300})
+
+        def _send(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = server.connections = 0
+    server.flaky = set(flaky)
+    server.reset = lambda: setattr(server, 'flaky', set(flaky))
+    server.slowest = max(latency.values())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}/v0/'.format(server.server_address[1]), server
+
+
+if __name__ == '__main__':
+    import tempfile
+    import urllib.request
+
+    base, server = serve_mock_api()
+    session = Session()
+    ids = get_json(session, base + 'topstories.json')[:100]
+
+    start = time.perf_counter()
+    serial = []
+    for item_id in ids:
+        # a new connection for every item, and no retries (the 503s would
+        # just fail, so skip those here)
+        try:
+            with urllib.request.urlopen('{}item/{}.json'.format(
+                    base, item_id)) as response:
+                serial.append(json.load(response))
+        except urllib.error.HTTPError:
+            serial.append(None)
+    elapsed = time.perf_counter() - start
+    print('one at a time: {:.2f}s, {} failed, {} connections'.format(
+        elapsed, serial.count(None), server.connections - 1))
+
+    cache = JSONCache(tempfile.mkdtemp(), max_age=600)
+    server.requests = server.connections = 0
+    server.reset()
+    start = time.perf_counter()
+    items = fetch_items(ids, base, cache=cache)
+    elapsed = time.perf_counter() - start
+    assert all(item is not None for item in items)
+    print('fetch_items:   {:.2f}s, {} requests (with retries) over {} '
+          'connections; slowest request {:.2f}s'.format(
+              elapsed, server.requests, server.connections, server.slowest))
+
+    server.requests = 0
+    start = time.perf_counter()
+    again = fetch_items(ids, base, cache=cache)
+    elapsed = time.perf_counter() - start
+    assert again == items
+    print('from cache:    {:.3f}s, {} requests'.format(elapsed,
+                                                       server.requests))
+
+    # the rate limit on its own: 50 calls at 100/sec with bursts of 10
+    bucket = TokenBucket(100, capacity=10)
+    start = time.perf_counter()
+    for i in range(50):
+        bucket.take()
+    print('50 tokens at 100/sec: {:.2f}s'.format(time.perf_counter() - start))
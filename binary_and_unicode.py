@@ -375,6 +375,9 @@ print(testing)  # (154, 141)
 # Read 8 bytes-two unsigned long integers (2L)
 # Skip the final 6 bytes (6x)
 
+# For packing whole records to send over a network, precompiled with
+# struct.Struct, see demos/binary_protocol.py.
+
 
 # Summary
 # -----------------------------------------------------------------------------
@@ -0,0 +1,202 @@
+'''Config Files: cached loading'''
+
+
+# structured_file_formats.py reads data/practice.yaml and data/practice.cfg by
+# parsing them from scratch every time. A service that reads dozens of config
+# files at startup pays that cost over and over, and PyYAML's pure Python
+# parser is slow. Three things help:
+
+# 1. PyYAML can be built against libyaml, a C library. When it is,
+#    yaml.CSafeLoader exists and is many times faster than yaml.SafeLoader.
+#    It's just as safe - only the parser is swapped out.
+# 2. Keep parsed results in memory, keyed by the file's path. The file's
+#    modification time and size are stored alongside, so an edited file is
+#    noticed and parsed again.
+# 3. Save the parsed result as a pickle next to the source file
+#    (practice.yaml -> .practice.yaml.cache). On the next start, loading the
+#    pickle is much faster than parsing the text again. The cache records the
+#    source's mtime and size too, so a stale cache is simply ignored.
+
+# The pickle cache should be treated exactly like the config file itself: if
+# someone can write to the directory they can change the config anyway, but
+# never copy .cache files around from untrusted places (see pickling.py).
+
+# see also: structured_file_formats.py
+
+import configparser
+import json
+import os
+import pickle
+
+try:
+    import yaml
+except ImportError:  # pip install pyyaml
+    yaml = None
+
+
+CACHE_VERSION = 1
+_MISSING = object()  # no usable disk cache (None is a valid result)
+
+
+# Parsers
+# -----------------------------------------------------------------------------
+# Each takes the text of the file and returns plain Python data. ConfigParser
+# objects are turned into a dict of sections so interpolation (%(home)s) is
+# resolved once and the result can be pickled.
+
+def _parse_yaml(text):
+    if yaml is None:
+        raise ImportError('PyYAML is required to load YAML files')
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+
+def _parse_ini(text):
+    cfg = configparser.ConfigParser()
+    cfg.read_string(text)
+    return {section: dict(cfg[section]) for section in cfg.sections()}
+
+
+PARSERS = {
+    '.yaml': _parse_yaml,
+    '.yml': _parse_yaml,
+    '.cfg': _parse_ini,
+    '.ini': _parse_ini,
+    '.json': json.loads,
+}
+
+
+# The loader
+# -----------------------------------------------------------------------------
+
+def _cache_path(path):
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.' + tail + '.cache')
+
+
+def _read_disk_cache(path, stamp):
+    try:
+        with open(_cache_path(path), 'rb') as fob:
+            version, cached_stamp, data = pickle.load(fob)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return _MISSING
+    if version != CACHE_VERSION or tuple(cached_stamp) != stamp:
+        return _MISSING
+    return data
+
+
+def _write_disk_cache(path, stamp, data):
+    # write to a temporary name and rename it into place, so another process
+    # never sees a half written cache file:
+    cache = _cache_path(path)
+    temp = '{}.{}.tmp'.format(cache, os.getpid())
+    try:
+        with open(temp, 'wb') as fob:
+            pickle.dump((CACHE_VERSION, stamp, data), fob,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cache)
+    except (OSError, pickle.PicklingError):
+        # a read-only directory just means no disk cache
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+class ConfigLoader():
+    '''Load config files, remembering the results until the file changes.
+
+    validate, if given, is called with the parsed data and can raise an
+    exception to reject it or return a cleaned up version. The disk cache
+    is shared by every loader, so it holds the data as parsed and anything
+    read from it is validated again. Only this loader's memory cache holds
+    validated data.
+    '''
+
+    def __init__(self, validate=None, disk_cache=True):
+        self.validate = validate
+        self.disk_cache = disk_cache
+        self._memory = {}
+        self.stats = {'memory': 0, 'disk': 0, 'parsed': 0}
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        cached = self._memory.get(path)
+        if cached is not None and cached[0] == stamp:
+            self.stats['memory'] += 1
+            return cached[1]
+
+        data = _read_disk_cache(path, stamp) if self.disk_cache else _MISSING
+        if data is not _MISSING:
+            self.stats['disk'] += 1
+        else:
+            ext = os.path.splitext(path)[1].lower()
+            try:
+                parse = PARSERS[ext]
+            except KeyError:
+                raise ValueError('no parser for {!r} files'.format(ext))
+            with open(path) as fob:
+                data = parse(fob.read())
+            self.stats['parsed'] += 1
+            if self.disk_cache:
+                _write_disk_cache(path, stamp, data)
+
+        if self.validate is not None:
+            result = self.validate(data)
+            if result is not None:
+                data = result
+        self._memory[path] = (stamp, data)
+        return data
+
+    def clear(self):
+        self._memory.clear()
+
+
+# Callers get the same object back from the cache each time, so treat the
+# result as read only (or copy.deepcopy() it before changing anything).
+
+_default_loader = ConfigLoader()
+load_config = _default_loader.load
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Cold start (parse), warm start (pickle from a previous run) and repeat reads
+# within one process (memory).
+
+if __name__ == '__main__':
+    import time
+
+    files = ['data/practice.yaml', 'data/practice.cfg']
+    print('libyaml:', bool(yaml and hasattr(yaml, 'CSafeLoader')))
+
+    def timed(loader, label, repeat=200):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for filename in files:
+                loader.load(filename)
+            if label != 'memory':
+                loader.clear()
+        per_round = (time.perf_counter() - start) / repeat
+        print('{:7} {:8.1f} us per round of {} files'.format(
+            label, per_round * 1e6, len(files)))
+
+    timed(ConfigLoader(disk_cache=False), 'parse')
+    timed(ConfigLoader(), 'disk')
+    timed(ConfigLoader(), 'memory')
+
+    print(load_config('data/practice.cfg')['files']['bin'])  # /usr/local/bin
+    print(load_config('data/practice.yaml')['details'])
+
+    # a loader with a validate never gets data another loader's validate
+    # cleaned up, even through the shared disk cache
+    upper = ConfigLoader(validate=lambda data: {
+        name.upper(): section for name, section in data.items()})
+    assert 'FILES' in upper.load('data/practice.cfg')
+    assert 'files' in ConfigLoader().load('data/practice.cfg')
+
+    for filename in files:
+        os.remove(_cache_path(os.path.abspath(filename)))
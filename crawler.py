@@ -0,0 +1,342 @@
+'''Web Crawling: many pages at once (asyncio)'''
+
+
+# get_links() in web_scraping.py fetches one page, waits for all of it to
+# arrive, parses it, and only then moves on to the next URL. Almost all of
+# that time is spent waiting on the network. A crawler that follows the links
+# it finds needs a few more things:
+
+# - concurrency: fetch many pages at once. asyncio tasks wait for pages
+#   (see concurrency.py), at most `concurrency` at a time, while the actual
+#   downloads run on a small thread pool with urllib.
+# - politeness: don't hammer one site. At most per_host requests to the
+#   same host are in flight at once, with at least delay seconds between
+#   starting them.
+# - parsing in other processes: finding links is CPU work, and in a thread
+#   it would hold up everything else (the GIL). A ProcessPoolExecutor runs
+#   it on the other CPUs while the event loop carries on fetching.
+# - a seen set: every URL is normalized (no #fragment, lowercase host, ...)
+#   and only fetched once, however many pages link to it.
+# - a frontier saved to disk: the URLs still to visit, and which ones are
+#   done, live in a SQLite database (see sqlite3_example1.py). Stop the
+#   crawl at any point and a new Crawler with the same file carries on
+#   where it left off.
+
+#   crawler = Crawler(['http://localhost:8000/'], 'crawl.db', max_pages=500)
+#   asyncio.run(crawler.run())
+#   print(crawler.stats)
+
+# Links are found with link_extractor.py, which skips building the whole
+# BeautifulSoup tree that get_links() does.
+
+# see also: web_scraping.py, link_extractor.py, concurrency.py
+
+import asyncio
+import collections
+import concurrent.futures
+import http.client
+import os
+import sqlite3
+import urllib.parse
+import urllib.request
+
+from link_extractor import extract_links
+
+
+USER_AGENT = 'python-notes-crawler/1.0'
+QUEUED, DONE, FAILED = 0, 1, 2
+
+
+def normalize(url):
+    '''A canonical form of url, so the same page is only fetched once.'''
+    url, fragment = urllib.parse.urldefrag(url)
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = parts.netloc.lower()
+    if (scheme, host.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        host = host.rsplit(':', 1)[0]
+    return urllib.parse.urlunsplit((scheme, host, parts.path or '/',
+                                    parts.query, ''))
+
+
+# Parsing
+# -----------------------------------------------------------------------------
+# parse_page() runs in the worker processes, so it has to be a plain module
+# level function that can be pickled.
+
+def parse_page(url, body, charset='utf-8'):
+    '''Return the absolute, normalized http(s) links on a page.'''
+    page = body.decode(charset or 'utf-8', 'replace')
+    return [normalize(link) for link in extract_links(page, url)
+            if link.startswith(('http://', 'https://'))]
+
+
+def fetch(url, timeout=10):
+    '''Download url. Returns (final url, charset, body or None if not HTML).'''
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if response.headers.get_content_type() != 'text/html':
+            return response.geturl(), None, None
+        return (response.geturl(), response.headers.get_content_charset(),
+                response.read())
+
+
+# The frontier
+# -----------------------------------------------------------------------------
+
+class Frontier():
+    '''Every URL seen so far, with its depth and whether it's been visited.'''
+
+    def __init__(self, filename=':memory:'):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY '
+                        'KEY, depth INTEGER, state INTEGER)')
+        # the seen set: checking it in memory is much faster than asking
+        # the database about every link
+        self.seen = {url for url, in self.db.execute('SELECT url FROM urls')}
+        self.changes = 0
+
+    def add(self, urls, depth):
+        '''Queue the urls not seen before. Returns the new ones.'''
+        new = [url for url in dict.fromkeys(urls) if url not in self.seen]
+        self.seen.update(new)
+        self.db.executemany('INSERT OR IGNORE INTO urls VALUES (?, ?, ?)',
+                            [(url, depth, QUEUED) for url in new])
+        self._changed(len(new))
+        return new
+
+    def queued(self):
+        return self.db.execute('SELECT url, depth FROM urls WHERE state = ? '
+                               'ORDER BY depth', (QUEUED,)).fetchall()
+
+    def mark(self, url, state):
+        self.db.execute('UPDATE urls SET state = ? WHERE url = ?',
+                        (state, url))
+        self._changed(1)
+
+    def _changed(self, count):
+        # committing is the slow part, so do it every so often, not every time
+        self.changes += count
+        if self.changes >= 100:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.changes = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+# The crawler
+# -----------------------------------------------------------------------------
+
+class Crawler():
+
+    def __init__(self, start_urls, frontier=':memory:', concurrency=20,
+                 per_host=4, delay=0.0, max_pages=100, max_depth=3,
+                 hosts=None, timeout=10, parse_workers=None):
+        self.start_urls = [normalize(url) for url in start_urls]
+        self.frontier = (frontier if isinstance(frontier, Frontier)
+                         else Frontier(frontier))
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        # only follow links to these hosts (by default the start URLs' hosts)
+        self.hosts = set(hosts or (urllib.parse.urlsplit(url).netloc
+                                   for url in self.start_urls))
+        self.timeout = timeout
+        self.parse_workers = parse_workers
+        self.stats = collections.Counter()
+        self.pages = {}          # url -> links found on it, for this run
+        self._host_limits = {}
+        self._next_start = {}
+        self._started = 0
+
+    async def _polite(self, host):
+        # wait until it's this host's turn
+        loop = asyncio.get_running_loop()
+        wait = self._next_start.get(host, 0) - loop.time()
+        self._next_start[host] = max(loop.time(), self._next_start.get(
+            host, 0)) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def _visit(self, url, depth, queue, threads, processes):
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(url).netloc
+        limit = self._host_limits.setdefault(
+            host, asyncio.Semaphore(self.per_host))
+        try:
+            async with limit:
+                await self._polite(host)
+                final_url, charset, body = await loop.run_in_executor(
+                    threads, fetch, url, self.timeout)
+        except (OSError, ValueError, http.client.HTTPException):
+            # URLError and timeouts are OSErrors
+            self.stats['failed'] += 1
+            self.frontier.mark(url, FAILED)
+            return
+        self.stats['fetched'] += 1
+        links = []
+        if body is not None:
+            self.stats['bytes'] += len(body)
+            try:
+                links = await loop.run_in_executor(processes, parse_page,
+                                                   final_url, body, charset)
+            except (ValueError, UnicodeError, LookupError):
+                # a page we can't make sense of (a bad URL, an unknown
+                # charset) counts as failed, and is just skipped
+                self.stats['failed'] += 1
+                self.frontier.mark(url, FAILED)
+                return
+        self.pages[url] = links
+        self.stats['links'] += len(links)
+        self.frontier.mark(url, DONE)
+        if depth < self.max_depth:
+            follow = [link for link in links
+                      if urllib.parse.urlsplit(link).netloc in self.hosts]
+            for link in self.frontier.add(follow, depth + 1):
+                queue.put_nowait((link, depth + 1))
+
+    async def _worker(self, queue, threads, processes):
+        while True:
+            url, depth = await queue.get()
+            try:
+                # Past max_pages the rest are left queued in the frontier
+                # for next time.
+                if self._started < self.max_pages:
+                    self._started += 1
+                    await self._visit(url, depth, queue, threads, processes)
+            except Exception as err:
+                # Anything unexpected from one page mustn't stop this
+                # worker, or the pages queued for it would never be done
+                # and run() would wait forever.
+                print('crawler: {} failed: {!r}'.format(url, err))
+                self.stats['failed'] += 1
+                self.frontier.mark(url, FAILED)
+            finally:
+                queue.task_done()
+
+    async def run(self):
+        '''Crawl until there's nothing left to visit or max_pages is hit.'''
+        queue = asyncio.Queue()
+        self.frontier.add(self.start_urls, 0)
+        for url, depth in self.frontier.queued():
+            queue.put_nowait((url, depth))
+        threads = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        processes = concurrent.futures.ProcessPoolExecutor(
+            self.parse_workers)
+        workers = [asyncio.create_task(self._worker(queue, threads,
+                                                    processes))
+                   for i in range(self.concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            threads.shutdown()
+            processes.shutdown()
+            self.frontier.commit()
+        return self.pages
+
+
+def crawl(start_urls, frontier=':memory:', **options):
+    '''Run a Crawler and return {url: links} for the pages it visited.'''
+    return asyncio.run(Crawler(start_urls, frontier, **options).run())
+
+
+# A test site
+# -----------------------------------------------------------------------------
+# A local web server with as many generated pages as we like, each linking to
+# a handful of others (some relative, some absolute, some with #fragments),
+# and a delay on every response to stand in for a real network.
+
+def serve_test_site(pages=1000, links=10, latency=0.05, port=0):
+    '''Start the test site on a thread. Returns its base URL.'''
+    import http.server
+    import threading
+    import time
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            try:
+                number = int(self.path.strip('/').split('/')[-1] or 0)
+            except ValueError:
+                number = pages
+            if number >= pages:
+                self.send_error(404)
+                return
+            hrefs = ['/page/{}', '{}#top', base + '/page/{}']
+            anchors = ''.join(
+                '<li><a href="{}">page {}</a></li>'.format(
+                    hrefs[i % 3].format(target), target)
+                for i, target in enumerate(
+                    (number * 7 + i * 13 + 1) % pages for i in range(links)))
+            body = ('<html><head><title>Page {0}</title></head><body>'
+                    '<h1>Page {0}</h1><p>{1}</p><ul>{2}</ul>'
+                    '</body></html>').format(number, 'Lorem ipsum. ' * 200,
+                                             anchors).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    base = 'http://localhost:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return base + '/page/0'
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# One page at a time like web_scraping.py's main loop, then the crawler, then
+# a crawl that's stopped halfway and resumed from its frontier file.
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    start_url = serve_test_site(pages=1000, latency=0.05)
+
+    start = time.perf_counter()
+    todo, seen = [normalize(start_url)], set()
+    while todo and len(seen) < 100:
+        url = todo.pop(0)
+        if url in seen:
+            continue
+        seen.add(url)
+        final_url, charset, body = fetch(url)
+        todo.extend(parse_page(final_url, body, charset))
+    elapsed = time.perf_counter() - start
+    print('one at a time: {} pages in {:.2f}s, {:.0f} pages/sec'.format(
+        len(seen), elapsed, len(seen) / elapsed))
+
+    start = time.perf_counter()
+    crawler = Crawler([start_url], max_pages=1000, max_depth=10,
+                      concurrency=50, per_host=50)
+    asyncio.run(crawler.run())
+    elapsed = time.perf_counter() - start
+    print('crawler: {} pages in {:.2f}s, {:.0f} pages/sec  {}'.format(
+        len(crawler.pages), elapsed, len(crawler.pages) / elapsed,
+        dict(crawler.stats)))
+
+    filename = os.path.join(tempfile.mkdtemp(), 'frontier.db')
+    first = crawl([start_url], filename, max_pages=300, max_depth=10,
+                  concurrency=50, per_host=50)
+    second = crawl([start_url], filename, max_pages=1000, max_depth=10,
+                   concurrency=50, per_host=50)
+    print('resumed: {} pages, then {} more, {} fetched twice'.format(
+        len(first), len(second), len(first.keys() & second.keys())))
@@ -0,0 +1,256 @@
+'''A compact binary message format for the socket demos (struct)'''
+
+
+# The socket demos send whatever bytes they like (b'Hi there'). Real messages
+# are usually records, and the easy way to send a record is JSON:
+
+#   {"id": 1, "symbol": "ACME", "price": 12.5, "quantity": 100, ...}
+
+# That's readable, but every message repeats the field names, numbers are
+# sent as text, and both ends spend CPU time turning text into numbers and
+# back. When both ends agree on the layout of a record in advance, the
+# struct module can pack it into a fixed number of bytes instead (see
+# binary_and_unicode.py):
+
+#   struct.Struct('!Q8sdId')  ->  36 bytes, every time
+
+# A Schema is a record layout with a type number. Building the
+# struct.Struct once, up front, means the format string isn't parsed again
+# for every record.
+
+# A message is a small header, then one or more records of the same type:
+
+#   type (2 bytes)  count (4 bytes)  record  record  record ...
+
+# One record per message is simple; a "batch" of many records in one message
+# saves a header and a network round trip per record. Records always have
+# the same size, so the count says exactly how long the message is.
+
+# Decoding doesn't copy anything: struct.iter_unpack() reads the records
+# straight out of the receive buffer through a memoryview. Only the numbers
+# and strings it unpacks are new objects.
+
+# On TCP each message goes inside demos/tcp_server.py's length-prefixed frame
+# (tcp_server.frame(message)), and each_message() finds the messages in a
+# receive buffer. On UDP each datagram is one message already.
+
+# Text fields are fixed width ('8s'): shorter values are padded with zero
+# bytes and longer ones cut off. Unpacked raw tuples keep the padding;
+# records() strips it and decodes the text.
+
+# see also: networks.md, demos/tcp_server.py, demos/udp_server.py,
+#           binary_and_unicode.py, json_example.py
+
+import collections
+import struct
+
+from tcp_server import HEADER
+
+MESSAGE = struct.Struct('!HI')      # type, number of records
+SCHEMAS = {}                        # type -> Schema
+
+
+class Schema():
+    '''A record layout: fields is a list of (name, struct format) pairs.'''
+
+    def __init__(self, type, name, fields):
+        if type in SCHEMAS:
+            raise ValueError('schema type {} is already {}'.format(
+                type, SCHEMAS[type].name))
+        self.type = type
+        self.name = name
+        self.fields = fields
+        self.struct = struct.Struct('!' + ''.join(fmt for _, fmt in fields))
+        self.size = self.struct.size
+        self.record = collections.namedtuple(name, [n for n, _ in fields])
+        self.text = [i for i, (_, fmt) in enumerate(fields)
+                     if fmt.endswith('s')]
+        SCHEMAS[type] = self
+
+    def encode(self, record):
+        '''One record as a message.'''
+        return MESSAGE.pack(self.type, 1) + self.struct.pack(*record)
+
+    def encode_batch(self, records):
+        '''Many records as one message.'''
+        pack = self.struct.pack
+        body = b''.join([pack(*record) for record in records])
+        return MESSAGE.pack(self.type, len(body) // self.size) + body
+
+    def batch_size(self, limit):
+        '''How many records fit in a message of at most limit bytes.'''
+        return (limit - MESSAGE.size) // self.size
+
+    def __repr__(self):
+        return '<Schema {} {}: {} bytes>'.format(self.type, self.name,
+                                                 self.size)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def decode(message):
+    '''Return (schema, raw tuples) for a message, without copying it.
+
+    message can be bytes, a bytearray or a memoryview. The tuples are
+    produced lazily, so the buffer must not change until they've been
+    read.
+    '''
+    view = memoryview(message)
+    if len(view) < MESSAGE.size:
+        raise ProtocolError('message too short')
+    type, count = MESSAGE.unpack_from(view)
+    try:
+        schema = SCHEMAS[type]
+    except KeyError:
+        raise ProtocolError('unknown record type {}'.format(type)) from None
+    end = MESSAGE.size + count * schema.size
+    if len(view) != end:
+        raise ProtocolError('{} {} records need {} bytes, got {}'.format(
+            count, schema.name, end, len(view)))
+    return schema, schema.struct.iter_unpack(view[MESSAGE.size:])
+
+
+def records(message):
+    '''Decode a message into named tuples, with text fields decoded.'''
+    schema, rows = decode(message)
+    make = schema.record._make
+    if not schema.text:
+        return [make(row) for row in rows]
+    result = []
+    for row in rows:
+        row = list(row)
+        for i in schema.text:
+            row[i] = row[i].rstrip(b'\0').decode('utf-8', 'replace')
+        result.append(make(row))
+    return result
+
+
+def each_message(buf, handle):
+    '''Call handle(message) for every complete framed message in buf.
+
+    Like tcp_server.unframe() but without copying: message is a memoryview
+    into buf, only valid during the call. Afterwards the messages are
+    removed from buf, leaving any partial one for next time. Returns how
+    many were handled.
+    '''
+    count = start = 0
+    with memoryview(buf) as view:
+        while len(view) - start >= HEADER.size:
+            size, = HEADER.unpack_from(view, start)
+            if len(view) - start - HEADER.size < size:
+                break
+            start += HEADER.size
+            with view[start:start + size] as message:
+                handle(message)
+            start += size
+            count += 1
+    del buf[:start]
+    return count
+
+
+# Some example schemas
+# -----------------------------------------------------------------------------
+
+Trade = Schema(1, 'Trade', [('id', 'Q'), ('symbol', '8s'), ('price', 'd'),
+                            ('quantity', 'I'), ('timestamp', 'd')])
+Summary = Schema(2, 'Summary', [('trades', 'Q'), ('quantity', 'Q'),
+                                ('value', 'd')])
+
+
+def summarize(message):
+    '''A tcp_server handler: reply to a batch of trades with a Summary.'''
+    schema, rows = decode(message)
+    trades = quantity = value = 0
+    for id, symbol, price, qty, timestamp in rows:
+        trades += 1
+        quantity += qty
+        value += price * qty
+    return Summary.encode((trades, quantity, value))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Encoding and decoding speed and size against JSON, then batches of trades
+# sent to the TCP server (which replies with a summary) and the UDP server.
+
+if __name__ == '__main__':
+    import json
+    import random
+    import threading
+    import time
+
+    import tcp_client
+    import tcp_server
+    import udp_server
+
+    random.seed(1)
+    count = 200000
+    symbols = [b'ACME', b'INITECH', b'HOOLI', b'UMBRELLA']
+    trades = [(i, random.choice(symbols), round(random.uniform(1, 500), 2),
+               random.randrange(1, 1000), 1.5e9 + i * 0.001)
+              for i in range(count)]
+    dicts = [{'id': t[0], 'symbol': t[1].decode(), 'price': t[2],
+              'quantity': t[3], 'timestamp': t[4]} for t in trades]
+
+    def timed(label, func):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        print('{:33}{:7.3f}s  {:10,.0f} records/sec'.format(
+            label, elapsed, count / elapsed))
+        return result
+
+    data = timed('json encode', lambda: json.dumps(dicts).encode())
+    timed('json decode', lambda: json.loads(data))
+    batch = timed('struct encode (one batch)',
+                  lambda: Trade.encode_batch(trades))
+    timed('struct decode (raw tuples)', lambda: list(decode(batch)[1]))
+    timed('struct decode (named, text)', lambda: records(batch))
+    singles = timed('struct encode (one per message)',
+                    lambda: [Trade.encode(t) for t in trades])
+    timed('struct decode (one per message)',
+          lambda: [next(decode(m)[1]) for m in singles])
+    print('size: json {:,} bytes, struct {:,} bytes ({:.0f}%)'.format(
+        len(data), len(batch), 100 * len(batch) / len(data)))
+
+    # TCP: batches of 1000 trades, each answered with a Summary
+    server = tcp_server.Server(('localhost', 0),
+                               tcp_server.with_request_ids(summarize))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    start = time.perf_counter()
+    with tcp_client.Pool(server.address) as pool:
+        futures = [pool.request(Trade.encode_batch(trades[i:i + 1000]))
+                   for i in range(0, count, 1000)]
+        summaries = [records(future.result())[0] for future in futures]
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print('tcp: {:,} trades summarized in {:.2f}s ({:,.0f}/sec), '
+          'total quantity {:,}'.format(
+              count, elapsed, count / elapsed,
+              sum(summary.quantity for summary in summaries)))
+
+    # UDP: batches that fit in one ordinary 1500 byte ethernet packet
+    received = [0]
+
+    def count_trades(packet, client):
+        schema, rows = decode(packet)
+        received[0] += sum(1 for row in rows)
+
+    server = udp_server.Server(('localhost', 0), count_trades)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    per_packet = Trade.batch_size(1400)
+    sock = udp_server.socket.socket(udp_server.socket.AF_INET,
+                                    udp_server.socket.SOCK_DGRAM)
+    sock.connect(server.address)
+    start = time.perf_counter()
+    for i in range(0, count, per_packet):
+        sock.send(Trade.encode_batch(trades[i:i + per_packet]))
+        if i % (per_packet * 50) == 0:
+            time.sleep(0.001)     # UDP has no flow control: don't flood
+    time.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print('udp: {:,} of {:,} trades received in {:.2f}s, {} per '
+          'packet'.format(received[0], count, elapsed, per_packet))
@@ -1,17 +1,358 @@
-import datetime
+'''A TCP client with a connection pool and pipelining'''
+
+
+# The first version of this client (see networks.md) connected, sent one
+# message, waited for the reply and hung up. Every message paid for a new
+# TCP handshake, and nothing else could be sent while waiting.
+
+# This client talks to demos/tcp_server.py and does two things differently:
+
+# 1. Connections are kept open in a Pool and reused, so the handshake is
+#    paid once per connection rather than once per message.
+
+# 2. Requests are pipelined: a request is sent without waiting for the
+#    replies to earlier ones, so many can be in flight on one connection.
+#    Each message starts with an 8 byte request ID and the server puts the
+#    same ID on the reply (see with_request_ids() in tcp_server.py), so
+#    replies are matched to their requests even if they come back in a
+#    different order.
+
+# request() returns straight away with a future; call() waits for the reply.
+# There are two versions with the same methods: Pool uses a thread per
+# connection to read replies, for ordinary code, and AsyncPool is for
+# asyncio code (see concurrency.py).
+
+#   with Pool(address) as pool:
+#       print(pool.call(b'Hi there'))
+#       futures = [pool.request(b'message') for i in range(1000)]
+#       replies = [future.result() for future in futures]
+
+#   async with AsyncPool(address) as pool:
+#       replies = await asyncio.gather(*(pool.call(b'hello')
+#                                        for i in range(1000)))
+
+# see also: networks.md, demos/tcp_server.py
+
+import asyncio
+import concurrent.futures
+import itertools
 import socket
+import threading
+
+from tcp_server import HEADER, MAX_SIZE, REQUEST_ID, address
+
+
+def _frame(request_id, message):
+    return (HEADER.pack(REQUEST_ID.size + len(message))
+            + REQUEST_ID.pack(request_id) + message)
+
+
+class Connection():
+    '''One connection with any number of requests in flight.'''
+
+    def __init__(self, address=address, timeout=None):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(None)
+        self.pending = {}         # request ID -> future
+        self.ids = itertools.count()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_replies,
+                                        daemon=True)
+        self._reader.start()
+
+    def request(self, message):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError('connection is closed')
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+        # A separate lock for sending: sendall() can block until the server
+        # reads, and the reader thread mustn't be kept waiting meanwhile.
+        with self._send_lock:
+            try:
+                self.sock.sendall(_frame(request_id, message))
+            except OSError:
+                with self._lock:
+                    self.pending.pop(request_id, None)
+                raise
+        return future
+
+    def call(self, message, timeout=None):
+        return self.request(message).result(timeout)
+
+    def _read_replies(self):
+        sock = self.sock
+        buf = bytearray()
+        error = None
+        try:
+            while True:
+                while len(buf) < HEADER.size:
+                    self._fill(sock, buf)
+                size, = HEADER.unpack_from(buf)
+                if size > MAX_SIZE:
+                    raise ConnectionError('reply over the size limit')
+                while len(buf) < HEADER.size + size:
+                    self._fill(sock, buf)
+                request_id, = REQUEST_ID.unpack_from(buf, HEADER.size)
+                reply = bytes(buf[HEADER.size + REQUEST_ID.size:
+                                  HEADER.size + size])
+                del buf[:HEADER.size + size]
+                with self._lock:
+                    future = self.pending.pop(request_id, None)
+                # False if the caller cancelled it; then nobody wants it
+                if (future is not None and
+                        future.set_running_or_notify_cancel()):
+                    future.set_result(reply)
+        except (OSError, ConnectionError) as err:
+            error = err
+        with self._lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError(
+                    'connection lost: {}'.format(error)))
+
+    @staticmethod
+    def _fill(sock, buf):
+        data = sock.recv(256 * 1024)
+        if not data:
+            raise ConnectionError('closed by the server')
+        buf += data
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._reader.join()
+
+
+class Pool():
+    '''Up to size persistent connections, opened as they're needed.
+
+    Each request goes on the open connection with the fewest requests in
+    flight; a new connection is only opened when all of them are busy.
+    '''
+
+    def __init__(self, address=address, size=4, timeout=None):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.connections = []
+        self.connects = 0
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        with self._lock:
+            self.connections = [conn for conn in self.connections
+                                if not conn.closed]
+            idle = min(self.connections, default=None,
+                       key=lambda conn: len(conn.pending))
+            if idle is None or idle.pending and len(
+                    self.connections) < self.size:
+                idle = Connection(self.address, self.timeout)
+                self.connections.append(idle)
+                self.connects += 1
+            return idle
+
+    def request(self, message):
+        return self._connection().request(message)
+
+    def call(self, message, timeout=None):
+        return self.request(message).result(timeout)
+
+    def close(self):
+        with self._lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# asyncio
+# -----------------------------------------------------------------------------
+# The same thing with a reader task per connection instead of a thread.
+
+class AsyncConnection():
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.ids = itertools.count()
+        self.closed = False
+        self._task = asyncio.get_running_loop().create_task(
+            self._read_replies())
+
+    @classmethod
+    async def open(cls, address=address):
+        reader, writer = await asyncio.open_connection(*address)
+        writer.get_extra_info('socket').setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(reader, writer)
+
+    def request(self, message):
+        if self.closed:
+            raise ConnectionError('connection is closed')
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(_frame(request_id, message))
+        return future
+
+    async def call(self, message):
+        future = self.request(message)
+        # let the write buffer drain if the server is falling behind
+        await self.writer.drain()
+        return await future
+
+    async def _read_replies(self):
+        error = None
+        try:
+            while True:
+                size, = HEADER.unpack(
+                    await self.reader.readexactly(HEADER.size))
+                if size > MAX_SIZE:
+                    raise ConnectionError('reply over the size limit')
+                data = await self.reader.readexactly(size)
+                request_id, = REQUEST_ID.unpack_from(data)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(data[REQUEST_ID.size:])
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as err:
+            error = err
+        except asyncio.CancelledError:
+            error = 'closed'
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(
+                    'connection lost: {}'.format(error)))
+
+    async def close(self):
+        self.closed = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class AsyncPool():
+
+    def __init__(self, address=address, size=4):
+        self.address = address
+        self.size = size
+        self.connections = []
+        self.connects = 0
+        self._lock = asyncio.Lock()
+
+    async def _connection(self):
+        async with self._lock:
+            self.connections = [conn for conn in self.connections
+                                if not conn.closed]
+            idle = min(self.connections, default=None,
+                       key=lambda conn: len(conn.pending))
+            if idle is None or idle.pending and len(
+                    self.connections) < self.size:
+                idle = await AsyncConnection.open(self.address)
+                self.connections.append(idle)
+                self.connects += 1
+            return idle
+
+    async def request(self, message):
+        return (await self._connection()).request(message)
+
+    async def call(self, message):
+        return await (await self._connection()).call(message)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The same number of messages sent three ways: a new connection for every
+# message like the first version of this client, one message at a time over
+# a pooled connection, and pipelined across the pool. Starts
+# demos/tcp_server.py if it isn't running already.
+
+if __name__ == '__main__':
+    import datetime
+    import os
+    import signal
+    import time
+
+    from tcp_load import server_running, start_server
+
+    proc = None if server_running(address[1]) else start_server(address[1])
+    print('Starting the client at', datetime.datetime.now())
+    count = 10000
+    message = os.urandom(100)
+
+    def timed(label, func):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print('{:32}{:6.2f}s  {:8,.0f} messages/sec'.format(
+            label, elapsed, count / elapsed))
 
+    def connection_per_message():
+        for i in range(count):
+            conn = Connection(address)
+            assert conn.call(message) == message
+            conn.close()
 
-address = ('localhost', 4544)
-max_size = 1000
-print('Starting the client at', datetime.datetime.now())
+    def one_at_a_time():
+        with Pool(address) as pool:
+            for i in range(count):
+                assert pool.call(message) == message
 
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def pipelined():
+        with Pool(address) as pool:
+            futures = [pool.request(message) for i in range(count)]
+            assert all(future.result() == message for future in futures)
 
-# The connect() call sets up a stream
-client.connect(address)
-client.sendall(b'Hi there')
-data = client.recv(max_size)
-print('Message:', datetime.datetime.now(), 'someone replied', data)
+    async def pipelined_async():
+        async with AsyncPool(address) as pool:
+            futures = [await pool.request(message) for i in range(count)]
+            replies = await asyncio.gather(*futures)
+            assert all(reply == message for reply in replies)
 
-client.close()
+    try:
+        with Pool(address) as pool:
+            print('Message:', datetime.datetime.now(), 'someone replied',
+                  pool.call(b'Hi there'))
+        timed('new connection per message', connection_per_message)
+        timed('pooled, one at a time', one_at_a_time)
+        timed('pooled and pipelined', pipelined)
+        timed('pooled and pipelined (asyncio)',
+              lambda: asyncio.run(pipelined_async()))
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
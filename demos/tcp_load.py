@@ -0,0 +1,125 @@
+'''Load test for demos/tcp_server.py (asyncio)'''
+
+
+# Opens lots of connections to the server at once, then has every one of
+# them send messages and wait for each reply, like many separate clients
+# would. asyncio lets one process play thousands of clients (see
+# concurrency.py). Reports:
+
+# - connections/sec: how fast the server accepts new clients
+# - messages/sec: replies received per second across all the connections
+# - latency: how long each message took to come back, as percentiles. The
+#   median shows the usual case, p99 shows the slowest 1 in 100.
+
+# If no server is running on the port, one is started as a subprocess and
+# stopped afterwards with SIGTERM, which also exercises its graceful shutdown.
+
+#   $ python3 demos/tcp_load.py [connections] [messages] [size] [port]
+
+# The machine's open file limit (ulimit -n) has to allow for the client and
+# server ends of every connection.
+
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from tcp_server import HEADER, address, frame
+
+
+async def request(reader, writer, message):
+    writer.write(frame(message))
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return await reader.readexactly(size)
+
+
+async def connect_all(port, count, concurrency=200):
+    # Limit how many handshakes are in progress at once so the server's
+    # listen backlog doesn't overflow.
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect():
+        async with limit:
+            return await asyncio.open_connection(address[0], port)
+
+    return await asyncio.gather(*(connect() for i in range(count)))
+
+
+async def client(reader, writer, messages, message, latencies):
+    for i in range(messages):
+        start = time.perf_counter()
+        reply = await request(reader, writer, message)
+        latencies.append(time.perf_counter() - start)
+        assert reply == message
+
+
+async def main(connections, messages, size, port):
+    start = time.perf_counter()
+    streams = await connect_all(port, connections)
+    elapsed = time.perf_counter() - start
+    print('{:,} connections in {:.2f}s: {:,.0f} connections/sec'.format(
+        connections, elapsed, connections / elapsed))
+
+    message = os.urandom(size)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(reader, writer, messages, message,
+                                  latencies)
+                           for reader, writer in streams))
+    elapsed = time.perf_counter() - start
+    print('{:,} messages of {} bytes in {:.2f}s: {:,.0f} messages/sec'.format(
+        len(latencies), size, elapsed, len(latencies) / elapsed))
+    cuts = statistics.quantiles(latencies, n=100)
+    print('latency ms: p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}'.format(
+        cuts[49] * 1000, cuts[89] * 1000, cuts[98] * 1000,
+        max(latencies) * 1000))
+
+    # one message far bigger than the old recv(1000) could ever have read
+    reader, writer = streams[0]
+    big = os.urandom(5 * 1024 * 1024)
+    start = time.perf_counter()
+    assert await request(reader, writer, big) == big
+    print('5 MB message echoed intact in {:.3f}s'.format(
+        time.perf_counter() - start))
+
+    for reader, writer in streams:
+        writer.close()
+    await asyncio.gather(*(writer.wait_closed() for reader, writer in streams),
+                         return_exceptions=True)
+
+
+def start_server(port):
+    '''Start demos/tcp_server.py and wait until it accepts connections.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here,
+                                                          'tcp_server.py'),
+                             str(port)], stdout=subprocess.PIPE, text=True)
+    proc.stdout.readline()     # Starting the server at ...
+    proc.stdout.readline()     # listening on ...
+    return proc
+
+
+def server_running(port):
+    import socket
+    try:
+        socket.create_connection((address[0], port)).close()
+    except ConnectionRefusedError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    connections, messages, size, port = args + [1000, 100, 100,
+                                                address[1]][len(args):]
+
+    proc = None if server_running(port) else start_server(port)
+    try:
+        asyncio.run(main(connections, messages, size, port))
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            print('server:', proc.communicate(timeout=30)[0].strip())
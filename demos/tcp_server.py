@@ -1,24 +1,274 @@
+'''A TCP server for many clients at once (selectors)'''
+
+
+# The first version of this server (see networks.md) accepted one client,
+# called recv(1000) once, replied and quit. Two things stop that from being
+# a real server:
+
+# 1. TCP sends a stream of bytes, not messages. One recv() can return half
+#    a message, or two and a bit, and anything over max_size was simply cut
+#    off. So every message here is "framed": a 4 byte length (network byte
+#    order, '!I') followed by exactly that many bytes. The receiver keeps
+#    what has arrived in a buffer until a whole frame is there.
+
+# 2. accept() and recv() block, so while the server waits on one client
+#    every other one waits too. Instead all the sockets are non-blocking and
+#    a selector (epoll on Linux, kqueue on BSD/macOS) tells us which ones are
+#    ready. One thread then handles thousands of connections, each with its
+#    own input and output buffer.
+
+# Replies that can't be sent straight away (the client isn't reading fast
+# enough) wait in the connection's output buffer. While that buffer is over
+# MAX_PENDING we stop reading from that client, so a slow reader can't make
+# the server buffer without limit.
+
+# Shutting down (Ctrl-C, SIGTERM or server.shutdown() from another thread)
+# stops accepting new connections, lets replies that are already buffered go
+# out for up to grace seconds, then closes everything.
+
+# Run the server:        $ python3 demos/tcp_server.py [port]
+# Load test it:          $ python3 demos/tcp_load.py [connections] [messages]
+
+# see also: networks.md, demos/tcp_client.py, memcache_server.py
+
 import datetime
+import selectors
+import signal
 import socket
-
+import struct
+import time
 
 address = ('localhost', 4544)
-max_size = 1000  # bytes
-print('Starting the server at', datetime.datetime.now())
-print('waiting for client to call')
+HEADER = struct.Struct('!I')        # message length
+MAX_SIZE = 16 * 1024 * 1024         # largest message accepted, in bytes
+MAX_PENDING = 4 * 1024 * 1024       # stop reading while this much is unsent
+RECV_SIZE = 256 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def frame(message):
+    '''The bytes to send for one message.'''
+    return HEADER.pack(len(message)) + message
+
+
+def unframe(buf, max_size=MAX_SIZE):
+    '''Split complete messages off the front of a bytearray.
+
+    Returns a list of messages and removes them from buf, leaving any
+    partial message behind for next time.
+    '''
+    messages = []
+    view = memoryview(buf)
+    start = 0
+    end = len(buf)
+    while end - start >= HEADER.size:
+        size, = HEADER.unpack_from(view, start)
+        if size > max_size:
+            view.release()
+            raise FrameError('message of {} bytes is over the {} byte '
+                             'limit'.format(size, max_size))
+        if end - start - HEADER.size < size:
+            break
+        start += HEADER.size
+        messages.append(bytes(view[start:start + size]))
+        start += size
+    view.release()
+    del buf[:start]
+    return messages
+
+
+def echo(message):
+    return message
+
+
+# Clients that keep several requests in flight on one connection (see
+# demos/tcp_client.py) start each message with an 8 byte request ID, and
+# need the same ID on the front of the reply to match it up. echo() does
+# that already; other handlers can be wrapped with with_request_ids().
+
+REQUEST_ID = struct.Struct('!Q')
+
+
+def with_request_ids(handler):
+    def tagged(message):
+        tag = message[:REQUEST_ID.size]
+        return tag + handler(message[REQUEST_ID.size:])
+    return tagged
+
+
+class Connection():
+    __slots__ = ('sock', 'addr', 'inbuf', 'outbuf', 'events')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.events = selectors.EVENT_READ
+
+
+class Server():
+    '''Serve framed messages, replying with handler(message).'''
+
+    def __init__(self, address=address, handler=echo, backlog=1024,
+                 max_size=MAX_SIZE):
+        self.handler = handler
+        self.max_size = max_size
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(backlog)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # writing a byte to _wakeup interrupts select() from another thread
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ)
+        self.connections = {}
+        self.stopping = False
+        self.stats = {'connections': 0, 'messages': 0, 'errors': 0}
+
+    def _accept(self):
+        # accept everything that's waiting, not just one per select()
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock, addr)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            self.stats['connections'] += 1
+
+    def _close(self, conn):
+        self.selector.unregister(conn.sock)
+        del self.connections[conn.sock]
+        conn.sock.close()
+
+    def _update(self, conn):
+        # Read unless the output buffer is too full, write while there's
+        # anything in it. Once stopping, a connection with nothing left to
+        # send is done.
+        events = 0
+        if not self.stopping and len(conn.outbuf) < MAX_PENDING:
+            events |= selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        if not events:
+            self._close(conn)
+        elif events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(conn)
+            return
+        conn.inbuf += data
+        try:
+            messages = unframe(conn.inbuf, self.max_size)
+        except FrameError:
+            self.stats['errors'] += 1
+            self._close(conn)
+            return
+        if not messages:
+            return
+        self.stats['messages'] += len(messages)
+        handler = self.handler
+        for message in messages:
+            try:
+                reply = handler(message)
+                conn.outbuf += HEADER.pack(len(reply))
+                conn.outbuf += reply
+            except Exception as err:
+                # a handler bug only costs this client its connection
+                print('handler failed for {}: {!r}'.format(conn.addr, err))
+                self.stats['errors'] += 1
+                self._close(conn)
+                return
+        self._write(conn)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._close(conn)
+            return
+        del conn.outbuf[:sent]
+        self._update(conn)
+
+    def serve_forever(self, grace=5.0):
+        deadline = None
+        while self.connections or not self.stopping:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.listener:
+                    self._accept()
+                elif key.fileobj is self._wakeup:
+                    self._wakeup.recv(64)
+                    if self.stopping and deadline is None:
+                        deadline = time.monotonic() + grace
+                        self._begin_shutdown()
+                elif key.data.sock in self.connections:
+                    conn = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(conn)
+                    if (events & selectors.EVENT_WRITE
+                            and conn.sock in self.connections):
+                        self._write(conn)
+        self._close_all()
+
+    def _begin_shutdown(self):
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        for conn in list(self.connections.values()):
+            self._update(conn)
+
+    def _close_all(self):
+        for conn in list(self.connections.values()):
+            self._close(conn)
+        self.selector.close()
+        self._wakeup.close()
+        self._waker.close()
+        if self.listener.fileno() != -1:
+            self.listener.close()
 
-# SOCK_DGRAM is replaced with SOCK_STREAM to use the streaming TCP protocol:
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(address)
+    def shutdown(self):
+        '''Stop the server. Safe to call from another thread or a signal
+        handler.'''
+        self.stopping = True
+        try:
+            self._waker.send(b'x')
+        except OSError:
+            pass
 
-# This queues up to 5 client connections before refusing new ones:
-server.listen(5)
 
-# TCP gets the first available message as it arrives:
-client, addr = server.accept()
-data = client.recv(max_size)
-print('Message:', datetime.datetime.now(), client, 'said', data)
+if __name__ == '__main__':
+    import sys
 
-client.sendall(b'Are you talking to me?')
-client.close()
-server.close()
+    if len(sys.argv) > 1:
+        address = (address[0], int(sys.argv[1]))
+    server = Server(address)
+    signal.signal(signal.SIGINT, lambda *args: server.shutdown())
+    signal.signal(signal.SIGTERM, lambda *args: server.shutdown())
+    print('Starting the server at', datetime.datetime.now())
+    print('listening on {}:{}'.format(*server.address))
+    server.serve_forever()
+    print('Stopped at', datetime.datetime.now(), server.stats)
@@ -0,0 +1,101 @@
+'''Blast demos/udp_server.py with UDP packets'''
+
+
+# Sends packets as fast as it can (or at a set rate), then asks the server
+# for its counts to see how many actually arrived. UDP has no flow control:
+# a sender that's faster than the receiver just loses packets, and this shows
+# how many, and where - the kernel's socket buffer, or the server's own
+# buffer pool and worker queue.
+
+# The packets start with b'#' so the server counts them without replying.
+# Using several sockets (from different ports) lets the kernel spread them
+# over the processes of a server started with SO_REUSEPORT.
+
+# If no server answers, one is started as a subprocess for the run.
+
+#   $ python3 demos/udp_blast.py [packets] [size] [port] [sockets] [rate]
+
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from udp_server import server_address
+
+
+def server_stats(address, timeout=1.0):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(b'STATS', address)
+        try:
+            return json.loads(sock.recv(4096))
+        except socket.timeout:
+            return None
+
+
+def blast(address, packets, size, sockets=1, rate=0):
+    '''Send packets datagrams of size bytes. Returns the seconds taken.'''
+    socks = []
+    for i in range(sockets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(address)     # then send() needn't repeat the address
+        socks.append(sock)
+    payload = b'#' + os.urandom(size - 1)
+    sends = [sock.send for sock in socks]
+    start = time.perf_counter()
+    for i in range(packets):
+        sends[i % sockets](payload)
+        if rate and i % 100 == 99:
+            # sleep off any time we're ahead of the requested rate
+            ahead = start + (i + 1) / rate - time.perf_counter()
+            if ahead > 0:
+                time.sleep(ahead)
+    elapsed = time.perf_counter() - start
+    for sock in socks:
+        sock.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    packets, size, port, sockets, rate = args + [
+        200000, 64, server_address[1], 1, 0][len(args):]
+    address = (server_address[0], port)
+
+    proc = None
+    before = server_stats(address, timeout=0.5)
+    if before is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        proc = subprocess.Popen([sys.executable,
+                                 os.path.join(here, 'udp_server.py'),
+                                 str(port)], stdout=subprocess.DEVNULL)
+        while before is None:
+            before = server_stats(address, timeout=0.2)
+
+    try:
+        elapsed = blast(address, packets, size, sockets, rate)
+        time.sleep(0.5)           # let the server catch up
+        after = server_stats(address)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+
+    # the server counts every packet it takes off the socket, including the
+    # ones it then drops and our STATS request
+    no_buffer = after['no_buffer'] - before['no_buffer']
+    queue_full = after['queue_full'] - before['queue_full']
+    received = (after['packets'] - before['packets'] - 1 - no_buffer -
+                queue_full)
+    print('sent     {:10,} packets of {} bytes in {:.2f}s: {:,.0f}/sec'.format(
+        packets, size, elapsed, packets / elapsed))
+    print('handled  {:10,} ({:.1%} lost)'.format(
+        received, 1 - received / packets))
+    print('dropped by the server: {:,} no free buffer, {:,} queue full'.format(
+        no_buffer, queue_full))
+    if after['kernel_drops'] is not None:
+        print('dropped by the kernel: {:,}'.format(
+            after['kernel_drops'] - before['kernel_drops']))
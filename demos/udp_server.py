@@ -1,26 +1,279 @@
+'''A UDP server for high packet rates'''
+
+
+# The first version of this server (see networks.md) received one datagram
+# with recvfrom(), replied and quit. Receiving lots of small packets quickly
+# runs into a few problems:
+
+# - recvfrom() allocates a new bytes object for every packet.
+#   recvfrom_into() writes the packet into a buffer we already have, so here
+#   a pool of fixed-size buffers is allocated once, up front, and reused.
+# - if handling a packet takes a while, packets pile up in the kernel's
+#   socket buffer, and when that's full the kernel silently drops them. So
+#   one thread does nothing but receive, and hands the buffers to a queue
+#   for worker threads to handle. SO_RCVBUF asks for a bigger kernel buffer
+#   to ride out bursts.
+# - a queue.put() and a get() for every packet cost more than receiving it.
+#   C programs use recvmmsg() to fetch many datagrams in one call, but the
+#   socket module doesn't have it. The nearest thing is to wait for one
+#   datagram, then keep reading without waiting (MSG_DONTWAIT) until the
+#   socket is empty or max_batch have been read, and queue the whole batch
+#   as one job. It's still one system call per packet, but one put() and
+#   one get() per batch. Where MSG_DONTWAIT doesn't exist (Windows), every
+#   batch is one packet.
+# - one process only gets one CPU (see concurrency.py). With SO_REUSEPORT
+#   (Linux, BSD, macOS) several processes can bind the same port and the
+#   kernel shares the packets out between them.
+
+# UDP doesn't tell anyone when packets are lost, so the server keeps count:
+# packets and bytes received, packets dropped because every buffer was busy
+# or the worker queue was full, and, on Linux, what the kernel dropped before
+# we ever saw it (from /proc/net/udp). Send it a datagram containing just
+# b'STATS' and it replies with the counts as JSON.
+
+# The handler gets a memoryview of the packet, which is only valid until the
+# handler returns, and the sender's address. Whatever it returns is sent back
+# (None for no reply). The default handler replies to anything like the
+# first version did, except packets starting with b'#', which are only
+# counted; demos/udp_blast.py sends those.
+
+# Run the server:        $ python3 demos/udp_server.py [port] [processes]
+# Blast it:              $ python3 demos/udp_blast.py [packets] [size]
+
+# see also: networks.md, demos/udp_client.py, demos/tcp_server.py
+
+import collections
 import datetime
+import json
+import multiprocessing
+import os
+import queue
+import signal
 import socket
-
+import threading
+import time
 
 server_address = ('localhost', 4544)
 max_size = 4096
-print('Starting the server at', datetime.datetime.now())
-print('waiting for client to call')
+FIELDS = ('packets', 'bytes', 'no_buffer', 'queue_full')
+PACKETS, BYTES, NO_BUFFER, QUEUE_FULL = range(len(FIELDS))
+
+
+def greet(data, client):
+    if data[:1] == b'#':
+        return None
+    return b'Are you talking to me?'
+
+
+def new_stats(processes=1):
+    '''Counters that can be shared with child processes.'''
+    return multiprocessing.RawArray('Q', processes * len(FIELDS))
+
+
+def totals(stats):
+    '''Add up the counters from every process.'''
+    counts = dict.fromkeys(FIELDS, 0)
+    for i, value in enumerate(stats):
+        counts[FIELDS[i % len(FIELDS)]] += value
+    return counts
+
+
+def kernel_drops(sock):
+    '''Packets the kernel dropped for this socket, or None if unknown.'''
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for table in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(table) as fob:
+                next(fob)
+                for line in fob:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+        except OSError:
+            pass
+    return None
+
+
+class Server():
+    '''Receive datagrams on one thread and handle them on others.'''
+
+    def __init__(self, address=server_address, handler=greet, workers=2,
+                 buffers=1024, buffer_size=max_size, reuse_port=False,
+                 rcvbuf=4 * 1024 * 1024, stats=None, slot=0, max_batch=64):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+
+        # One block of memory cut into buffer_size pieces. free holds the
+        # numbers of the pieces that aren't in use (deque append and pop
+        # are thread safe).
+        self.memory = bytearray(buffers * buffer_size)
+        whole = memoryview(self.memory)
+        self.views = [whole[i * buffer_size:(i + 1) * buffer_size]
+                      for i in range(buffers)]
+        self.free = collections.deque(range(buffers))
+        self.queue = queue.Queue(buffers)
+
+        self.shared_stats = stats if stats is not None else new_stats()
+        start = slot * len(FIELDS) * 8
+        self.stats = memoryview(self.shared_stats).cast('B')[
+            start:start + len(FIELDS) * 8].cast('Q')
+        self.stopping = False
+        self.workers = [threading.Thread(target=self._work, daemon=True)
+                        for i in range(workers)]
+
+    def _receive(self):
+        sock = self.sock
+        views = self.views
+        free = self.free
+        jobs = self.queue
+        stats = self.stats
+        max_batch = self.max_batch
+        dontwait = getattr(socket, 'MSG_DONTWAIT', None)
+        scratch = bytearray(len(views[0]))
+        while not self.stopping:
+            batch = []
+            flags = 0             # wait for the first packet of a batch
+            while len(batch) < max_batch:
+                try:
+                    index = free.pop()
+                    buf = views[index]
+                except IndexError:
+                    index = None
+                    buf = scratch     # still have to take it off the socket
+                try:
+                    size, client = sock.recvfrom_into(buf, 0, flags)
+                except BlockingIOError:   # nothing more waiting
+                    if index is not None:
+                        free.append(index)
+                    break
+                stats[PACKETS] += 1
+                stats[BYTES] += size
+                if index is None:
+                    stats[NO_BUFFER] += 1
+                elif size == 5 and buf[:5] == b'STATS':
+                    free.append(index)
+                    sock.sendto(self.report(), client)
+                else:
+                    batch.append((index, size, client))
+                if dontwait is None:
+                    break
+                flags = dontwait
+            if not batch:
+                continue
+            try:
+                jobs.put_nowait(batch)
+            except queue.Full:
+                free.extend(index for index, size, client in batch)
+                stats[QUEUE_FULL] += len(batch)
+
+    def _work(self):
+        sock = self.sock
+        views = self.views
+        free = self.free
+        handler = self.handler
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            for index, size, client in batch:
+                try:
+                    reply = handler(views[index][:size], client)
+                    if reply is not None:
+                        sock.sendto(reply, client)
+                except Exception as err:
+                    print('handler failed for {}: {!r}'.format(client, err))
+                finally:
+                    free.append(index)
+
+    def report(self):
+        counts = totals(self.shared_stats)
+        counts['kernel_drops'] = kernel_drops(self.sock)
+        return json.dumps(counts).encode()
+
+    def serve_forever(self):
+        for worker in self.workers:
+            worker.start()
+        try:
+            self._receive()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # let the workers finish what's queued, then stop them
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.sock.close()
+
+    def shutdown(self):
+        '''Stop serve_forever() from another thread.'''
+        self.stopping = True
+        # wake up the receiving thread, which is waiting for a packet
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as waker:
+            waker.sendto(b'#', self.address)
+
+
+# Several processes sharing a port
+# -----------------------------------------------------------------------------
+
+def _serve_process(address, stats, slot, workers):
+    server = Server(address, workers=workers, reuse_port=True, stats=stats,
+                    slot=slot)
+    server.serve_forever()
 
-# This line creates a socket (AF_INET means we'll create an IP socket,
-# SOCK_DGRAM means we'll send and receive datagrams - UDP):
-server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-# This listens for any data arriving at the IP, port. The programs sits and
-# waits here until there's some action:
-server.bind(server_address)
+def serve(address=server_address, processes=1, workers=2, interval=1.0):
+    '''Run the server in processes processes, printing the packet rate.'''
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    stats = new_stats(processes)
+    if processes == 1:
+        server = Server(address, workers=workers, stats=stats)
+        children = [threading.Thread(target=server.serve_forever,
+                                     daemon=True)]
+    else:
+        children = [multiprocessing.Process(target=_serve_process,
+                                            args=(address, stats, slot,
+                                                  workers))
+                    for slot in range(processes)]
+    for child in children:
+        child.start()
+    print('listening on {}:{} with {} process(es)'.format(
+        address[0], address[1], processes))
+    last = totals(stats)
+    try:
+        while True:
+            time.sleep(interval)
+            now = totals(stats)
+            if now['packets'] != last['packets']:
+                print('{:10,.0f} packets/sec {:8.1f} MB/sec  dropped: '
+                      '{:,} no buffer, {:,} queue full'.format(
+                          (now['packets'] - last['packets']) / interval,
+                          (now['bytes'] - last['bytes']) / interval / 1e6,
+                          now['no_buffer'], now['queue_full']))
+            last = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if processes == 1:
+            server.shutdown()
+        for child in children:
+            if processes > 1 and child.is_alive():
+                os.kill(child.pid, signal.SIGINT)
+            child.join()
+    return totals(stats)
 
-# Any data that comes in will be received here:
-data, client = server.recvfrom(max_size)
-print('Message:', datetime.datetime.now(), client, 'said', data)
 
-# The server sends a reply:
-server.sendto(b'Are you talking to me?', client)
+if __name__ == '__main__':
+    import sys
 
-# and closes the connection:
-server.close()
+    args = [int(arg) for arg in sys.argv[1:]]
+    port, processes = args + [server_address[1], 1][len(args):]
+    print('Starting the server at', datetime.datetime.now())
+    counts = serve((server_address[0], port), processes)
+    print('Stopped at', datetime.datetime.now(), counts)
@@ -0,0 +1,291 @@
+'''Web APIs: every page of a GitHub search, cached'''
+
+
+# pygal_github_api_example.py makes one search request and charts the 30
+# repositories on the first page. GitHub's search API hands out results a
+# page at a time (up to 100 per page, and the first 1000 results at most),
+# and limits how often we can ask: 10 searches a minute without a token, 30
+# with one.
+
+# RepoSearch.iter_repos() gets all the pages:
+
+# - page 1 says how many results there are, and so how many pages. The rest
+#   are fetched at the same time on a few threads, within the rate limit
+#   (api_fetch.py's TokenBucket). If GitHub says the limit has run out
+#   anyway, the request waits until X-RateLimit-Reset and tries again.
+# - every page is saved in a SQLite database (see sqlite3_example1.py),
+#   keyed by the query and page number, along with its ETag. For max_age
+#   seconds a saved page is used without asking GitHub at all, so running
+#   the report again soon after costs no requests. After that the ETag is
+#   sent back (If-None-Match) and an unchanged page comes back as a 304
+#   Not Modified with no body, which GitHub doesn't count against the rate
+#   limit.
+# - repositories are yielded one at a time, in order, as soon as their page
+#   is in, so the chart can be built while later pages are still coming.
+
+#   search = RepoSearch('github_search.db')
+#   for repo in search.iter_repos('language:python', sort='stars'):
+#       print(repo['name'], repo['stargazers_count'])
+#   print(search.stats)
+
+# see also: pygal_github_api_example.py, api_fetch.py, http_cache.py
+
+import concurrent.futures
+import json
+import sqlite3
+import time
+import urllib.parse
+
+from api_fetch import Session, TokenBucket, get_with_retries
+from http_cache import freshness
+
+GITHUB_API = 'https://api.github.com/'
+MAX_RESULTS = 1000       # GitHub search never returns more than this
+
+
+class SearchCache():
+    '''Search result pages in SQLite, by query and page number.'''
+
+    def __init__(self, filename=':memory:'):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (query TEXT, '
+                        'page INTEGER, etag TEXT, fetched REAL, max_age '
+                        'REAL, body TEXT, PRIMARY KEY (query, page))')
+
+    def get(self, query, page):
+        '''(etag, when fetched, GitHub's max-age, data) or None.'''
+        row = self.db.execute('SELECT etag, fetched, max_age, body FROM '
+                              'pages WHERE query = ? AND page = ?',
+                              (query, page)).fetchone()
+        if row is None:
+            return None
+        return row[:3] + (json.loads(row[3]),)
+
+    def put(self, query, page, etag, max_age, data):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES '
+                            '(?, ?, ?, ?, ?, ?)',
+                            (query, page, etag, time.time(), max_age,
+                             json.dumps(data)))
+
+    def touch(self, query, page, max_age):
+        '''Record that the page was found to be unchanged just now.'''
+        with self.db:
+            self.db.execute('UPDATE pages SET fetched = ?, max_age = ? '
+                            'WHERE query = ? AND page = ?',
+                            (time.time(), max_age, query, page))
+
+    def close(self):
+        self.db.close()
+
+
+class RepoSearch():
+
+    def __init__(self, cache=':memory:', api=GITHUB_API, token=None,
+                 per_page=100, workers=4, rate=10 / 60, burst=10,
+                 max_age=3600):
+        self.cache = (cache if isinstance(cache, SearchCache)
+                      else SearchCache(cache))
+        self.api = api
+        self.per_page = per_page
+        self.workers = workers
+        # the default rate is GitHub's limit without a token; burst lets a
+        # whole search's pages go at once when the limit hasn't been used
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        # None: only as long as GitHub's Cache-Control says (60 seconds)
+        self.max_age = max_age
+        headers = {'Accept': 'application/vnd.github+json',
+                   'User-Agent': 'python-notes'}
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        self.session = Session(headers)
+        self.stats = {'requests': 0, 'not_modified': 0, 'cached': 0,
+                      'downloaded': 0}
+
+    def _url(self, params, page):
+        return '{}search/repositories?{}'.format(
+            self.api, urllib.parse.urlencode(dict(params, page=page)))
+
+    def _fetch(self, url, etag):
+        # runs on a worker thread: network only, the database stays on
+        # the calling thread
+        headers = {'If-None-Match': etag} if etag else None
+        return get_with_retries(self.session, url, headers, self.limiter,
+                                ok=(200, 304))
+
+    def _store(self, key, page, cached, response):
+        # back on the calling thread: save the page and return its data
+        self.stats['requests'] += 1
+        max_age = freshness(response.headers)
+        if response.status == 304:
+            self.stats['not_modified'] += 1
+            self.cache.touch(key, page, max_age)
+            return cached[3]
+        self.stats['downloaded'] += 1
+        data = response.json()
+        self.cache.put(key, page, response.headers.get('ETag'), max_age,
+                       data)
+        return data
+
+    def _fresh(self, cached):
+        max_age = cached[2] if self.max_age is None else self.max_age
+        return time.time() - cached[1] < max_age
+
+    def iter_repos(self, query, sort=None, order='desc', limit=MAX_RESULTS):
+        '''Yield up to limit repository dicts for a search, in order.'''
+        params = {'q': query, 'per_page': self.per_page}
+        if sort:
+            params.update(sort=sort, order=order)
+        key = urllib.parse.urlencode(sorted(params.items()))
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            jobs = {}
+            pages = 1
+            page = 1
+            try:
+                while page <= pages:
+                    # Look each page up in the cache, and start fetching
+                    # the ones that need the network in the background, as
+                    # soon as the page count is known.
+                    for next_page in range(page, pages + 1):
+                        if next_page not in jobs:
+                            jobs[next_page] = self._start(pool, key, params,
+                                                          next_page)
+                    cached, future = jobs.pop(page)
+                    if future is None:
+                        self.stats['cached'] += 1
+                        data = cached[3]
+                    else:
+                        data = self._store(key, page, cached, future.result())
+                    if page == 1:
+                        total = min(data['total_count'], limit, MAX_RESULTS)
+                        pages = max(1, -(-total // self.per_page))
+                    for repo in data['items']:
+                        if limit <= 0:
+                            return
+                        limit -= 1
+                        yield repo
+                    page += 1
+            finally:
+                # on an error, or if the caller stops early, don't fetch
+                # pages nobody will read
+                for cached, future in jobs.values():
+                    if future is not None:
+                        future.cancel()
+
+    def _start(self, pool, key, params, page):
+        cached = self.cache.get(key, page)
+        if cached is not None and self._fresh(cached):
+            return cached, None
+        return cached, pool.submit(self._fetch, self._url(params, page),
+                                   cached and cached[0])
+
+
+# A stub GitHub
+# -----------------------------------------------------------------------------
+# Serves /search/repositories with made up repositories, ETags, 304s,
+# X-RateLimit headers and a delay on every response, and counts requests.
+
+def serve_stub_api(repos=2500, latency=0.1, port=0):
+    '''Start the stub API on a thread. Returns (base URL, server).'''
+    import hashlib
+    import http.server
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            with server.lock:
+                server.requests += 1
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/search/repositories':
+                return self._send(404, b'{}', {})
+            args = dict(urllib.parse.parse_qsl(url.query))
+            per_page = min(100, int(args.get('per_page', 30)))
+            page = int(args.get('page', 1))
+            start = (page - 1) * per_page
+            items = [{'name': 'repo{}'.format(i),
+                      'owner': {'login': 'user{}'.format(i % 97)},
+                      'stargazers_count': server.stars - i * 10,
+                      'html_url': 'https://github.com/user/repo{}'.format(i),
+                      'description': 'Repository number {}'.format(i)}
+                     for i in range(start, min(start + per_page, repos,
+                                               MAX_RESULTS))]
+            body = json.dumps({'total_count': repos,
+                               'incomplete_results': False,
+                               'items': items}).encode()
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            headers = {'ETag': etag, 'Cache-Control': 'max-age=60',
+                       'X-RateLimit-Limit': '30',
+                       'X-RateLimit-Remaining': '29',
+                       'X-RateLimit-Reset': str(int(time.time()) + 60)}
+            if self.headers.get('If-None-Match') == etag:
+                with server.lock:
+                    server.not_modified += 1
+                return self._send(304, b'', headers)
+            self._send(200, body, headers)
+
+        def _send(self, status, body, headers):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if status != 304:
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = server.not_modified = 0
+    server.stars = 50000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}/'.format(server.server_address[1]), server
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    from api_fetch import get_json
+
+    base, server = serve_stub_api()
+    filename = os.path.join(tempfile.mkdtemp(), 'search.db')
+
+    start = time.perf_counter()
+    first = get_json(Session(), base + 'search/repositories?q=language:python'
+                     '&sort=stars')
+    print('one request like the example: {} repos in {:.2f}s'.format(
+        len(first['items']), time.perf_counter() - start))
+
+    def run(label, **options):
+        server.requests = server.not_modified = 0
+        search = RepoSearch(filename, base, rate=50, **options)
+        start = time.perf_counter()
+        first_repo = None
+        count = 0
+        for repo in search.iter_repos('language:python', sort='stars'):
+            if first_repo is None:
+                first_repo = time.perf_counter() - start
+            count += 1
+        elapsed = time.perf_counter() - start
+        print('{:30} {} repos in {:.2f}s (first after {:.2f}s), {} requests'
+              ', {} not modified'.format(label, count, elapsed, first_repo,
+                                         server.requests,
+                                         server.not_modified))
+        search.cache.close()
+        return count
+
+    assert run('first run, 10 pages:') == MAX_RESULTS
+    run('again, nothing changed:')
+    run('after max_age:', max_age=0)
+    server.stars += 1
+    run('after the stars changed:', max_age=0)
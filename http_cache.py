@@ -0,0 +1,397 @@
+'''HTTP: a caching urlopen() with conditional requests'''
+
+
+# UpdatedURL in pickling.py downloads its whole page every hour, and the
+# request.urlopen() examples in web_servers_frameworks.py fetch every time
+# they run, whether the page has changed or not. HTTP has a way to avoid
+# that, and servers already support it:
+
+# - Cache-Control: max-age=60 in a response says "this is good for 60
+#   seconds". Until then, the copy we have can be used without asking the
+#   server at all.
+# - ETag: "abc123" is a version label for the page, and Last-Modified is the
+#   time it last changed. After max-age is up, we send them back in a
+#   conditional request (If-None-Match: "abc123", If-Modified-Since: ...).
+#   If the page hasn't changed, the server answers 304 Not Modified with no
+#   body, and our copy is good again. Otherwise it sends the new page with a
+#   normal 200.
+
+# HTTPCache keeps response bodies in files in a directory, with a small JSON
+# file of headers next to each, so the cache survives restarts and big pages
+# don't sit in memory. Its urlopen() returns something that reads like the
+# real response (read(), status, getheader(), with), wherever it came from.
+
+#   cache = HTTPCache('.http_cache')
+#   with cache.urlopen('https://news.ycombinator.com/') as response:
+#       data = response.read()
+#   print(cache.stats)
+
+# Responses marked Cache-Control: no-store aren't kept, and no-cache means
+# always check with the server first. Only plain GET requests are cached.
+
+# The cache is keyed by URL, but a response can depend on the request's
+# headers too. The server says which ones with Vary (Vary: Accept-Language
+# means a French and an English visitor get different pages). Those request
+# headers are saved along with the response, and a request that doesn't send
+# the same values is a miss, fetched again, and replaces the saved copy.
+# Vary: * means no two requests are alike, so that response isn't kept.
+# Requests with an Authorization header are never cached at all, so one
+# user's private pages can't be handed to another.
+
+# see also: pickling.py, web_servers_frameworks.py, config_cache.py
+
+import email.utils
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# the response headers worth keeping alongside the body
+KEEP_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Last-Modified',
+                'Cache-Control', 'Date', 'Expires', 'Vary')
+
+
+def parse_cache_control(value):
+    '''"max-age=60, no-cache" -> {'max-age': '60', 'no-cache': None}'''
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') or None
+    return directives
+
+
+def freshness(headers):
+    '''How many seconds a response with these headers may be used for.'''
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return max(0, int(directives['max-age']) - int(headers.get('Age', 0)))
+    except (KeyError, ValueError, TypeError):
+        return 0
+
+
+class CachedResponse():
+    '''The parts of http.client.HTTPResponse most code uses.'''
+
+    def __init__(self, url, status, headers, filename, source):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.source = source     # 'fresh', 'revalidated' or 'network'
+        self._file = open(filename, 'rb')
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def getheader(self, name, default=None):
+        for key, value in self.headers.items():
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _MemoryResponse(CachedResponse):
+    '''A response we weren't allowed to store.'''
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.source = 'network'
+        self._file = io.BytesIO(body)
+
+
+class HTTPCache():
+
+    def __init__(self, directory, timeout=30):
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.stats = {'fresh': 0, 'revalidated': 0, 'misses': 0,
+                      'bytes_downloaded': 0, 'bytes_saved': 0}
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + '.json', base + '.body'
+
+    def _load(self, url, request_headers):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as fob:
+                meta = json.load(fob)
+        except (OSError, ValueError):
+            return None
+        try:
+            # a body that doesn't match its headers (say the program died
+            # between writing the two) is treated as not cached at all
+            if meta['url'] != url or os.path.getsize(body_path) != \
+                    meta['size']:
+                return None
+        except (OSError, KeyError):
+            return None
+        # saved for a request with different Vary headers: not ours to use
+        for name, value in meta.get('vary', {}).items():
+            if request_headers.get(name) != value:
+                return None
+        return meta
+
+    def _save_meta(self, url, meta):
+        # write to a temporary name and rename it into place, so a crash
+        # never leaves half a file behind (see config_cache.py)
+        meta_path = self._paths(url)[0]
+        temp = '{}.{}.{}.tmp'.format(meta_path, os.getpid(),
+                                     threading.get_ident())
+        with open(temp, 'w') as fob:
+            json.dump(meta, fob)
+        os.replace(temp, meta_path)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def _uncached(self, url, headers):
+        # fetch without looking in or adding to the cache
+        request = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = response.read()
+            kept = {name: response.headers[name] for name in KEEP_HEADERS
+                    if response.headers.get(name) is not None}
+        self._count(misses=1, bytes_downloaded=len(body))
+        return _MemoryResponse(response.geturl(), response.status, kept, body)
+
+    def urlopen(self, url, headers=None):
+        headers = headers or {}
+        request_headers = {name.lower(): value
+                           for name, value in headers.items()}
+        if 'authorization' in request_headers:
+            return self._uncached(url, headers)
+        meta = self._load(url, request_headers)
+        body_path = self._paths(url)[1]
+        now = time.time()
+        if meta is not None and now < meta['fresh_until']:
+            self._count(fresh=1, bytes_saved=meta['size'])
+            return CachedResponse(url, meta['status'], meta['headers'],
+                                  body_path, 'fresh')
+
+        request = urllib.request.Request(url, headers=headers)
+        if meta is not None:
+            if meta['headers'].get('ETag'):
+                request.add_header('If-None-Match', meta['headers']['ETag'])
+            if meta['headers'].get('Last-Modified'):
+                request.add_header('If-Modified-Since',
+                                   meta['headers']['Last-Modified'])
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or meta is None:
+                raise
+            # Not Modified: our copy is current. The 304 can carry new
+            # caching headers, so keep those.
+            err.close()
+            for name in KEEP_HEADERS:
+                if err.headers.get(name) is not None:
+                    meta['headers'][name] = err.headers[name]
+            meta['fresh_until'] = now + freshness(meta['headers'])
+            self._save_meta(url, meta)
+            self._count(revalidated=1, bytes_saved=meta['size'])
+            return CachedResponse(url, meta['status'], meta['headers'],
+                                  body_path, 'revalidated')
+
+        with response:
+            kept = {name: response.headers[name] for name in KEEP_HEADERS
+                    if response.headers.get(name) is not None}
+            directives = parse_cache_control(kept.get('Cache-Control'))
+            vary = [name.strip().lower()
+                    for name in kept.get('Vary', '').split(',')
+                    if name.strip()]
+            if 'no-store' in directives or '*' in vary:
+                body = response.read()
+                self._count(misses=1, bytes_downloaded=len(body))
+                return _MemoryResponse(response.geturl(), response.status,
+                                       kept, body)
+            # stream the body to a file, then rename it into place
+            temp = '{}.{}.{}.tmp'.format(body_path, os.getpid(),
+                                         threading.get_ident())
+            with open(temp, 'wb') as fob:
+                shutil.copyfileobj(response, fob, 64 * 1024)
+            size = os.path.getsize(temp)
+            os.replace(temp, body_path)
+            meta = {'url': url, 'status': response.status, 'headers': kept,
+                    'size': size, 'fresh_until': now + freshness(kept),
+                    'vary': {name: request_headers.get(name)
+                             for name in vary}}
+            self._save_meta(url, meta)
+        self._count(misses=1, bytes_downloaded=size)
+        return CachedResponse(url, meta['status'], kept, body_path, 'network')
+
+    def get(self, url, headers=None):
+        '''The body of url, as bytes.'''
+        with self.urlopen(url, headers) as response:
+            return response.read()
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(('.json', '.body')):
+                os.remove(os.path.join(self.directory, name))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A local server with pages that use each kind of caching header, counting
+# what it actually sends. Then an UpdatedURL-style refresh loop over a 1 MB
+# page that only changes now and then.
+
+def serve_test_site(port=0):
+    '''Start the test server on a thread. Returns (base URL, server).'''
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            server = self.server
+            server.requests += 1
+            page = server.pages.get(self.path)
+            if page is None:
+                self.send_error(404)
+                return
+            body, cache_control = page
+            if self.path == '/vary':
+                language = self.headers.get('Accept-Language', 'en')
+                body = body.replace(b'x', language[:1].encode())
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            modified = email.utils.formatdate(server.modified, usegmt=True)
+            headers = {'Content-Type': 'text/html; charset=utf-8',
+                       'Last-Modified': modified}
+            if not self.path.startswith('/modified'):
+                headers['ETag'] = etag
+            if cache_control:
+                headers['Cache-Control'] = cache_control
+            if self.path == '/vary':
+                headers['Vary'] = 'Accept-Language'
+            if self._not_modified(etag, modified):
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            server.bytes_sent += len(body)
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _not_modified(self, etag, modified):
+            if self.headers.get('If-None-Match'):
+                return self.headers['If-None-Match'] == etag
+            since = self.headers.get('If-Modified-Since')
+            if since:
+                return (email.utils.parsedate_to_datetime(since) >=
+                        email.utils.parsedate_to_datetime(modified))
+            return False
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    server.requests = server.bytes_sent = 0
+    server.modified = time.time()
+    server.pages = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}'.format(server.server_address[1]), server
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    base, server = serve_test_site()
+    page = b'<html><body>' + b'x' * 1000000 + b'</body></html>'
+    server.pages = {'/etag': (page, 'max-age=0'),
+                    '/modified': (page, None),
+                    '/fresh': (page, 'max-age=2'),
+                    '/nostore': (page, 'no-store')}
+    cache = HTTPCache(tempfile.mkdtemp())
+
+    for path in ('/etag', '/modified', '/fresh', '/nostore'):
+        sources = []
+        for i in range(3):
+            with cache.urlopen(base + path) as response:
+                assert response.read() == page
+                sources.append(response.source)
+        print('{:10} {}'.format(path, ', '.join(sources)))
+    time.sleep(2.1)
+    with cache.urlopen(base + '/fresh') as response:
+        print('{:10} after max-age: {}'.format('/fresh', response.source))
+
+    # the page changes: the ETag no longer matches, so it's downloaded again
+    server.pages['/etag'] = (page.replace(b'x', b'y'), 'max-age=0')
+    assert cache.get(base + '/etag') == server.pages['/etag'][0]
+    print('{:10} changed: downloaded again'.format('/etag'))
+
+    # the same URL in two languages, and a logged in user
+    server.pages['/vary'] = (page, 'max-age=60')
+    sources = []
+    for language in ('en', 'fr', 'fr', 'en'):
+        with cache.urlopen(base + '/vary',
+                           {'Accept-Language': language}) as response:
+            assert response.read()[12:13] == language[:1].encode()
+            sources.append(response.source)
+    print('{:10} en, fr, fr, en: {}'.format('/vary', ', '.join(sources)))
+    for i in range(2):
+        with cache.urlopen(base + '/fresh',
+                           {'Authorization': 'Bearer abc'}) as response:
+            assert response.source == 'network'
+    print('{:10} with Authorization: network, network'.format('/fresh'))
+    print(cache.stats)
+
+    # 24 hourly updates of a page that changed 3 times
+    cache.clear()
+    for name in cache.stats:
+        cache.stats[name] = 0
+    server.requests = server.bytes_sent = 0
+    without = with_cache = 0
+    start = time.perf_counter()
+    for hour in range(24):
+        if hour % 8 == 0:
+            server.pages['/news'] = (page.replace(b'x', b'abc'[
+                hour // 8:hour // 8 + 1]), None)
+        without += len(urllib.request.urlopen(base + '/news').read())
+    plain = time.perf_counter() - start
+    start = time.perf_counter()
+    for hour in range(24):
+        if hour % 8 == 0:
+            server.pages['/news'] = (page.replace(b'x', b'abc'[
+                hour // 8:hour // 8 + 1]), None)
+        with_cache += len(cache.get(base + '/news'))
+    cached = time.perf_counter() - start
+    assert without == with_cache
+    print('24 updates: urlopen {:.3f}s, cache {:.3f}s; {:,} of {:,} bytes '
+          'downloaded ({revalidated} not modified, {misses} changed)'.format(
+              plain, cached, cache.stats['bytes_downloaded'], without,
+              **cache.stats))
+    server.shutdown()
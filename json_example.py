@@ -1,7 +1,7 @@
 '''JSON Example'''
 
 
-# see also structured_file_formats.py
+# see also structured_file_formats.py, json_streaming.py
 
 # The JSON (JavaScript Object Notation) module allows you to dump simple python
 # data structures into a file and load it back in next time the programs runs.
@@ -0,0 +1,220 @@
+'''Streaming JSON: reading one record at a time'''
+
+
+# json.load() reads the whole file into one string and then builds every
+# dict and list in it before handing anything back. For a file like
+# data/population_data.json (a top-level list of small dicts) that means the
+# peak memory is the raw text PLUS all of the Python objects, which is several
+# times the size of the file.
+
+# Most of the time we only want to loop over the records, like the 2010 loop
+# in pygal_json_example.py. The standard library doesn't have an incremental
+# JSON parser, but JSONDecoder.raw_decode() will decode ONE value from the
+# front of a string and tell us where it stopped. That's enough to walk a
+# top-level array element by element while only holding a small buffer of
+# text in memory:
+
+#   [ {...}, {...}, {...} ]
+#     ^----^ raw_decode() -> (record, end)  then skip the comma and repeat
+
+# see also: json_example.py, structured_file_formats.py
+
+import json
+import re
+
+
+CHUNK_SIZE = 64 * 1024  # characters read from the file at a time
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789+-.eE'
+
+# whitespace, then the comma or closing bracket after a record, then
+# whitespace again - matched in one go rather than a character at a time:
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+
+# Filters
+# -----------------------------------------------------------------------------
+# where= can be a function that takes a record and returns True/False, or a
+# dict of {path: value}. Paths use dots for nested keys, e.g. 'name.first'.
+
+def _lookup(record, path):
+    for key in path.split('.'):
+        record = record[key]
+    return record
+
+
+def make_filter(where):
+    if where is None or callable(where):
+        return where
+    conditions = list(where.items())
+
+    def matches(record):
+        try:
+            return all(_lookup(record, path) == value
+                       for path, value in conditions)
+        except (KeyError, IndexError, TypeError):
+            return False
+    return matches
+
+
+# The reader
+# -----------------------------------------------------------------------------
+
+class JSONArrayStream():
+    '''Iterate over the elements of a top-level JSON array in a file object.
+
+    Only the record being decoded (plus one chunk of text) is ever held in
+    memory, no matter how big the file is.
+    '''
+
+    def __init__(self, fob, where=None, chunk_size=CHUNK_SIZE):
+        self.fob = fob
+        self.matches = make_filter(where)
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        # Drop what's been consumed and read the next chunk on to the end.
+        chunk = self.fob.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while (self.pos < len(self.buffer)
+                   and self.buffer[self.pos] in _WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self._fill()
+
+    def _expect(self, chars):
+        self._skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError('unexpected end of JSON stream')
+        char = self.buffer[self.pos]
+        if char not in chars:
+            raise ValueError('expected one of {!r} at offset {}, got {!r}'
+                             .format(chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def _decode_one(self):
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A number that runs into the end of the buffer might be
+                # cut short ("12" of "123", "-4" of "-4.5"), so only trust
+                # it if something other than a digit follows it or there's
+                # nothing left to read.
+                if (self.eof or end < len(self.buffer)
+                        and self.buffer[end] not in _NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            # Record is bigger than what we have - read more. Doubling the
+            # read size keeps huge records from being re-parsed too often.
+            self._fill(size)
+            size *= 2
+
+    def _separator(self):
+        while True:
+            match = _SEPARATOR.match(self.buffer, self.pos)
+            # the trailing whitespace may continue into the next chunk:
+            if match and (match.end() < len(self.buffer) or self.eof):
+                self.pos = match.end()
+                return match.group(1)
+            if self.eof:
+                return self._expect(',]')
+            self._fill()
+
+    def __iter__(self):
+        self._expect('[')
+        self._skip_whitespace()
+        if self.buffer[self.pos:self.pos + 1] == ']':
+            self.pos += 1
+            return
+        matches = self.matches
+        while True:
+            self._skip_whitespace()
+            record = self._decode_one()
+            if matches is None or matches(record):
+                yield record
+            if self._separator() == ']':
+                return
+
+
+def iter_json_array(filename, where=None, chunk_size=CHUNK_SIZE):
+    '''Yield the records of a JSON file whose top level is a list.
+
+    for pop_dict in iter_json_array('data/population_data.json',
+                                    where={'Year': '2010'}):
+        ...
+    '''
+    with open(filename) as fob:
+        yield from JSONArrayStream(fob, where, chunk_size)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Compare time and peak memory (tracemalloc) against json.load() on the
+# population data scaled up by repeating its records.
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with open('data/population_data.json') as fob:
+        records = json.load(fob)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as tmp:
+        tmp.write('[\n')
+        for i in range(copies):
+            for j, record in enumerate(records):
+                if i or j:
+                    tmp.write(',\n')
+                json.dump(record, tmp)
+        tmp.write('\n]\n')
+        big = tmp.name
+    del records
+
+    def with_json_load():
+        with open(big) as fob:
+            return [r for r in json.load(fob) if r['Year'] == '2010']
+
+    def with_stream():
+        return list(iter_json_array(big, where={'Year': '2010'}))
+
+    try:
+        print('file size: {:.1f} MB'.format(os.path.getsize(big) / 1e6))
+        results = []
+        for func in (with_json_load, with_stream):
+            # time first, then measure memory on a second run - tracemalloc
+            # slows down every allocation and would skew the timing:
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append(result)
+            print('{:16} {:6.2f}s  peak {:8.1f} MB  {} records'.format(
+                func.__name__, elapsed, peak / 1e6, len(result)))
+        assert results[0] == results[1]
+    finally:
+        os.remove(big)
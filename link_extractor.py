@@ -0,0 +1,198 @@
+'''Web Scraping: finding links without building a tree'''
+
+
+# get_links() in web_scraping.py hands the whole page to BeautifulSoup, which
+# builds a Python object for every tag and every piece of text on it, keeps
+# them all in memory, and only then lets us search for the <a> tags. For a
+# list of links that's a lot of work thrown away.
+
+# html.parser.HTMLParser is a streaming parser: it reads the HTML from left
+# to right and calls a method for each thing it finds (handle_starttag(),
+# handle_data(), ...), then forgets it. LinkParser only looks at <a> (and
+# <base>) tags and builds nothing, so nothing piles up in memory however big
+# the page. It isn't much faster than building a tree: the parser still
+# reads every tag, and that's most of the work. The saving is memory.
+
+# An href that can't be resolved (say http://[bad/) is skipped rather than
+# stopping the whole page.
+
+# Links are resolved against the page's URL with urllib.parse.urljoin(), so
+# href="../about" on http://example.com/docs/intro becomes
+# http://example.com/about. A <base href="..."> tag changes what relative
+# links are resolved against, as it does in a browser.
+
+# The page can be fed in pieces as it arrives, so there's no need to wait
+# for the whole thing (or hold it all in memory) before links come out:
+
+#   with urllib.request.urlopen(url) as response:
+#       for link in iter_links(response, url):
+#           print(link)
+
+# see also: web_scraping.py, crawler.py
+
+import codecs
+import html.parser
+import urllib.parse
+
+class LinkParser(html.parser.HTMLParser):
+    '''Collects the resolved href of every <a> tag fed to it.'''
+
+    def __init__(self, base_url=''):
+        super().__init__()
+        self.base_url = base_url
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ('a', 'base'):
+            return
+        for name, value in attrs:
+            if name == 'href' and value:
+                try:
+                    url = urllib.parse.urljoin(self.base_url, value.strip())
+                except ValueError:
+                    # a malformed href, like http://[bad/ (urljoin reads
+                    # the [ as the start of an IPv6 address): skip it
+                    return
+                if tag == 'a':
+                    self.links.append(url)
+                else:
+                    self.base_url = url
+                return
+
+    def pop_links(self):
+        '''The links found since the last call.'''
+        links, self.links = self.links, []
+        return links
+
+
+def extract_links(page, base_url=''):
+    '''Every link on page (a str), resolved against base_url.'''
+    parser = LinkParser(base_url)
+    parser.feed(page)
+    parser.close()
+    return parser.links
+
+
+def iter_links(stream, base_url='', encoding='utf-8', chunk_size=64 * 1024):
+    '''Yield links from a binary file or response as it's read.'''
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    parser = LinkParser(base_url)
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        parser.feed(decoder.decode(data))
+        yield from parser.pop_links()
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    yield from parser.pop_links()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A few large generated pages through get_links()'s approach and through
+# LinkParser, for pages/sec and peak memory (tracemalloc). Without
+# BeautifulSoup installed, a small tree builder on the same html.parser stands
+# in for it, to show what building a tree costs on its own.
+
+if __name__ == '__main__':
+    import io
+    import time
+    import tracemalloc
+
+    try:
+        from bs4 import BeautifulSoup as soup
+    except ImportError:
+        soup = None
+
+    class Node():
+        __slots__ = ('tag', 'attrs', 'children')
+
+        def __init__(self, tag, attrs):
+            self.tag = tag
+            self.attrs = dict(attrs)
+            self.children = []
+
+    class TreeBuilder(html.parser.HTMLParser):
+        '''Every tag and piece of text, as a tree, like a soup.'''
+
+        def __init__(self):
+            super().__init__()
+            self.root = Node('[document]', [])
+            self.stack = [self.root]
+
+        def handle_starttag(self, tag, attrs):
+            node = Node(tag, attrs)
+            self.stack[-1].children.append(node)
+            self.stack.append(node)
+
+        def handle_endtag(self, tag):
+            for i in range(len(self.stack) - 1, 0, -1):
+                if self.stack[i].tag == tag:
+                    del self.stack[i:]
+                    break
+
+        def handle_data(self, data):
+            self.stack[-1].children.append(data)
+
+    def tree_links(page, base_url):
+        builder = TreeBuilder()
+        builder.feed(page)
+        builder.close()
+        links, todo = [], [builder.root]
+        while todo:
+            node = todo.pop()
+            if node.tag == 'a' and node.attrs.get('href'):
+                links.append(urllib.parse.urljoin(base_url,
+                                                  node.attrs['href']))
+            todo.extend(child for child in reversed(node.children)
+                        if isinstance(child, Node))
+        return links
+
+    def soup_links(page, base_url):
+        doc = soup(page, 'html.parser')
+        return [urllib.parse.urljoin(base_url, element.get('href'))
+                for element in doc.find_all('a') if element.get('href')]
+
+    def make_page(number, sections=400):
+        parts = ['<!DOCTYPE html><html><head><title>Page {}</title>'
+                 '</head><body>'.format(number)]
+        for i in range(sections):
+            parts.append(
+                '<div class="section" id="s{0}"><h2>Section {0}</h2>'
+                '<p>Some <b>bold</b> &amp; <i>italic</i> text about item {0}.'
+                ' {1}</p><ul><li><a href="/item/{0}">item</a></li>'
+                '<li><a href="../other/{0}?q=1#top">other</a></li>'
+                '<li><a href="https://example.org/{0}">away</a></li></ul>'
+                '<table><tr><td>{0}</td><td>{0}</td></tr></table></div>'
+                .format(i, 'Lorem ipsum dolor sit amet. ' * 5))
+        parts.append('</body></html>')
+        return ''.join(parts)
+
+    base_url = 'http://example.com/docs/page'
+    pages = [make_page(i) for i in range(10)]
+    print('{} pages of {:,} bytes'.format(len(pages), len(pages[0])))
+
+    ways = [('tree (stand-in for soup)', tree_links),
+            ('LinkParser', extract_links)]
+    if soup is not None:
+        ways.insert(0, ('BeautifulSoup', soup_links))
+    expected = extract_links(pages[0], base_url)
+    for label, func in ways:
+        assert func(pages[0], base_url) == expected, label
+        elapsed = float('inf')
+        for attempt in range(3):       # the best of 3, to smooth out noise
+            start = time.perf_counter()
+            for page in pages:
+                func(page, base_url)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        tracemalloc.start()
+        func(pages[0], base_url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:26}{:7.1f} pages/sec  peak memory {:6.1f} MB'.format(
+            label, len(pages) / elapsed, peak / 1e6))
+
+    stream = io.BytesIO(pages[0].encode())
+    assert list(iter_links(stream, base_url)) == expected
+    print('{:,} links per page, e.g. {}'.format(len(expected), expected[1]))
@@ -68,6 +68,8 @@ with open(filename) as fob:
             highs.append(high)
             lows.append(low)
 
+# For millions of rows, see csv_parallel.py to parse on every core.
+
 
 # Plotting the data:
 # -----------------------------------------------------------------------------
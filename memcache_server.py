@@ -0,0 +1,479 @@
+'''A small memcached-style cache server (asyncio)'''
+
+
+# noSQL_datastores.py describes memcached, but trying it needs a memcached
+# server installed and running. This is a small stand-in written with asyncio
+# that speaks enough of the memcached text protocol for the usual
+# "cache in front of a database" pattern:
+
+#   set <key> <flags> <exptime> <bytes> [noreply]\r\n<data>\r\n  -> STORED
+#   get <key> [<key> ...]\r\n      -> VALUE <key> <flags> <bytes>\r\n<data>\r\n
+#                                     ... END\r\n
+#   gets <key> [<key> ...]\r\n     -> same, plus a cas number per value
+#   delete <key> [noreply]\r\n     -> DELETED or NOT_FOUND
+#   incr <key> <amount>\r\n        -> the new value, or NOT_FOUND
+#   stats\r\n                      -> STAT <name> <value>\r\n ... END\r\n
+
+# (add, replace and decr work too.)
+
+# Memory is limited to a fixed number of bytes, managed the way memcached
+# does it with "slabs":
+
+# - items are sorted into size classes (64 byte chunks, 80 byte chunks, 100
+#   byte chunks ... each 1.25 times the last)
+# - memory is handed out to a class one 1 MB page at a time, and each page
+#   is cut into chunks of that class's size
+# - once every page has been handed out, storing a new item means evicting
+#   the least recently used item *of the same class*
+
+# This avoids fragmentation (every chunk in a class is the same size) at the
+# price of wasting the space between an item's size and its chunk's size.
+
+# Run the server:        $ python3 memcache_server.py serve [port]
+# Run the load test:     $ python3 memcache_server.py
+
+# see also: noSQL_datastores.py, concurrency.py, demos/tcp_server.py
+
+import asyncio
+import collections
+import queue
+import socket
+import time
+
+
+PAGE_SIZE = 1024 * 1024
+MIN_CHUNK = 64
+GROWTH_FACTOR = 1.25
+ITEM_OVERHEAD = 48     # roughly what memcached stores per item besides data
+MAX_KEY_LENGTH = 250
+RELATIVE_EXPIRY_LIMIT = 60 * 60 * 24 * 30  # like memcached: 30 days
+
+
+# Slab storage
+# -----------------------------------------------------------------------------
+
+class SlabClass():
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.per_page = PAGE_SIZE // chunk_size
+        self.pages = 0
+        self.lru = collections.OrderedDict()  # key -> item, oldest first
+
+    def full(self):
+        return len(self.lru) >= self.pages * self.per_page
+
+
+class Item():
+    __slots__ = ('key', 'flags', 'expires', 'cas', 'value', 'slab')
+
+    def __init__(self, key, flags, expires, cas, value, slab):
+        self.key = key
+        self.flags = flags
+        self.expires = expires
+        self.cas = cas
+        self.value = value
+        self.slab = slab
+
+
+class SlabCache():
+    '''A byte-budgeted LRU cache with memcached-style slab classes.'''
+
+    def __init__(self, memory_limit=64 * 1024 * 1024):
+        self.max_pages = max(1, memory_limit // PAGE_SIZE)
+        self.pages = 0
+        self.items = {}
+        self.classes = []
+        size = MIN_CHUNK
+        while size < PAGE_SIZE:
+            self.classes.append(SlabClass(size))
+            size = int(size * GROWTH_FACTOR + 7) // 8 * 8  # 8 byte aligned
+        self.classes.append(SlabClass(PAGE_SIZE))
+        self.cas_counter = 0
+        self.stats = collections.Counter()
+
+    def _slab_for(self, size):
+        for slab in self.classes:
+            if size <= slab.chunk_size:
+                return slab
+        return None
+
+    def _unlink(self, item):
+        del self.items[item.key]
+        del item.slab.lru[item.key]
+
+    def _expired(self, item, now):
+        return item.expires and item.expires <= now
+
+    def _live(self, key):
+        # expired items are removed lazily, when they're next looked up
+        item = self.items.get(key)
+        if item is not None and self._expired(item, time.time()):
+            self._unlink(item)
+            return None
+        return item
+
+    def get(self, key):
+        item = self._live(key)
+        if item is None:
+            self.stats['get_misses'] += 1
+            return None
+        item.slab.lru.move_to_end(key)
+        self.stats['get_hits'] += 1
+        return item
+
+    def set(self, key, flags, exptime, value):
+        size = len(key) + len(value) + ITEM_OVERHEAD
+        slab = self._slab_for(size)
+        if slab is None:
+            return False  # bigger than a page
+        old = self.items.get(key)
+        if old is not None:
+            self._unlink(old)
+        if slab.full():
+            if self.pages < self.max_pages:
+                slab.pages += 1
+                self.pages += 1
+            elif slab.lru:
+                oldest = next(iter(slab.lru.values()))
+                self._unlink(oldest)
+                self.stats['evictions'] += 1
+            else:
+                # every page belongs to other classes - nothing to evict
+                self.stats['outofmemory'] += 1
+                return False
+        if exptime and exptime <= RELATIVE_EXPIRY_LIMIT:
+            exptime += time.time()
+        self.cas_counter += 1
+        item = Item(key, flags, exptime, self.cas_counter, value, slab)
+        self.items[key] = item
+        slab.lru[key] = item
+        self.stats['total_items'] += 1
+        return True
+
+    def delete(self, key):
+        item = self._live(key)
+        if item is None:
+            return False
+        self._unlink(item)
+        return True
+
+    def incr(self, key, amount):
+        item = self._live(key)
+        if item is None:
+            return None
+        # like memcached: incr wraps around at 64 bits, decr stops at 0
+        number = max(0, int(item.value) + amount) % 2 ** 64
+        value = str(number).encode('ascii')
+        self.set(key, item.flags, item.expires, value)
+        return value
+
+    def stat_lines(self):
+        chunks = sum(len(slab.lru) * slab.chunk_size for slab in self.classes)
+        data = sum(len(item.key) + len(item.value)
+                   for item in self.items.values())
+        stats = dict(self.stats, curr_items=len(self.items),
+                     limit_maxbytes=self.max_pages * PAGE_SIZE,
+                     bytes=chunks, total_malloced=self.pages * PAGE_SIZE,
+                     data_bytes=data)
+        return ['STAT {} {}'.format(name, value)
+                for name, value in sorted(stats.items())]
+
+
+# The server
+# -----------------------------------------------------------------------------
+# One coroutine per connection. readline() gets the command line; for set,
+# readexactly() gets the data block. Replies for a connection are collected
+# and written together.
+
+class CacheServer():
+
+    def __init__(self, cache=None):
+        self.cache = cache or SlabCache()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.split()
+                if not parts:
+                    writer.write(b'ERROR\r\n')
+                    continue
+                command = parts[0]
+                if command == b'quit':
+                    break
+                if command in (b'set', b'add', b'replace'):
+                    await self._set(reader, writer, command, parts)
+                elif command in (b'get', b'gets'):
+                    self._get(writer, parts[1:], with_cas=command == b'gets')
+                elif command == b'delete' and len(parts) >= 2:
+                    found = self.cache.delete(parts[1])
+                    if parts[-1] != b'noreply':
+                        writer.write(b'DELETED\r\n' if found
+                                     else b'NOT_FOUND\r\n')
+                elif command in (b'incr', b'decr') and len(parts) >= 3:
+                    self._incr(writer, command, parts)
+                elif command == b'stats':
+                    for stat in self.cache.stat_lines():
+                        writer.write(stat.encode('ascii') + b'\r\n')
+                    writer.write(b'END\r\n')
+                else:
+                    writer.write(b'ERROR\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _set(self, reader, writer, command, parts):
+        try:
+            key, flags, exptime, size = (parts[1], int(parts[2]),
+                                         int(parts[3]), int(parts[4]))
+        except (IndexError, ValueError):
+            writer.write(b'CLIENT_ERROR bad command line format\r\n')
+            return
+        if size < 0:
+            writer.write(b'CLIENT_ERROR bad command line format\r\n')
+            return
+        noreply = parts[-1] == b'noreply'
+        if len(key) + size + ITEM_OVERHEAD > PAGE_SIZE:
+            # bigger than the largest slab: like memcached, read the data
+            # and throw it away a piece at a time instead of buffering it
+            remaining = size + 2
+            while remaining:
+                remaining -= len(await reader.readexactly(
+                    min(remaining, 64 * 1024)))
+            if not noreply:
+                writer.write(b'SERVER_ERROR object too large for cache\r\n')
+            return
+        data = await reader.readexactly(size + 2)
+        if len(key) > MAX_KEY_LENGTH or data[-2:] != b'\r\n':
+            writer.write(b'CLIENT_ERROR bad data chunk\r\n')
+            return
+        if command != b'set':
+            exists = self.cache._live(key) is not None
+        if ((command == b'add' and exists)
+                or (command == b'replace' and not exists)):
+            reply = b'NOT_STORED\r\n'
+        elif self.cache.set(key, flags, exptime, data[:-2]):
+            reply = b'STORED\r\n'
+        else:
+            reply = b'SERVER_ERROR out of memory storing object\r\n'
+        if not noreply:
+            writer.write(reply)
+
+    def _get(self, writer, keys, with_cas):
+        out = []
+        for key in keys:
+            item = self.cache.get(key)
+            if item is None:
+                continue
+            if with_cas:
+                out.append(b'VALUE %s %d %d %d\r\n' % (
+                    key, item.flags, len(item.value), item.cas))
+            else:
+                out.append(b'VALUE %s %d %d\r\n' % (
+                    key, item.flags, len(item.value)))
+            out.append(item.value)
+            out.append(b'\r\n')
+        out.append(b'END\r\n')
+        writer.write(b''.join(out))
+
+    def _incr(self, writer, command, parts):
+        try:
+            amount = int(parts[2])
+        except ValueError:
+            writer.write(b'CLIENT_ERROR invalid numeric delta argument\r\n')
+            return
+        if command == b'decr':
+            amount = -amount
+        try:
+            value = self.cache.incr(parts[1], amount)
+        except ValueError:
+            writer.write(b'CLIENT_ERROR cannot increment or decrement '
+                         b'non-numeric value\r\n')
+            return
+        if parts[-1] != b'noreply':
+            writer.write(b'NOT_FOUND\r\n' if value is None
+                         else value + b'\r\n')
+
+    async def serve(self, host='localhost', port=11311):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+# The client
+# -----------------------------------------------------------------------------
+# A blocking client that keeps a pool of open connections, so each request
+# doesn't pay for a new TCP handshake. Threads borrow a connection for one
+# command and put it back.
+
+class CacheClient():
+
+    def __init__(self, host='localhost', port=11311, pool_size=8,
+                 timeout=5.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(pool_size)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _call(self, request, read_reply):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        sock, rfile = conn
+        try:
+            sock.sendall(request)
+            reply = read_reply(rfile)
+        except Exception:
+            sock.close()  # don't put a broken connection back in the pool
+            raise
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            sock.close()
+        return reply
+
+    @staticmethod
+    def _read_values(rfile):
+        values = {}
+        while True:
+            line = rfile.readline()
+            if line == b'END\r\n':
+                return values
+            if not line.startswith(b'VALUE '):
+                raise ConnectionError('unexpected reply {!r}'.format(line))
+            parts = line.split()
+            data = rfile.read(int(parts[3]) + 2)[:-2]
+            cas = int(parts[4]) if len(parts) > 4 else None
+            values[parts[1].decode('utf-8')] = (data, int(parts[2]), cas)
+
+    def get_many(self, keys):
+        '''Return {key: value} for the keys that were found (bytes values).'''
+        if not keys:
+            return {}
+        request = b'get ' + ' '.join(keys).encode('utf-8') + b'\r\n'
+        found = self._call(request, self._read_values)
+        return {key: data for key, (data, flags, cas) in found.items()}
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def gets(self, key):
+        '''Return (value, cas) or None.'''
+        request = b'gets ' + key.encode('utf-8') + b'\r\n'
+        found = self._call(request, self._read_values).get(key)
+        return None if found is None else (found[0], found[2])
+
+    def set(self, key, value, exptime=0, flags=0):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        request = b'set %s %d %d %d\r\n%s\r\n' % (
+            key.encode('utf-8'), flags, exptime, len(value), value)
+        return self._call(request, lambda r: r.readline()) == b'STORED\r\n'
+
+    def delete(self, key):
+        request = b'delete ' + key.encode('utf-8') + b'\r\n'
+        return self._call(request, lambda r: r.readline()) == b'DELETED\r\n'
+
+    def incr(self, key, amount=1):
+        request = b'incr %s %d\r\n' % (key.encode('utf-8'), amount)
+        reply = self._call(request, lambda r: r.readline()).strip()
+        return None if reply == b'NOT_FOUND' else int(reply)
+
+    def stats(self):
+        def read_stats(rfile):
+            stats = {}
+            for line in iter(rfile.readline, b'END\r\n'):
+                name, value = line.decode('ascii').split()[1:3]
+                stats[name] = int(float(value))
+            return stats
+        return self._call(b'stats\r\n', read_stats)
+
+    def close(self):
+        while True:
+            try:
+                sock, rfile = self.pool.get_nowait()
+            except queue.Empty:
+                return
+            sock.close()
+
+
+def start_in_thread(port=0, memory_limit=64 * 1024 * 1024):
+    '''Run a CacheServer on its own thread. Returns the port it's using.'''
+    import threading
+    ready = queue.Queue()
+
+    async def main():
+        server = CacheServer(SlabCache(memory_limit))
+        srv = await asyncio.start_server(server.handle, 'localhost', port)
+        ready.put(srv.sockets[0].getsockname()[1])
+        async with srv:
+            await srv.serve_forever()
+
+    thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+    thread.start()
+    return ready.get()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The cache-aside pattern: look in the cache first, and on a miss read the
+# (slow) database and store the result. Keys are chosen with a skewed
+# distribution - a few are popular, most are rare - like real traffic.
+
+if __name__ == '__main__':
+    import random
+    import statistics
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    if sys.argv[1:2] == ['serve']:
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 11311
+        print('cache server on port', port)
+        asyncio.run(CacheServer().serve(port=port))
+
+    port = start_in_thread(memory_limit=4 * 1024 * 1024)
+    client = CacheClient(port=port, pool_size=16)
+
+    client.set('quantity', '2')
+    print(client.incr('quantity', 12))            # 14
+    print(client.get_many(['quantity', 'nope']))  # {'quantity': b'14'}
+
+    def slow_database(key):
+        time.sleep(0.002)
+        return ('row for ' + key).encode('utf-8') * 20
+
+    def lookup(key):
+        start = time.perf_counter()
+        value = client.get(key)
+        if value is None:
+            value = slow_database(key)
+            client.set(key, value, exptime=300)
+        return time.perf_counter() - start
+
+    keys = ['user:{}'.format(int(random.paretovariate(1.2) * 10))
+            for _ in range(20000)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(16) as pool:
+        latencies = sorted(pool.map(lookup, keys))
+    elapsed = time.perf_counter() - start
+
+    stats = client.stats()
+    hits, misses = stats['get_hits'], stats['get_misses']
+    print('requests/sec: {:.0f}'.format(len(keys) / elapsed))
+    print('hit ratio: {:.1%}'.format(hits / (hits + misses)))
+    print('latency p50 {:.2f} ms  p99 {:.2f} ms'.format(
+        statistics.median(latencies) * 1e3,
+        latencies[int(len(latencies) * 0.99)] * 1e3))
+    print('items {curr_items}, chunk bytes {bytes}, data bytes {data_bytes}, '
+          'evictions {evictions}'.format(**dict({'evictions': 0}, **stats)))
+    client.close()
@@ -70,6 +70,9 @@ for k, v in test_dict.items():
 print(test_dict_decoded)
 # {'rouge': 'red', 'jaune': 'yellow', 'vert': 'green'}
 
+# To skip the two copies and decode as you go (with a cache of decoded
+# values), see typed_dbm.py
+
 # the whichdb() method reports the type of database that was created. This will
 # vary depending on which modules are intalled on your system... one of either
 # dbm.gnu, dbm.ndbm or dbm.dumb.
@@ -96,6 +99,9 @@ print(dbm.whichdb('data/definitions'))
 # is inherent in memcached, being that it's a cache server. It avoids running
 # out of memory by discarding old data.
 
+# To try this out without installing memcached, memcache_server.py has a
+# small server (and client) that speaks the same text protocol.
+
 
 # Redis
 # -----------------------------------------------------------------------------
@@ -123,6 +129,9 @@ import redis
 
 conn = redis.Redis('localhost', 6379)
 
+# Each command below is a separate round trip to the server. To batch them
+# into pipelines automatically see redis_batching.py.
+
 
 # Redis Strings
 # -----------------------------------------------------------------------------
@@ -363,6 +372,9 @@ conn.getbit('everyday', jon)
 conn.bitop('or', 'alldays', *days)
 conn.bitcount('alldays')
 
+# To do the same in-process, with compressed bitmaps that stay small even
+# for sparse IDs like jon's, see roaring_bitmap.py.
+
 
 # Redis Caches and Expiration:
 # -----------------------------------------------------------------------------
@@ -383,6 +395,9 @@ conn.get(key)   # returns None
 # The expireat() command expires a key at a given epoch time. Key expiration
 # is useful to keep caches fresh and to limit login sessions.
 
+# For the same expire/ttl behaviour in a plain Python dictionary, without a
+# server, see ttl_dict.py.
+
 
 # Redis in use:
 # -----------------------------------------------------------------------------
@@ -0,0 +1,316 @@
+'''Pickle Archive: many records with random access'''
+
+
+# pickling.py shows that several objects can be pickled one after another into
+# the same file, as long as they're loaded back in the same order. The
+# downside is that there's no way to jump to the 100th album: pickle.load()
+# has to unpickle the 99 before it.
+
+# The fix is an index. Each record is written to the end of the file and we
+# remember where it starts and how long it is. When the archive is closed,
+# the list of offsets is pickled after the last record, followed by a small
+# fixed size footer that says where the index starts:
+
+#   [record 0][record 1]...[record n][index][footer]
+
+# Opening the archive reads the footer (normally the last 24 bytes) and then
+# the index. After that, archive[i] is one seek() and one read(), no matter
+# how many records there are.
+
+# Adding more records later writes them after the old footer and then a
+# fresh index and footer at the very end. The old index is left behind as
+# garbage, as are records that get replaced or deleted. compact() rewrites
+# the file with only the live records.
+
+# Leaving the old index in place means a crash part way through never
+# destroys the last good one. If the program dies before close() (or
+# flush()), the file ends in records or half an index rather than a footer,
+# so opening it scans back for the last footer that points at an index that
+# loads, and the archive is as it was at the last flush(). The records after
+# it are lost, and count as garbage until the next compact().
+
+# Records are pickled with protocol 5. Objects that support it (numpy arrays,
+# or any bytes-like data wrapped in pickle.PickleBuffer) hand their data over
+# as "out-of-band" buffers instead of copying it into the pickle stream.
+# Those buffers are written straight after the record's pickle, and on load
+# pickle gets views into the bytes read from disk rather than another copy.
+
+# see also: pickling.py, pickle_buffers.py
+
+import os
+import pickle
+import struct
+
+
+MAGIC = b'PKLARC01'
+FOOTER = struct.Struct('<QQ8s')  # index offset, index length, MAGIC
+PROTOCOL = 5
+
+
+class PickleArchive():
+    '''An append-only file of pickled records with an offset index.
+
+    mode is 'r' (read only), 'a' (read/append, created if missing) or
+    'n' (always start a new, empty archive).
+    '''
+
+    def __init__(self, filename, mode='r'):
+        if mode not in ('r', 'a', 'n'):
+            raise ValueError("mode must be 'r', 'a' or 'n'")
+        self.filename = filename
+        self.writable = mode != 'r'
+        if mode == 'n' or (mode == 'a' and not os.path.exists(filename)):
+            self.fob = open(filename, 'w+b')
+            self.index = []
+            self._dirty = True
+            self._tail = 0
+        else:
+            self.fob = open(filename, 'r+b' if self.writable else 'rb')
+            self._dirty = False
+            self.index = self._read_index()
+
+    # The index is a list with one entry per record:
+    #   (offset, (pickle length, buffer 1 length, buffer 2 length, ...))
+
+    def _index_at(self, end):
+        # the index whose footer ends at end, or None if there isn't one
+        if end < FOOTER.size:
+            return None
+        fob = self.fob
+        fob.seek(end - FOOTER.size)
+        offset, length, magic = FOOTER.unpack(fob.read(FOOTER.size))
+        if magic != MAGIC or offset + length + FOOTER.size != end:
+            return None
+        fob.seek(offset)
+        try:
+            index = pickle.loads(fob.read(length))
+        except Exception:
+            return None  # MAGIC turned up inside a record, not a footer
+        if not isinstance(index, list):
+            return None
+        self._tail = length + FOOTER.size
+        return index
+
+    def _find_index(self, end, chunk_size=1 << 20):
+        # Read backwards a chunk at a time, trying every MAGIC from the
+        # end. Each read overlaps the previous one by len(MAGIC) - 1
+        # bytes, so one that straddles two chunks isn't missed.
+        fob = self.fob
+        stop = end
+        while stop > 0:
+            start = max(0, stop - chunk_size)
+            fob.seek(start)
+            data = fob.read(stop - start + len(MAGIC) - 1)
+            found = data.rfind(MAGIC)
+            while found >= 0:
+                index = self._index_at(start + found + len(MAGIC))
+                if index is not None:
+                    return index
+                found = data.rfind(MAGIC, 0, found + len(MAGIC) - 1)
+            stop = start
+        return None
+
+    def _read_index(self):
+        end = self.fob.seek(0, os.SEEK_END)
+        if end < FOOTER.size:
+            raise ValueError('{} is not a pickle archive'.format(self.filename))
+        index = self._index_at(end)
+        if index is None:
+            # not closed properly: fall back to the last good index
+            index = self._find_index(end)
+            if index is None:
+                raise ValueError('{} has no valid index'.format(
+                    self.filename))
+            # write a footer at the end again on close()
+            self._dirty = self.writable
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    # Reading
+    # -------------------------------------------------------------------------
+
+    def _load(self, entry):
+        offset, sizes = entry
+        data = bytearray(sum(sizes))
+        self.fob.seek(offset)
+        self.fob.readinto(data)
+        view = memoryview(data)
+        buffers = []
+        start = sizes[0]
+        for size in sizes[1:]:
+            buffers.append(view[start:start + size])
+            start += size
+        return pickle.loads(view[:sizes[0]], buffers=buffers)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._load(entry) for entry in self.index[i]]
+        return self._load(self.index[i])
+
+    def __iter__(self):
+        for entry in list(self.index):
+            yield self._load(entry)
+
+    # Writing
+    # -------------------------------------------------------------------------
+
+    def _write(self, obj):
+        if not self.writable:
+            raise PermissionError('archive was opened read only')
+        buffers = []
+        payload = pickle.dumps(obj, protocol=PROTOCOL,
+                               buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+        fob = self.fob
+        offset = fob.seek(0, os.SEEK_END)
+        fob.write(payload)
+        for raw in raws:
+            fob.write(raw)
+        self._dirty = True
+        return offset, (len(payload),) + tuple(raw.nbytes for raw in raws)
+
+    def append(self, obj):
+        self.index.append(self._write(obj))
+        return len(self.index) - 1
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+
+    def __setitem__(self, i, obj):
+        self.index[i] = self._write(obj)
+
+    def __delitem__(self, i):
+        if not self.writable:
+            raise PermissionError('archive was opened read only')
+        del self.index[i]
+        self._dirty = True
+
+    def flush(self):
+        '''Write the index and footer so everything so far is readable.'''
+        if not self._dirty:
+            return
+        fob = self.fob
+        offset = fob.seek(0, os.SEEK_END)
+        data = pickle.dumps(self.index, protocol=PROTOCOL)
+        fob.write(data)
+        fob.write(FOOTER.pack(offset, len(data), MAGIC))
+        fob.flush()
+        self._dirty = False
+        self._tail = len(data) + FOOTER.size
+
+    def garbage(self):
+        '''Bytes of old records and indexes that compact() would free.'''
+        used = sum(sum(sizes) for offset, sizes in self.index)
+        if not self._dirty:
+            used += self._tail  # the current index and footer
+        return self.fob.seek(0, os.SEEK_END) - used
+
+    def close(self):
+        if self.fob.closed:
+            return
+        if self.writable:
+            self.flush()
+        self.fob.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compact(filename):
+    '''Rewrite an archive with only its live records, in index order.'''
+    temp = filename + '.compact'
+    with PickleArchive(filename) as old, PickleArchive(temp, 'n') as new:
+        for offset, sizes in old.index:
+            old.fob.seek(offset)
+            data = old.fob.read(sum(sizes))
+            new.index.append((new.fob.seek(0, os.SEEK_END), sizes))
+            new.fob.write(data)
+    os.replace(temp, filename)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# $ python3 pickle_archive.py                 - demo and timing
+# $ python3 pickle_archive.py compact FILE    - compact an existing archive
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    import time
+
+    if sys.argv[1:2] == ['compact']:
+        for filename in sys.argv[2:]:
+            before = os.path.getsize(filename)
+            compact(filename)
+            print('{}: {} -> {} bytes'.format(
+                filename, before, os.path.getsize(filename)))
+        sys.exit()
+
+    unkle = ('The Road, Pt. 1', 'UNKLE', '2017', (
+              (1, 'Inter 1'),
+              (2, 'Farewell'),
+              (3, 'Looking for the Rain'),
+              (4, 'Cowboys or Indians')))
+
+    filename = os.path.join(tempfile.mkdtemp(), 'music.pkar')
+    count = 100000
+
+    with PickleArchive(filename, 'n') as archive:
+        for i in range(count):
+            archive.append(unkle + (i,))
+        # a large payload, written out-of-band:
+        archive.append(pickle.PickleBuffer(bytearray(10000000)))
+
+    with PickleArchive(filename, 'a') as archive:
+        archive[0] = ('replaced',)
+        del archive[1]
+        print('records:', len(archive), 'garbage bytes:', archive.garbage())
+
+    with PickleArchive(filename) as archive:
+        start = time.perf_counter()
+        for i in range(97, len(archive) - 1, 97):
+            assert archive[i][-1] == i + 1
+        per_lookup = (time.perf_counter() - start) / (count // 97)
+        print('archive[i]: {:.1f} us'.format(per_lookup * 1e6))
+
+    # versus loading everything in front of the record with pickle.load():
+    with open(filename + '.seq', 'wb') as fob:
+        for i in range(count):
+            pickle.dump(unkle + (i,), fob)
+    start = time.perf_counter()
+    with open(filename + '.seq', 'rb') as fob:
+        for i in range(count):
+            record = pickle.load(fob)
+    print('record {} with pickle.load(): {:.1f} ms'.format(
+        count - 1, (time.perf_counter() - start) * 1e3))
+
+    compact(filename)
+    with PickleArchive(filename) as archive:
+        print('after compact:', len(archive), 'records,',
+              archive.garbage(), 'garbage bytes')
+
+    # a crash part way through appending: the records are written but the
+    # new index is only half there and there's no footer
+    archive = PickleArchive(filename, 'a')
+    before = len(archive)
+    archive.extend(unkle + (i,) for i in range(1000))
+    archive.fob.write(pickle.dumps(archive.index)[:1000] + MAGIC)
+    archive.fob.close()
+    start = time.perf_counter()
+    with PickleArchive(filename, 'a') as archive:
+        assert len(archive) == before and archive[5][-1] == 6
+        archive.append(('after the crash',))
+        print('after an interrupted append: {} records, last good index '
+              'found in {:.1f} ms'.format(
+                  len(archive), (time.perf_counter() - start) * 1e3))
+    with PickleArchive(filename) as archive:
+        assert archive[-1] == ('after the crash',)
+
+    os.remove(filename)
+    os.remove(filename + '.seq')
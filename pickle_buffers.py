@@ -0,0 +1,212 @@
+'''Pickle Protocol 5: out-of-band buffers'''
+
+
+# The examples in pickling.py pickle everything "in-band": every byte of every
+# object is copied into the one pickle stream. For a large array or a big
+# bytearray that means the data is copied once into the pickle, written out,
+# read back into memory, and then copied AGAIN into the rebuilt object.
+
+# Protocol 5 (Python 3.8+, PEP 574) lets objects hand over their raw memory
+# separately as "out-of-band" buffers:
+
+#   buffers = []
+#   data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+#   ...
+#   obj = pickle.loads(data, buffers=buffers)
+
+# data then only holds the small bits (shapes, dtypes, structure) and each
+# large payload is a pickle.PickleBuffer we can put wherever we like. On load,
+# objects are rebuilt directly on top of whatever memory we pass in - if we
+# pass in a memoryview of a memory-mapped file, nothing is copied at all; the
+# operating system pages the data in as it's used.
+
+# numpy arrays support this out of the box. Plain bytes and bytearray do not
+# (they're always pickled in-band), so wrap them in pickle.PickleBuffer to
+# send them out-of-band. They'll come back as a memoryview.
+
+# see also: pickling.py, pickle_archive.py
+
+import mmap
+import os
+import pickle
+import struct
+from multiprocessing import shared_memory
+
+
+MAGIC = b'PKLOOB01'
+HEADER = struct.Struct('<8sQQ')  # MAGIC, pickle length, number of buffers
+ENTRY = struct.Struct('<QQ')     # buffer offset, buffer length
+ALIGN = 64                       # so numpy data starts on a cache line
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(data, raws):
+    # Works out where the pickle and each buffer will go in one block:
+    #   [header][buffer table][pickle][pad][buffer 0][pad][buffer 1]...
+    pos = HEADER.size + ENTRY.size * len(raws) + len(data)
+    table = []
+    for raw in raws:
+        pos = _aligned(pos)
+        table.append((pos, raw.nbytes))
+        pos += raw.nbytes
+    return table, pos
+
+
+def _split(obj):
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    return data, [buf.raw() for buf in buffers]
+
+
+def _join(view):
+    # Rebuild the object from a block laid out by _layout(). Every buffer is
+    # a slice of view - a memoryview slice never copies.
+    magic, length, count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError('not an out-of-band pickle')
+    start = HEADER.size + ENTRY.size * count
+    buffers = []
+    for i in range(count):
+        offset, size = ENTRY.unpack_from(view, HEADER.size + ENTRY.size * i)
+        buffers.append(view[offset:offset + size])
+    return pickle.loads(view[start:start + length], buffers=buffers)
+
+
+# Files and mmap
+# -----------------------------------------------------------------------------
+
+def dump(obj, filename):
+    '''Pickle obj to filename, writing large buffers straight from memory.'''
+    data, raws = _split(obj)
+    table, total = _layout(data, raws)
+    with open(filename, 'wb') as fob:
+        fob.write(HEADER.pack(MAGIC, len(data), len(raws)))
+        for entry in table:
+            fob.write(ENTRY.pack(*entry))
+        fob.write(data)
+        for (offset, size), raw in zip(table, raws):
+            fob.write(b'\0' * (offset - fob.tell()))
+            fob.write(raw)  # no copy: write() reads the buffer directly
+    return total
+
+
+def load(filename, writable=False):
+    '''Load an object written by dump(), backed by a memory map of the file.
+
+    Buffers are not copied: a numpy array comes back as a view of the file.
+    With writable=False the data is read only; writable=True gives a private
+    copy-on-write mapping (changes are never written back to the file).
+    '''
+    access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+    with open(filename, 'rb') as fob:
+        # the mapping stays open for as long as any view of it is alive
+        mm = mmap.mmap(fob.fileno(), 0, access=access)
+    return _join(memoryview(mm))
+
+
+# Shared memory
+# -----------------------------------------------------------------------------
+# The same layout works in a multiprocessing.shared_memory block, so another
+# process can attach to it by name and rebuild the object without copying
+# anything. Putting the data into shared memory is the one copy.
+
+def dump_shared(obj):
+    '''Copy obj into a new shared memory block. Returns the SharedMemory;
+    pass its .name to load_shared() in another process, and call
+    .close() and .unlink() when every process is done with it.'''
+    data, raws = _split(obj)
+    table, total = _layout(data, raws)
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    buf = shm.buf
+    HEADER.pack_into(buf, 0, MAGIC, len(data), len(raws))
+    pos = HEADER.size
+    for entry in table:
+        ENTRY.pack_into(buf, pos, *entry)
+        pos += ENTRY.size
+    buf[pos:pos + len(data)] = data
+    for (offset, size), raw in zip(table, raws):
+        buf[offset:offset + size] = raw.cast('B')
+    return shm
+
+
+def load_shared(name):
+    '''Attach to a block made by dump_shared(). Returns (obj, shm).
+
+    obj is built on top of the shared memory, so keep shm around while obj
+    is in use, and drop obj before calling shm.close().
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    return _join(shm.buf), shm
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# $ python3 pickle_buffers.py 1024     (size in MB, default 256)
+
+# Compares a plain in-band pickle.dump()/load() round trip with dump() and an
+# mmap backed load(). tracemalloc shows the extra copies: the in-band version
+# peaks at several times the payload, the out-of-band one at almost nothing.
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    nbytes = size_mb * 1024 * 1024
+    if np is not None:
+        payload = np.ones(nbytes // 8, dtype='float64')
+        in_band = {'name': 'ones', 'array': payload}
+        out_of_band = in_band
+    else:
+        payload = bytearray(nbytes)
+        in_band = {'name': 'zeros', 'array': payload}
+        out_of_band = {'name': 'zeros', 'array': pickle.PickleBuffer(payload)}
+
+    folder = tempfile.mkdtemp()
+    plain = os.path.join(folder, 'plain.pickle')
+    oob = os.path.join(folder, 'oob.pickle')
+
+    def plain_round_trip():
+        with open(plain, 'wb') as fob:
+            pickle.dump(in_band, fob, protocol=5)
+        with open(plain, 'rb') as fob:
+            return pickle.load(fob)
+
+    def oob_round_trip():
+        dump(out_of_band, oob)
+        return load(oob)
+
+    print('payload: {} MB, numpy: {}'.format(size_mb, np is not None))
+    for func in (plain_round_trip, oob_round_trip):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:17} {:6.2f}s  peak allocated {:8.1f} MB'.format(
+            func.__name__, elapsed, peak / 1e6))
+        assert len(result['array']) == len(payload)
+        del result
+
+    shm = dump_shared(out_of_band)
+    result, attached = load_shared(shm.name)
+    assert len(result['array']) == len(payload)
+    del result
+    attached.close()
+    shm.close()
+    shm.unlink()
+
+    os.remove(plain)
+    os.remove(oob)
+    os.rmdir(folder)
@@ -63,6 +63,9 @@ with open('data/music.pickle', 'rb') as unpickle_file:
     arcade2 = pickle.load(unpickle_file)
     x = pickle.load(unpickle_file)
 
+# To get at the 3rd album, the first two have to be unpickled first. For
+# random access to any record, see pickle_archive.py
+
 # pickle can use different protocols when serializing data. These protocols are
 # released with new versions of Python and will include better support for more
 # complex data objects. That being said, the protocols aren't backwards
@@ -76,6 +79,9 @@ with open('data/music.pickle', 'wb') as pickle_file:
     pickle.dump(unkle, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
     pickle.dump(unkle, pickle_file, protocol=pickle.DEFAULT_PROTOCOL)
 
+# Protocol 5 (Python 3.8+) can also pass large buffers such as numpy arrays
+# "out-of-band" so they aren't copied into the pickle. see: pickle_buffers.py
+
 # Final Note: as with PyYAML load(), pickle can create Python objects.
 # Don't unpickle something that you don't trust. Here's an example of code
 # that would delete a file called text.txt if run:
@@ -83,6 +89,9 @@ with open('data/music.pickle', 'wb') as pickle_file:
 pickle.loads(b"cos\nsystem\n(S'rm text.txt'\ntR.")      # mac/linux
 pickle.loads(b"cos\nsystem\n(S'del text.txt'\ntR.")     # windows
 
+# If you do need to load pickles from somewhere you don't fully control, an
+# Unpickler with an allow-list of classes blocks this. see: safe_unpickle.py
+
 
 
 # Customizing pickles
@@ -171,3 +180,16 @@ class UpdatedURL():
 u = UpdatedURL('https://news.ycombinator.com/')
 serialized = pickle.dumps(u)
 # Now it works!
+
+# update() downloads the whole page every hour even when it hasn't changed.
+# http_cache.py's HTTPCache keeps the last copy on disk and asks the server
+# whether it has changed (a conditional request), so an unchanged page costs
+# a tiny 304 Not Modified reply instead:
+
+#   cache = HTTPCache('.http_cache')
+#   ...
+#       def update(self):
+#           self.contents = cache.get(self.url)
+
+# Keep the cache at module level rather than as an attribute: like the
+# timer, it holds a lock, which can't be pickled.
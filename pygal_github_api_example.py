@@ -10,42 +10,53 @@
 # https://help.github.com/articles/understanding-the-search-syntax/
 # http://docs.python-requests.org
 
-import requests
 import pygal
 from pygal.style import LightColorizedStyle as LCS, LightenStyle as LS
 
+from github_search import RepoSearch
+
 
 # Processing an API response
 # -----------------------------------------------------------------------------
 
-# make an API call and store the requests:
-url = 'https://api.github.com/search/repositories?q=language:python&sort=stars'
-r = requests.get(url)
+# With requests, one API call for the first page looks like this:
+
+# url = ('https://api.github.com/search/repositories'
+#        '?q=language:python&sort=stars')
+# r = requests.get(url)
 
-# It's always go to check the status - use these to make some asserts.
-print('Status code:', r.status_code)
-print('Headers:', r.headers['content-type'])
-print('Encoding:', r.encoding)
+# It's always good to check the status - use these to make some asserts:
+# print('Status code:', r.status_code)
+# print('Headers:', r.headers['content-type'])
+# print('Encoding:', r.encoding)
 # Status code: 200  (a status code of 200 indicates a successful response)
 # Headers: application/json; charset=utf-8
 # Encoding: utf-8
 
-# Store API response in a variable. The API returns info in JSON format so we
-# use the json() method to convert to a python dict.
-response_dict = r.json()
-print(type(response_dict))  # -> <class 'dict'>
-
-# process results:
-print(response_dict.keys())
-print('Total repositories:', response_dict['total_count'])
-print('Incomplete results:', response_dict['incomplete_results'])
-print('Repositories returned:', len(response_dict['items']))
+# The API returns info in JSON format, so the json() method converts it to a
+# python dict:
+# response_dict = r.json()
+# print(response_dict.keys())
+# print('Total repositories:', response_dict['total_count'])
+# print('Incomplete results:', response_dict['incomplete_results'])
+# print('Repositories returned:', len(response_dict['items']))
 # dict_keys(['total_count', 'incomplete_results', 'items'])
 # Incomplete results: False
 # Total repositories: 2077471
 # Repositories returned: 30
+# repo_dicts = response_dict['items']
+
+# Every run of that downloads the page again. github_search.py makes the
+# same request but keeps the result in a SQLite database: running this again
+# within the hour makes no requests at all, and after that an unchanged page
+# costs a 304 Not Modified. It can also fetch every page GitHub allows (1000
+# results), several at once within the rate limit - leave out limit to get
+# them all. Here we only want the top 30, one page's worth.
 
-repo_dicts = response_dict['items']
+search = RepoSearch('github_search.db', per_page=30)
+repo_dicts = list(search.iter_repos('language:python', sort='stars',
+                                    limit=30))
+print('Repositories returned:', len(repo_dicts))
 
 # examine the first repo:
 # repo_dict1 = repo_dicts[0]
@@ -137,7 +148,10 @@ my_config.truncate_label = 15
 my_config.show_y_guides = True
 my_config.width = 1000
 
-my_config.y_labels = list(range(0, 42000, 2000))
+# about 20 y labels, from 0 up past the most-starred repo:
+top = max(plot_dict['value'] for plot_dict in plot_dicts)
+step = max(2000, int(round(top / 20, -3)))
+my_config.y_labels = list(range(0, top + step, step))
 my_config.y_labels_major_count = 3
 my_config.x_labels = names
 my_config.x_label_rotation = 45
@@ -148,3 +162,4 @@ chart.title = "Most-Starred Python Projects on GitHub"
 # chart.add('', stars)
 chart.add('', plot_dicts)
 chart.render_to_file('api_pygal_example.svg')
+print(search.stats)
@@ -14,6 +14,8 @@ import requests
 import pygal
 from pygal.style import DefaultStyle as DS, LightenStyle as LS
 
+from api_fetch import JSONCache, fetch_items
+
 
 # Make an API call and store the response:
 # -----------------------------------------------------------------------------
@@ -32,12 +34,17 @@ print('Encoding:', r.encoding)
 
 submission_ids = r.json()
 submission_dicts = []
-for submission_id in submission_ids[:100]:
-    # make a separate API call for each submission:
-    url = ('https://hacker-news.firebaseio.com/v0/item/'
-            + str(submission_id) + '.json')
-    submission_r = requests.get(url)
-    response_dict = submission_r.json()
+
+# Each submission needs a separate API call. Rather than making them one at a
+# time, fetch_items() makes them in parallel over kept-open connections,
+# within a rate limit, retrying failures, and keeps each item in a cache for
+# 10 minutes (see api_fetch.py):
+
+items = fetch_items(submission_ids[:100],
+                    cache=JSONCache('.hn_cache', max_age=600))
+for submission_id, response_dict in zip(submission_ids, items):
+    if response_dict is None or 'title' not in response_dict:
+        continue      # deleted since it was listed
 
     submission_dict = {
         'title' : response_dict['title'],
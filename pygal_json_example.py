@@ -31,6 +31,9 @@ for pop_dict in pop_data:
         population = int(float(pop_dict['Value']))
         print(country_name, '–', population)
 
+# json.load() holds the whole file in memory. For much bigger files the
+# records can be streamed one at a time instead. see also: json_streaming.py
+
 
 # Extract the data
 # -----------------------------------------------------------------------------
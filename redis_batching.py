@@ -0,0 +1,223 @@
+'''Redis: automatic pipelining'''
+
+
+# Every command in the Redis walk-through in noSQL_datastores.py is its own
+# round trip: send the command, wait for the server, read the reply. Redis
+# itself answers in microseconds, so most of that time is spent waiting on
+# the network.
+
+# redis-py has pipelines for this. Commands are queued on the client and sent
+# together with execute(), and the replies come back together:
+
+#   pipe = conn.pipeline(transaction=False)
+#   pipe.incr('quantity')
+#   pipe.hset('colours', 'red', 'rouge')
+#   pipe.execute()   # [3, 1]
+
+# The catch is that the code has to be written around the pipeline. An
+# AutoPipeline does the batching for us: call the same methods as on the
+# connection, but get back a Future (see concurrency.py) instead of waiting.
+# A background thread sends whatever has been queued as one pipeline once
+# max_batch commands are waiting or max_delay seconds have passed, whichever
+# comes first. Call .result() on a future when you need the reply. A future
+# cancelled before its batch goes out is left out of the batch.
+
+#   batch = AutoPipeline(conn)
+#   futures = [batch.incr('quantity') for _ in range(1000)]
+#   print(futures[-1].result())
+
+# Commands from any number of threads end up in the same batches, and a
+# single connection does all of the sending.
+
+# $ pip install redis    and a running redis-server (see noSQL_datastores.py)
+
+# see also: noSQL_datastores.py, concurrency.py
+
+import threading
+import time
+from concurrent.futures import Future, wait
+
+
+class AutoPipeline():
+    '''Queue Redis commands and send them in pipelines automatically.'''
+
+    def __init__(self, conn, max_batch=100, max_delay=0.002):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []  # (command name, args, kwargs, future)
+        self.batches = 0
+        self._ready = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, name, *args, **kwargs):
+        '''Queue conn.<name>(*args, **kwargs) and return a Future.'''
+        future = Future()
+        with self._ready:
+            # checked under the lock, so nothing is queued after close()
+            if self._closed:
+                raise RuntimeError('AutoPipeline is closed')
+            self.pending.append((name, args, kwargs, future))
+            if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+                self._ready.notify()
+        return future
+
+    def __getattr__(self, name):
+        # batch.hset('colours', 'red', 'rouge') -> submit('hset', ...)
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return self.submit(name, *args, **kwargs)
+        command.__name__ = name
+        return command
+
+    def _take_batch(self):
+        # Wait for the first command, then give the batch up to max_delay to
+        # fill up before sending it.
+        with self._ready:
+            while not self.pending and not self._closed:
+                self._ready.wait()
+            deadline = time.monotonic() + self.max_delay
+            while len(self.pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+        # skip commands whose futures were cancelled while they waited; the
+        # rest can't be cancelled any more
+        return [entry for entry in batch
+                if entry[-1].set_running_or_notify_cancel()]
+
+    def _send(self, batch):
+        try:
+            pipe = self.conn.pipeline(transaction=False)
+        except Exception as err:
+            for name, args, kwargs, future in batch:
+                future.set_exception(err)
+            return
+        queued = []
+        for name, args, kwargs, future in batch:
+            # a command the client rejects (a misspelled name, the wrong
+            # arguments) only fails its own future, not the whole batch
+            try:
+                getattr(pipe, name)(*args, **kwargs)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                queued.append(future)
+        if not queued:
+            return
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception as err:  # connection problems fail the whole batch
+            for future in queued:
+                future.set_exception(err)
+            return
+        self.batches += 1
+        for future, result in zip(queued, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._send(batch)
+            elif self._closed:
+                return
+
+    def flush(self):
+        '''Wait until everything queued so far has been sent.'''
+        with self._ready:
+            waiting = [entry[-1] for entry in self.pending]
+            self._ready.notify()
+        wait(waiting)  # cancelled ones count as done
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The string, hash, set and sorted set commands from noSQL_datastores.py, one
+# round trip at a time and then through an AutoPipeline. Every key starts
+# with PREFIX, and only those keys are deleted between runs, so it's safe to
+# point at a redis-server that holds other data.
+
+if __name__ == '__main__':
+    import sys
+
+    try:
+        import redis
+    except ImportError:
+        sys.exit('this benchmark needs redis-py: pip install redis')
+
+    conn = redis.Redis('localhost', 6379)
+    try:
+        conn.ping()
+    except redis.ConnectionError:
+        sys.exit('start a local redis-server first')
+
+    PREFIX = 'redis_batching:'
+
+    def clear():
+        keys = list(conn.scan_iter(PREFIX + '*'))
+        if keys:
+            conn.delete(*keys)
+
+    count = 10000
+    workloads = {
+        'strings': lambda run, i: (run('set', PREFIX + 'item:{}'.format(i),
+                                       'octopus'),
+                                   run('incr', PREFIX + 'quantity')),
+        'hashes': lambda run, i: (run('hset', PREFIX + 'colours',
+                                      'c{}'.format(i), 'rouge'),),
+        'sets': lambda run, i: (run('sadd', PREFIX + 'a',
+                                    'member{}'.format(i)),),
+        'sorted sets': lambda run, i: (run('zadd', PREFIX + 'logins',
+                                           {'user{}'.format(i): i}),),
+    }
+
+    for label, workload in workloads.items():
+        clear()
+
+        def direct(name, *args):
+            return getattr(conn, name)(*args)
+
+        start = time.perf_counter()
+        ops = 0
+        for i in range(count):
+            ops += len(workload(direct, i))
+        plain = ops / (time.perf_counter() - start)
+
+        clear()
+        with AutoPipeline(conn) as batch:
+            start = time.perf_counter()
+            futures = []
+            for i in range(count):
+                futures.extend(workload(batch.submit, i))
+            for future in futures:
+                future.result()
+            piped = len(futures) / (time.perf_counter() - start)
+            batches = batch.batches
+
+        print('{:12} {:9.0f} ops/sec  pipelined {:9.0f} ops/sec '
+              '({:.1f}x, {} batches)'.format(label, plain, piped,
+                                            piped / plain, batches))
+    clear()
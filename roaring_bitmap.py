@@ -0,0 +1,556 @@
+'''Compressed bitmaps: daily active users without Redis'''
+
+
+# The Redis Bits example in noSQL_datastores.py keeps one bitmap per day and
+# uses each user ID as a bit offset: setbit to record a login, bitcount for
+# the number of visitors, bitop and/or to combine days. A plain bitmap has to
+# be as long as the largest ID though. jon = 6603762 on his own costs 800 KB
+# a day, and a few hundred days of that is hundreds of MB of mostly zeros.
+
+# Roaring bitmaps (https://roaringbitmap.org) fix this by splitting the
+# 32 bit IDs into a high and a low half. IDs with the same high 16 bits share
+# a "container" that stores only their low 16 bits, and each container picks
+# whichever form is smaller:
+
+# - an array: a sorted array('H') of up to 4096 low halves, 2 bytes each
+# - a bitset: all 65536 possible low halves as bits, a fixed 8 KB. Here that's
+#   a plain Python int, so &, |, ^ and int.bit_count() run in C.
+
+# 4096 is the break even point: 4096 * 2 bytes = 8 KB. Containers with no IDs
+# at all don't exist, so empty ranges cost nothing.
+
+# Bitmap covers the Redis commands:
+#   conn.setbit(day, id, 1)        ->  bitmap.add(id)
+#   conn.getbit(day, id)           ->  id in bitmap
+#   conn.bitcount(day)             ->  len(bitmap)
+#   conn.bitop('and', dest, *days) ->  intersection(days)
+#   conn.bitop('or', dest, *days)  ->  union(days)
+#   conn.bitop('xor', dest, a, b)  ->  a ^ b
+
+# and can be saved to a file with save(). Bitmap.load() maps a saved file into
+# memory with mmap and only decodes the containers that are actually used.
+
+# How fast? The benchmark below is a year of logins, about 45,000 IDs a day
+# spread up to 50 million, so each day has about 760 containers. Anything
+# about one day takes well under a millisecond (DAU), and comparing a few
+# days takes tens of milliseconds. Whole-year queries miss the "milliseconds"
+# mark by a long way: every_day() or any_day() over 365 days has to visit
+# 365 * 760 = 280,000 containers, and even a few microseconds of Python per
+# container adds up to about a second (1.3s and 1.1s on the machine this was
+# written on). Building the year takes about 9s, most of it
+# sorting each day's IDs. Real roaring libraries do the same work in C with
+# SIMD; here the per-ID work is pushed into C where the standard library
+# allows (sorted(), set operations, array slicing), but the per-container
+# overhead is what's left.
+
+# see also: noSQL_datastores.py, sets.py
+
+import array
+import bisect
+import functools
+import mmap
+import operator
+import os
+import struct
+import sys
+
+ARRAY_MAX = 4096
+BITSET_BYTES = 1 << 13
+MAGIC = b'RBM1'
+HEADER = struct.Struct('<4sI')      # magic, number of containers
+ENTRY = struct.Struct('<IIQ')       # high 16 bits, cardinality, offset
+U32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# the low bits set in each possible byte, for turning a bitset into an array
+_BYTE_BITS = [tuple(i for i in range(8) if byte >> i & 1)
+              for byte in range(256)]
+
+
+# Containers
+# -----------------------------------------------------------------------------
+# A container is either an array('H') or an int. These functions take and
+# return either kind, converting the result to whichever is smaller.
+
+def _to_bits(container):
+    if isinstance(container, int):
+        return container
+    buf = bytearray(BITSET_BYTES)
+    for low in container:
+        buf[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(buf, 'little')
+
+
+def _to_array(bits):
+    result = array.array('H')
+    data = bits.to_bytes(BITSET_BYTES, 'little')
+    # skip over empty 64 bit words rather than looking at every byte
+    for word, value in enumerate(memoryview(data).cast('Q')):
+        if value:
+            for i in range(word * 8, word * 8 + 8):
+                base = i * 8
+                result.extend(base + bit for bit in _BYTE_BITS[data[i]])
+    return result
+
+
+def _cardinality(container):
+    if isinstance(container, int):
+        return container.bit_count()
+    return len(container)
+
+
+def _shrink(container):
+    '''The smaller form of a container, or None if it's empty.'''
+    if isinstance(container, int):
+        count = container.bit_count()
+        if not count:
+            return None
+        return _to_array(container) if count <= ARRAY_MAX else container
+    if not container:
+        return None
+    return _to_bits(container) if len(container) > ARRAY_MAX else container
+
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return _shrink(a & b)
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        data = b.to_bytes(BITSET_BYTES, 'little')
+        return _shrink(array.array(
+            'H', [low for low in a if data[low >> 3] >> (low & 7) & 1]))
+    return _shrink(array.array('H', sorted(set(a).intersection(b))))
+
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int) or len(a) + len(b) > ARRAY_MAX:
+        return _shrink(_to_bits(a) | _to_bits(b))
+    return array.array('H', sorted(set(a).union(b)))
+
+
+def _xor(a, b):
+    if isinstance(a, int) or isinstance(b, int) or len(a) + len(b) > ARRAY_MAX:
+        return _shrink(_to_bits(a) ^ _to_bits(b))
+    return _shrink(array.array('H', sorted(set(a).symmetric_difference(b))))
+
+
+# Bitmap
+# -----------------------------------------------------------------------------
+
+class Bitmap():
+    '''A set of unsigned 32 bit integers stored as a roaring bitmap.'''
+
+    def __init__(self, ids=()):
+        # high 16 bits -> container, or (cardinality, offset) for a container
+        # that hasn't been read from a loaded file yet
+        self.containers = {}
+        self._buffer = None
+        self._file = None
+        if ids:
+            self.update(ids)
+
+    def _get(self, key):
+        container = self.containers.get(key)
+        if isinstance(container, tuple):
+            container = self._decode(*container)
+            self.containers[key] = container
+        return container
+
+    def _items(self):
+        for key in sorted(self.containers):
+            yield key, self._get(key)
+
+    def _raw(self, key):
+        # Like _get(), except that an array container not read from a loaded
+        # file yet comes back as the file's bytes, without building (and
+        # keeping) an array. intersection() and union() only read it once.
+        container = self.containers.get(key)
+        if (isinstance(container, tuple) and container[0] <= ARRAY_MAX
+                and sys.byteorder == 'little'):
+            cardinality, offset = container
+            return self._buffer[offset:offset + cardinality * 2]
+        return self._get(key)
+
+    def add(self, id):
+        key, low = id >> 16, id & 0xFFFF
+        container = self._get(key)
+        if container is None:
+            self.containers[key] = array.array('H', [low])
+        elif isinstance(container, int):
+            self.containers[key] = container | 1 << low
+        else:
+            i = bisect.bisect_left(container, low)
+            if i == len(container) or container[i] != low:
+                container.insert(i, low)
+                if len(container) > ARRAY_MAX:
+                    self.containers[key] = _to_bits(container)
+
+    def update(self, ids):
+        '''Add many IDs. Much faster than calling add() for each one.'''
+        # Sorting lines up the IDs by container. Then rather than work out
+        # id >> 16 and id & 0xFFFF in Python for every ID, the sorted IDs go
+        # into an array of 32 bit ints and its memory is viewed as 16 bit
+        # halves: every other one is a low half, the rest are the high
+        # halves (the keys). bisect on the keys finds where each container's
+        # run ends, and each run of low halves is copied out as one slice.
+        ids = array.array(U32, sorted(set(ids)))
+        halves = memoryview(ids).cast('B').cast('H')
+        first = 0 if sys.byteorder == 'little' else 1
+        lows = array.array('H', halves[first::2].tobytes())
+        keys = array.array('H', halves[1 - first::2].tobytes())
+        start = 0
+        while start < len(keys):
+            key = keys[start]
+            end = bisect.bisect_right(keys, key, start)
+            container = self._get(key)
+            if container is None:
+                self.containers[key] = _shrink(lows[start:end])
+            else:
+                self.containers[key] = _or(container, lows[start:end])
+            start = end
+
+    def __contains__(self, id):
+        container = self._get(id >> 16)
+        if container is None:
+            return False
+        low = id & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = bisect.bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __iter__(self):
+        for key, container in self._items():
+            if isinstance(container, int):
+                container = _to_array(container)
+            base = key << 16
+            for low in container:
+                yield base | low
+
+    def __len__(self):
+        # cardinality of containers not read yet comes from the file's index
+        return sum(container[0] if isinstance(container, tuple)
+                   else _cardinality(container)
+                   for container in self.containers.values())
+
+    def __bool__(self):
+        return bool(self.containers)
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        return (self.containers.keys() == other.containers.keys()
+                and all(_to_bits(a) == _to_bits(other._get(key))
+                        for key, a in self._items()))
+
+    def nbytes(self):
+        '''Approximate bytes used by the containers.'''
+        return sum(BITSET_BYTES if isinstance(container, int)
+                   else len(container) * 2 for key, container in self._items())
+
+    def _combine(self, other, op, keys):
+        result = Bitmap()
+        for key in keys:
+            a, b = self._get(key), other._get(key)
+            if a is None or b is None:
+                container = a if b is None else b
+                if op is _and or container is None:
+                    continue
+                container = (container if isinstance(container, int)
+                             else array.array('H', container))
+            else:
+                container = op(a, b)
+            if container is not None:
+                result.containers[key] = container
+        return result
+
+    def __and__(self, other):
+        return self._combine(other, _and,
+                             self.containers.keys() & other.containers.keys())
+
+    def and_cardinality(self, other):
+        '''len(self & other) without building the intersection.'''
+        count = 0
+        for key in self.containers.keys() & other.containers.keys():
+            a, b = self._get(key), other._get(key)
+            if isinstance(a, int) and isinstance(b, int):
+                count += (a & b).bit_count()
+            elif isinstance(a, int) or isinstance(b, int):
+                count += _cardinality(_and(a, b) or ())
+            else:
+                count += len(set(a).intersection(b))
+        return count
+
+    def __or__(self, other):
+        return self._combine(other, _or,
+                             self.containers.keys() | other.containers.keys())
+
+    def __xor__(self, other):
+        return self._combine(other, _xor,
+                             self.containers.keys() | other.containers.keys())
+
+    def __repr__(self):
+        return '<Bitmap {} ids in {} containers>'.format(
+            len(self), len(self.containers))
+
+    # Files
+    # -------------------------------------------------------------------------
+    # HEADER, then one ENTRY per container in key order, then the containers
+    # themselves: cardinality * 2 bytes for an array, 8 KB for a bitset.
+    # Which one it is follows from the cardinality, so it isn't stored.
+
+    def save(self, filename):
+        items = [(key, container) for key, container in self._items()]
+        offset = HEADER.size + ENTRY.size * len(items)
+        index, blobs = [], []
+        for key, container in items:
+            if isinstance(container, int):
+                blob = container.to_bytes(BITSET_BYTES, 'little')
+            else:
+                if sys.byteorder == 'big':
+                    container = array.array('H', container)
+                    container.byteswap()
+                blob = container.tobytes()
+            index.append(ENTRY.pack(key, _cardinality(container), offset))
+            blobs.append(blob)
+            offset += len(blob)
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as fob:
+            fob.write(HEADER.pack(MAGIC, len(items)))
+            fob.writelines(index)
+            fob.writelines(blobs)
+        os.replace(temp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Map a file written by save() into memory.
+
+        Only the index is read now; each container is decoded the first
+        time it's needed. Call close() when done, or use a with block.
+        '''
+        bitmap = cls()
+        bitmap._file = open(filename, 'rb')
+        buffer = bitmap._buffer = mmap.mmap(bitmap._file.fileno(), 0,
+                                            access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            bitmap.close()
+            raise ValueError('{} is not a bitmap file'.format(filename))
+        for key, cardinality, offset in ENTRY.iter_unpack(
+                buffer[HEADER.size:HEADER.size + ENTRY.size * count]):
+            bitmap.containers[key] = (cardinality, offset)
+        return bitmap
+
+    def _decode(self, cardinality, offset):
+        buffer = self._buffer
+        if cardinality > ARRAY_MAX:
+            return int.from_bytes(buffer[offset:offset + BITSET_BYTES],
+                                  'little')
+        container = array.array('H')
+        container.frombytes(buffer[offset:offset + cardinality * 2])
+        if sys.byteorder == 'big':
+            container.byteswap()
+        return container
+
+    def close(self):
+        '''Read any remaining containers and release the file.'''
+        if self._buffer is None:
+            return
+        for key in list(self.containers):
+            self._get(key)
+        self._buffer.close()
+        self._file.close()
+        self._buffer = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def intersection(bitmaps):
+    '''IDs that are in every one of bitmaps, like bitop('and', ...).
+
+    Works one key at a time across all the bitmaps, narrowing down a set
+    of low halves, smallest bitmap first.
+    '''
+    bitmaps = sorted(bitmaps, key=len)
+    result = Bitmap()
+    if not bitmaps:
+        return result
+    keys = set(bitmaps[0].containers)
+    for bitmap in bitmaps[1:]:
+        keys.intersection_update(bitmap.containers)
+    for key in sorted(keys):
+        containers = [bitmap._raw(key) for bitmap in bitmaps]
+        bitsets = [c for c in containers if isinstance(c, int)]
+        bits = functools.reduce(operator.and_, bitsets) if bitsets else None
+        lows = None
+        for container in containers:
+            if isinstance(container, int):
+                continue
+            if isinstance(container, bytes):
+                container = memoryview(container).cast('H')
+            if lows is None:
+                lows = set(container)
+            else:
+                lows.intersection_update(container)
+            if not lows:
+                break
+        if lows is None:
+            container = _shrink(bits)
+        elif bits is None:
+            container = _shrink(array.array('H', sorted(lows)))
+        else:
+            container = _and(array.array('H', sorted(lows)), bits)
+        if container is not None:
+            result.containers[key] = container
+    return result
+
+
+def union(bitmaps):
+    '''IDs that are in any of bitmaps, like bitop('or', ...).
+
+    The bytes of every array container with the same key are joined into
+    one array and turned into a set once, and bitsets are OR'd together as
+    ints, so each key is only converted to its final form once.
+    '''
+    arrays, bitsets = {}, {}
+    for bitmap in bitmaps:
+        for key in bitmap.containers:
+            container = bitmap._raw(key)
+            if isinstance(container, int):
+                bitsets[key] = bitsets.get(key, 0) | container
+            else:
+                arrays.setdefault(key, []).append(container)
+    result = Bitmap()
+    for key in sorted(arrays.keys() | bitsets.keys()):
+        lows = set(array.array('H', b''.join(arrays.get(key, ()))))
+        if key in bitsets or len(lows) > ARRAY_MAX:
+            container = _shrink(bitsets.get(key, 0) | _to_bits(lows))
+        else:
+            container = array.array('H', sorted(lows))
+        result.containers[key] = container
+    return result
+
+
+# Daily active users
+# -----------------------------------------------------------------------------
+# One Bitmap per day kept in a folder as <day>.rbm, the same layout as the
+# per-date keys in the Redis example.
+
+class DailyActive():
+    '''Track which user IDs were active on which days.'''
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.days = {}
+
+    def _filename(self, day):
+        return os.path.join(self.folder, '{}.rbm'.format(day))
+
+    def __getitem__(self, day):
+        try:
+            return self.days[day]
+        except KeyError:
+            filename = self._filename(day)
+            bitmap = (Bitmap.load(filename) if os.path.exists(filename)
+                      else Bitmap())
+            self.days[day] = bitmap
+            return bitmap
+
+    def login(self, day, *ids):
+        self[day].update(ids)
+
+    def count(self, day):
+        return len(self[day])
+
+    def every_day(self, days):
+        return intersection(self[day] for day in days)
+
+    def any_day(self, days):
+        return union(self[day] for day in days)
+
+    def retention(self, cohort_day, later_days):
+        '''The fraction of cohort_day's users seen again on each later day.'''
+        cohort = self[cohort_day]
+        size = len(cohort)
+        return [cohort.and_cardinality(self[day]) / size if size else 0.0
+                for day in later_days]
+
+    def save(self):
+        for day, bitmap in self.days.items():
+            bitmap.save(self._filename(day))
+
+    def close(self):
+        for bitmap in self.days.values():
+            bitmap.close()
+        self.days.clear()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The Redis example first, then a year of logins from a pool of users with
+# IDs spread up to 50 million.
+
+if __name__ == '__main__':
+    import random
+    import tempfile
+    import time
+
+    days = ['2017-08-14', '2017-08-15', '2017-08-16']
+    aria, sansa, jon = 1022, 40569, 6603762
+    logins = DailyActive(tempfile.mkdtemp())
+    logins.login(days[0], aria, jon)
+    logins.login(days[1], jon, sansa)
+    logins.login(days[2], jon)
+    print([logins.count(day) for day in days])          # [2, 2, 1]
+    print(aria in logins[days[1]])                      # False
+    print(list(logins.every_day(days)))                 # [6603762]
+    print(len(logins.any_day(days)))                    # 3
+
+    random.seed(1)
+    users = random.sample(range(50000000), 1000000)
+    regulars = users[:20000]
+    day_count = 365
+    daily = 30000
+    dates = ['day-{:03}'.format(i) for i in range(day_count)]
+    logins = DailyActive(tempfile.mkdtemp())
+
+    elapsed = 0
+    for day in dates:
+        ids = regulars[:random.randrange(15000, 20000)]
+        ids += random.sample(users, daily)
+        start = time.perf_counter()
+        logins.login(day, *ids)
+        elapsed += time.perf_counter() - start
+    print('build {} days      {:8.3f}s'.format(day_count, elapsed))
+
+    size = sum(bitmap.nbytes() for bitmap in logins.days.values())
+    print('memory: {:.1f} MB as bitmaps, {:.1f} MB as bytearrays'.format(
+        size / 1e6, day_count * 50000000 / 8 / 1e6))
+
+    start = time.perf_counter()
+    logins.save()
+    logins.close()
+    print('save                {:8.3f}s'.format(time.perf_counter() - start))
+
+    def timed(label, func):
+        start = time.perf_counter()
+        result = func()
+        print('{:20}{:8.1f}ms  {}'.format(
+            label, (time.perf_counter() - start) * 1000, result))
+
+    timed('load (mmap)', lambda: len([logins[day] for day in dates]))
+    timed('DAU', lambda: logins.count(dates[100]))
+    timed('every day, 30 days', lambda: len(logins.every_day(dates[:30])))
+    timed('every day, 365 days', lambda: len(logins.every_day(dates)))
+    timed('unique, 30 days', lambda: len(logins.any_day(dates[:30])))
+    timed('unique, 365 days', lambda: len(logins.any_day(dates)))
+    timed('retention, 7 days', lambda: ['{:.2f}'.format(r) for r in
+                                        logins.retention(dates[0],
+                                                         dates[1:8])])
+    timed('churned (xor)', lambda: len(logins[dates[0]] ^ logins[dates[1]]))
+    logins.close()
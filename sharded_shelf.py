@@ -0,0 +1,475 @@
+'''Sharded Shelf: a shelve for several processes'''
+
+
+# shelve_module.py opens one database file with shelve.open(). That works
+# well for one program, but:
+
+# - every write goes straight to the one dbm file, one key at a time
+# - there's no way for other processes to read it safely while it's open
+# - with writeback=True every entry that was *read* is written back on
+#   sync()/close(), whether it changed or not
+
+# ShardedShelf keeps the familiar dict-like interface but spreads the keys
+# over several dbm files ("shards") in a directory, picking the shard from a
+# hash of the key:
+
+#   data/topics/
+#       shard-00, shard-01, ...  - the dbm files
+#       shard-00.lock, ...       - lock + generation counter for each shard
+#       writer.lock              - held by the one process allowed to write
+#       wal.log                  - writes not yet copied into the shards
+#       shelf.json               - the number of shards
+
+# Writes are appended to wal.log (a write-ahead log) and kept in memory.
+# Every batch_size writes, or flush_interval seconds, the batch is copied into
+# the shards, one shard at a time, and the log is emptied. Appending to a log
+# is much cheaper than updating a dbm file, and if the program dies before a
+# flush the log is replayed the next time the shelf is opened for writing.
+
+# How safe is a write once shelf[key] = value returns? Each log entry goes to
+# the operating system in a single unbuffered write, so it survives the
+# program crashing or being killed. It doesn't survive the machine crashing
+# or losing power until the OS gets round to writing it to disk (usually
+# within 30 seconds or so on Linux) - unless the shelf was opened with
+# fsync=True, which waits for the disk on every write and is much slower
+# (3x in the benchmark below, far more on a spinning disk). flush_interval
+# is only checked when there's a write, so after the last one the batch
+# stays in the log (safe, but not yet visible to readers) until the next
+# write, flush() or close().
+
+# Any number of processes can open the shelf read only (flag='r'). Each shard
+# has a lock file used with fcntl.flock(): readers take a shared lock for the
+# moment they read, the writer takes an exclusive lock while it updates that
+# shard. The writer also bumps a counter in the lock file, which is how
+# readers notice they need to reopen the shard to see the new data. Readers
+# only see writes once they've been flushed.
+
+# fcntl is only available on mac/linux.
+
+# see also: shelve_module.py, pickling.py
+
+import collections.abc
+import dbm
+import fcntl
+import json
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from shelve_writeback import pickle_digest
+
+try:
+    import dbm.gnu as gdbm
+except ImportError:
+    gdbm = None
+
+
+_GENERATION = struct.Struct('<Q')
+_LOG_ENTRY = struct.Struct('<BII')  # op, key length, value length
+_SET, _DELETE = 1, 2
+
+
+class _ShardLock():
+    # flock() on a shard's lock file, as a context manager.
+
+    def __init__(self, fd, how):
+        self.fd = fd
+        self.how = how
+
+    def __enter__(self):
+        fcntl.flock(self.fd, self.how)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def _open_db(filename, flag):
+    # gdbm does its own locking, which would stop readers and the writer
+    # having the file open at the same time. We lock with flock() instead,
+    # so ask gdbm not to ('u').
+    if gdbm is not None:
+        return gdbm.open(filename, flag + 'u')
+    return dbm.open(filename, flag)
+
+
+class ShardedShelf(collections.abc.MutableMapping):
+    '''A shelve-like mapping stored across several dbm files.
+
+    flag is 'r' (read only), 'w' (read/write), 'c' (read/write, create if
+    needed) or 'n' (always start empty). Only one process at a time can
+    open the shelf for writing.
+    '''
+
+    def __init__(self, path, flag='c', shards=8, writeback=False,
+                 batch_size=1000, flush_interval=1.0, fsync=False,
+                 protocol=pickle.HIGHEST_PROTOCOL, keyencoding='utf-8'):
+        if flag not in ('r', 'w', 'c', 'n'):
+            raise ValueError("flag must be 'r', 'w', 'c' or 'n'")
+        self.path = path
+        self.readonly = flag == 'r'
+        self.writeback = writeback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.protocol = protocol
+        self.keyencoding = keyencoding
+        self.cache = {}      # writeback: key -> (value, pickle_digest)
+        self.pending = {}    # encoded key -> pickled value, or None (delete)
+        self.stats = collections.Counter()
+        self._last_flush = time.monotonic()
+
+        meta = os.path.join(path, 'shelf.json')
+        if flag != 'n' and os.path.exists(meta):
+            with open(meta) as fob:
+                shards = json.load(fob)['shards']
+        elif flag in ('r', 'w'):
+            raise FileNotFoundError('no shelf at {}'.format(path))
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.shards = shards
+
+        self._locks = [os.open(self._file('shard-{:02d}.lock'.format(i)),
+                       os.O_RDWR | os.O_CREAT) for i in range(shards)]
+        self._handles = [None] * shards
+        self._generations = [None] * shards
+
+        self._wal = None
+        if not self.readonly:
+            self._writer_lock = os.open(self._file('writer.lock'),
+                                        os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(self._writer_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self._writer_lock)
+                raise RuntimeError('{} is already open for writing'
+                                   .format(path))
+            with open(meta, 'w') as fob:
+                json.dump({'shards': shards}, fob)
+            # the writer keeps every shard open for writing
+            for i in range(shards):
+                with self._locked(i, fcntl.LOCK_EX):
+                    db = _open_db(self._shard_file(i),
+                                  'n' if flag == 'n' else 'c')
+                    if hasattr(db, 'sync'):
+                        db.sync()  # so readers can open a brand new shard
+                    self._handles[i] = db
+                    self._bump(i)
+            if flag != 'n':
+                self._replay()
+            # unbuffered: every entry reaches the OS as soon as it's logged
+            self._wal = open(self._file('wal.log'), 'ab', buffering=0)
+            self._wal.truncate(0)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _shard_file(self, i):
+        return self._file('shard-{:02d}'.format(i))
+
+    def _shard(self, key):
+        # crc32 rather than hash(): str hashes change from one run of Python
+        # to the next, but every process has to agree on where a key lives.
+        return zlib.crc32(key) % self.shards
+
+    # Locking
+    # -------------------------------------------------------------------------
+
+    def _locked(self, i, how):
+        return _ShardLock(self._locks[i], how)
+
+    def _bump(self, i):
+        # call with the exclusive lock held
+        data = os.pread(self._locks[i], _GENERATION.size, 0)
+        count = _GENERATION.unpack(data)[0] if len(data) == 8 else 0
+        os.pwrite(self._locks[i], _GENERATION.pack(count + 1), 0)
+
+    def _reader(self, i):
+        # call with the shared lock held; reopens the shard if the writer
+        # has changed it since we last looked
+        if not self.readonly:
+            return self._handles[i]  # the writer's own copy is always current
+        generation = os.pread(self._locks[i], _GENERATION.size, 0)
+        if self._handles[i] is None or generation != self._generations[i]:
+            if self._handles[i] is not None:
+                self._handles[i].close()
+            self._handles[i] = _open_db(self._shard_file(i), 'r')
+            self._generations[i] = generation
+        return self._handles[i]
+
+    def _read(self, key):
+        i = self._shard(key)
+        with self._locked(i, fcntl.LOCK_SH):
+            return self._reader(i)[key]
+
+    # Mapping interface
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, key):
+        try:
+            return self.cache[key][0]
+        except KeyError:
+            pass
+        encoded = key.encode(self.keyencoding)
+        data = self.pending.get(encoded, b'')
+        if data is None:
+            raise KeyError(key)
+        if not data:
+            data = self._read(encoded)
+        value = pickle.loads(data)
+        if self.writeback:
+            self.cache[key] = (value, pickle_digest(data))
+        return value
+
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value, self.protocol)
+        self._log(key.encode(self.keyencoding), data)
+        if self.writeback:
+            # changes made to value after this are picked up by sync()
+            self.cache[key] = (value, pickle_digest(data))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+        self._log(key.encode(self.keyencoding), None)
+
+    def __contains__(self, key):
+        if key in self.cache:
+            return True
+        encoded = key.encode(self.keyencoding)
+        if encoded in self.pending:
+            return self.pending[encoded] is not None
+        i = self._shard(encoded)
+        with self._locked(i, fcntl.LOCK_SH):
+            return encoded in self._reader(i)
+
+    def _stored_keys(self):
+        for i in range(self.shards):
+            with self._locked(i, fcntl.LOCK_SH):
+                keys = self._reader(i).keys()
+            yield from keys
+
+    def __iter__(self):
+        pending = self.pending
+        for encoded in self._stored_keys():
+            if encoded not in pending:
+                yield encoded.decode(self.keyencoding)
+        for encoded, data in list(pending.items()):
+            if data is not None:
+                yield encoded.decode(self.keyencoding)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    # Writing
+    # -------------------------------------------------------------------------
+
+    def _log(self, encoded, data):
+        if self.readonly:
+            raise PermissionError('shelf was opened read only')
+        # one write() per entry, so a crash leaves at most the last entry
+        # half written (and _replay() skips that)
+        self._wal.write(b''.join((
+            _LOG_ENTRY.pack(_SET if data is not None else _DELETE,
+                            len(encoded), len(data or b'')),
+            encoded, data or b'')))
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+        self.pending[encoded] = data
+        self.stats['logged'] += 1
+        if (len(self.pending) >= self.batch_size
+                or time.monotonic() - self._last_flush > self.flush_interval):
+            self.flush()
+
+    def _replay(self):
+        # A wal.log with entries in it means the last writer didn't flush
+        # them (it crashed) - apply them now.
+        try:
+            with open(self._file('wal.log'), 'rb') as fob:
+                log = fob.read()
+        except FileNotFoundError:
+            return
+        pos = 0
+        while pos + _LOG_ENTRY.size <= len(log):
+            op, klen, vlen = _LOG_ENTRY.unpack_from(log, pos)
+            pos += _LOG_ENTRY.size
+            if pos + klen + vlen > len(log):
+                break  # a half written entry at the end
+            key = log[pos:pos + klen]
+            pos += klen
+            self.pending[key] = log[pos:pos + vlen] if op == _SET else None
+            pos += vlen
+        self._apply()
+        with open(self._file('wal.log'), 'wb'):
+            pass  # everything is in the shards now, empty the log
+
+    def _apply(self):
+        by_shard = collections.defaultdict(list)
+        for encoded, data in self.pending.items():
+            by_shard[self._shard(encoded)].append((encoded, data))
+        for i, items in by_shard.items():
+            db = self._handles[i]
+            with self._locked(i, fcntl.LOCK_EX):
+                for encoded, data in items:
+                    if data is not None:
+                        db[encoded] = data
+                    elif encoded in db:
+                        del db[encoded]
+                if hasattr(db, 'sync'):
+                    db.sync()
+                self._bump(i)
+            self.stats['written'] += len(items)
+        self.pending.clear()
+
+    def flush(self):
+        '''Copy the logged writes into the shards.'''
+        if self._wal is None:
+            return  # read only
+        self._wal.flush()
+        if self.pending:
+            self._apply()
+            self._wal.truncate(0)
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        # With writeback, only values whose pickle has changed since they
+        # were read are written; the rest are just dropped from the cache.
+        # (see shelve_writeback.py)
+        if self.writeback and not self.readonly:
+            cache, self.cache = self.cache, {}
+            for key, (value, digest) in cache.items():
+                data = pickle.dumps(value, self.protocol)
+                if pickle_digest(data) != digest:
+                    self._log(key.encode(self.keyencoding), data)
+                else:
+                    self.stats['skipped'] += 1
+        self.flush()
+
+    def close(self):
+        if self._handles is None:
+            return
+        self.sync()
+        for handle in self._handles:
+            if handle is not None:
+                handle.close()
+        for fd in self._locks:
+            os.close(fd)
+        if self._wal is not None:
+            self._wal.close()
+            os.close(self._writer_lock)  # releases the writer lock
+        self._handles = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_handles', None) is not None:
+            self.close()
+
+
+
+def open_shelf(path, flag='c', **kwargs):
+    return ShardedShelf(path, flag, **kwargs)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Throughput against shelve.open(), then a writer and several reader
+# processes working on the same shelf at once.
+
+def _reader_process(path, keys, seconds, results):
+    shelf = ShardedShelf(path, 'r')
+    reads = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for key in keys:
+            try:
+                shelf[key]
+            except KeyError:
+                pass  # not flushed yet
+            reads += 1
+    shelf.close()
+    results.put(reads)
+
+
+if __name__ == '__main__':
+    import multiprocessing as mp
+    import shelve
+    import shutil
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    count = 20000
+    record = {'succulents': ['Blue star', 'Chinesis', 'Black Prince'],
+              'orchids': ['Phaleanopsis', 'Cattleya', 'Paphiopedilum']}
+    keys = ['plant-{}'.format(i) for i in range(count)]
+
+    def timed(label, func):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print('{:28} {:9.0f} ops/sec'.format(label, count / elapsed))
+
+    def shelve_writes():
+        with shelve.open(os.path.join(folder, 'plain')) as db:
+            for key in keys:
+                db[key] = record
+
+    def shelve_reads():
+        with shelve.open(os.path.join(folder, 'plain'), 'r') as db:
+            for key in keys:
+                db[key]
+
+    def sharded_writes():
+        with ShardedShelf(os.path.join(folder, 'sharded'), 'n') as db:
+            for key in keys:
+                db[key] = record
+
+    def sharded_reads():
+        with ShardedShelf(os.path.join(folder, 'sharded'), 'r') as db:
+            for key in keys:
+                db[key]
+
+    timed('shelve writes', shelve_writes)
+    timed('ShardedShelf writes', sharded_writes)
+
+    def sharded_fsync_writes():
+        with ShardedShelf(os.path.join(folder, 'fsynced'), 'n',
+                          fsync=True) as db:
+            for key in keys:
+                db[key] = record
+
+    timed('ShardedShelf fsync=True', sharded_fsync_writes)
+    print('dbm backend:',
+          dbm.whichdb(os.path.join(folder, 'sharded', 'shard-00')))
+    timed('shelve reads', shelve_reads)
+    timed('ShardedShelf reads', sharded_reads)
+
+    # one writer, several readers:
+    path = os.path.join(folder, 'shared')
+    writer = ShardedShelf(path, 'n', batch_size=500)
+    writer['plant-0'] = record
+    writer.flush()
+    results = mp.Queue()
+    readers = [mp.Process(target=_reader_process,
+                          args=(path, keys[:1000], 2.0, results))
+               for _ in range(4)]
+    for proc in readers:
+        proc.start()
+    start = time.perf_counter()
+    for key in keys:
+        writer[key] = record
+    writer.close()
+    write_time = time.perf_counter() - start
+    reads = sum(results.get() for proc in readers)
+    for proc in readers:
+        proc.join()
+    print('concurrent: {:.0f} writes/sec, {:.0f} reads/sec over {} readers'
+          .format(count / write_time, reads / 2.0, len(readers)))
+
+    shutil.rmtree(folder)
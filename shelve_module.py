@@ -123,6 +123,10 @@ with shelve.open('data/pizzas', writeback=True) as pizzas:
 # heavier memory usage. Regarding sync, it writes everything to the file, but
 # also clears the memory cache.
 
+# To write back only the entries that actually changed, see
+# shelve_writeback.py. For a shelf that several processes can read at once,
+# with batched writes, see sharded_shelf.py
+
 
 # Reminder
 # -----------------------------------------------------------------------------
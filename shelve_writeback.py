@@ -0,0 +1,136 @@
+'''Shelve writeback: only write back what changed'''
+
+
+# shelve_module.py explains writeback=True: every entry you read is cached in
+# memory so that pizzas['Italian'].append('mushroom') works, and on sync() or
+# close() EVERY cached entry is pickled and written back to the database.
+# Loop over a big shelf, change one entry, and the whole lot gets rewritten.
+
+# Shelve can't tell which objects were changed, but we can: when an entry is
+# first read, remember a digest (a short fingerprint) of its pickled bytes.
+# At sync() time pickle each cached object again and compare digests. Equal
+# digests mean the object is unchanged and the write can be skipped. We still
+# pay for the pickling, but database writes are usually the expensive part,
+# and only 16 bytes per entry are kept besides the cached objects themselves.
+
+# The stats attribute counts what happened, so we can see the "write
+# amplification": how many bytes plain writeback would have written for each
+# byte that actually needed to change.
+
+# see also: shelve_module.py, sharded_shelf.py
+
+import collections
+import dbm
+import hashlib
+import pickle
+import shelve
+from io import BytesIO
+
+
+def pickle_digest(data):
+    '''A 16 byte fingerprint of some pickled bytes.'''
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class TrackingShelf(shelve.Shelf):
+    '''A Shelf with writeback that only rewrites entries that changed.'''
+
+    def __init__(self, dict, protocol=None, keyencoding='utf-8'):
+        super().__init__(dict, protocol, writeback=True,
+                         keyencoding=keyencoding)
+        self.digests = {}
+        self.stats = collections.Counter()
+
+    def _dumps(self, value):
+        fob = BytesIO()
+        pickle.Pickler(fob, self._protocol).dump(value)
+        return fob.getvalue()
+
+    def __getitem__(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            data = self.dict[key.encode(self.keyencoding)]
+            value = pickle.Unpickler(BytesIO(data)).load()
+            self.cache[key] = value
+            self.digests[key] = pickle_digest(data)
+            self.stats['read'] += 1
+            return value
+
+    def __setitem__(self, key, value):
+        data = self._dumps(value)
+        self.dict[key.encode(self.keyencoding)] = data
+        self.cache[key] = value
+        self.digests[key] = pickle_digest(data)
+        self.stats['written'] += 1
+        self.stats['bytes_written'] += len(data)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.digests.pop(key, None)
+
+    def sync(self):
+        for key, value in self.cache.items():
+            data = self._dumps(value)
+            self.stats['bytes_cached'] += len(data)
+            if pickle_digest(data) == self.digests.get(key):
+                self.stats['skipped'] += 1
+                continue
+            self.dict[key.encode(self.keyencoding)] = data
+            self.stats['written'] += 1
+            self.stats['bytes_written'] += len(data)
+        self.cache = {}
+        self.digests = {}
+        if hasattr(self.dict, 'sync'):
+            self.dict.sync()
+
+    def write_amplification(self):
+        '''Bytes plain writeback would have written at sync() per byte
+        that was written here. 1.0 means nothing was written needlessly.'''
+        written = self.stats['bytes_written']
+        if not written:
+            return float('inf') if self.stats['bytes_cached'] else 1.0
+        return self.stats['bytes_cached'] / written
+
+
+def open(filename, flag='c', protocol=None):
+    '''Like shelve.open(filename, flag, protocol, writeback=True).'''
+    return TrackingShelf(dbm.open(filename, flag), protocol)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Read every entry of a shelf, change one, then close. Plain writeback writes
+# all of them; TrackingShelf writes one.
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import time
+
+    folder = tempfile.mkdtemp()
+    pizza = ['tomato', 'basil', 'mozzarella'] * 20
+    count = 5000
+
+    for opener, name in ((shelve.open, 'plain'), (open, 'tracking')):
+        filename = os.path.join(folder, name)
+        with shelve.open(filename, 'n') as pizzas:
+            for i in range(count):
+                pizzas['pizza-{}'.format(i)] = pizza
+
+        pizzas = opener(filename, writeback=True) if name == 'plain' \
+            else opener(filename)
+        for key in pizzas:
+            pizzas[key]
+        pizzas['pizza-0'].append('mushroom')
+        start = time.perf_counter()
+        pizzas.close()
+        elapsed = time.perf_counter() - start
+
+        with shelve.open(filename, 'r') as check:
+            assert check['pizza-0'][-1] == 'mushroom'
+        print('{:9} close() {:6.3f}s'.format(name, elapsed))
+
+    print('written: {written}, skipped: {skipped}'.format(**pizzas.stats))
+    print('write amplification avoided: {:.0f}x'.format(
+        pizzas.write_amplification()))
@@ -92,6 +92,9 @@ with open('data/singers.csv', 'r') as fin:
     csv_in = csv.DictReader(fin)
     singers = [row for row in csv_in]
 
+# For very large files, parsing can be spread across processes by splitting
+# the file on row boundaries. see also: csv_parallel.py
+
 
 # XML
 # -----------------------------------------------------------------------------
@@ -153,6 +156,9 @@ print(len(root[0])) # number of breakfast items
 #           to load everything into memory at once. A good choice if you need
 #           to process very large streams of XML.
 
+# ElementTree also has iterparse(), which reads the document in pieces and
+# lets you discard elements as you finish with them. see also: xml_streaming.py
+
 
 # HTML
 # -----------------------------------------------------------------------------
@@ -258,6 +264,10 @@ json.dumps(now, cls=DTEncoder)
 # class. The isinstance() function checks whether the object obj is of the
 # class datetime.datetime.
 
+# Note that mktime() drops the microseconds. For an alternative that keeps
+# them and handles many types without a growing chain of isinstance()
+# checks, see json_encoders.py
+
 # For JSON and other structured text formats, you can load from a file into
 # data structures without knowing anything about the structures ahead of
 # time. Then, you can walk through the structures by using isinstance() and
@@ -324,6 +334,9 @@ print(data['poems'][1]['title'])
 # Always Use safe_load() instead of load(), especially if you're importing
 # YAML that you don't trust.
 
+# If PyYAML was built with libyaml, yaml.CSafeLoader is a much faster drop-in
+# for safe_load(). see also: config_cache.py for caching parsed config files.
+
 
 # Configuration files
 # -----------------------------------------------------------------------------
@@ -0,0 +1,316 @@
+'''Expiring keys: Redis expire/ttl in-process with a timer wheel'''
+
+
+# The Redis Caches and Expiration section of noSQL_datastores.py gives keys
+# a time-to-live with expire() and asks how long is left with ttl(). Redis
+# forgets a key in two ways:
+
+# - lazily: a key that's past its time is deleted when someone asks for it
+# - actively: a few times a second it looks for expired keys and deletes
+#   them, so keys that nobody asks for again don't hang around forever
+
+# TTLDict does both for a plain in-process dictionary. The lazy part is easy:
+# keep each key's expiry time and check it on every lookup. The active part
+# is the interesting one. Scanning every key to find the expired ones costs
+# time proportional to the number of keys, and a threading.Timer per key
+# means millions of threads. A timer wheel does it in O(1) per key instead.
+
+# A timer wheel is like a clock face with 256 slots, one per tick (1/100 s by
+# default). A key expiring 37 ticks from now goes in the slot 37 places
+# ahead of the hand. Each tick the hand moves on one slot and whatever keys
+# are in that slot have expired. Keys further away than one turn of the wheel
+# go on a slower wheel whose slots are each a full turn of the faster one,
+# and so on, four wheels deep (256 ** 4 ticks is over a year). Whenever the
+# faster wheel completes a turn, the keys in the next slot of the slower one
+# are moved down ("cascaded") into the faster wheel, now that they're near.
+
+# Keys aren't removed from the wheel when they're deleted or given a new
+# expiry. The wheel remembers the expiry each key was filed under and skips
+# the key if that's no longer its expiry when the slot comes around.
+
+#   cache = TTLDict(on_expire=lambda key, value: print(key, 'expired'))
+#   cache.set('ned', 'ned_will_expire', ttl=5)
+#   cache.ttl('ned')     # 5.0
+#   cache['ned']         # ned_will_expire, for 5 more seconds
+
+# see also: noSQL_datastores.py, memcache_server.py
+
+import collections.abc
+import math
+import time
+
+WHEEL_BITS = 8
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+LEVELS = 4
+
+
+class TTLDict(collections.abc.MutableMapping):
+    '''A dict whose keys can expire, Redis style.
+
+    ttl values are in seconds. Keys stored with d[key] = value get
+    default_ttl (None for never). on_expire(key, value) is called for
+    every key that expires, but not for keys that are deleted.
+    '''
+
+    def __init__(self, default_ttl=None, resolution=0.01, on_expire=None,
+                 clock=time.monotonic):
+        self.default_ttl = default_ttl
+        self.resolution = resolution
+        self.on_expire = on_expire
+        self.clock = clock
+        self.data = {}
+        self.expires = {}     # key -> expiry time, only for keys with a ttl
+        # wheels[level][slot] is a dict of key -> the expiry it was filed with
+        self.wheels = [[{} for slot in range(WHEEL_SIZE)]
+                       for level in range(LEVELS)]
+        self.overflow = {}    # beyond the slowest wheel
+        self.filed = [0] * LEVELS
+        self.tick = self._now_tick()
+
+    def _now_tick(self):
+        return int(self.clock() / self.resolution)
+
+    # The wheel
+    # -------------------------------------------------------------------------
+
+    def _file(self, key, when):
+        # A key goes on the fastest wheel that's still in the same turn as
+        # the hand: then its slot is ahead of the hand on that wheel. The
+        # highest bit where due and the hand differ says which wheel that is.
+        tick = self.tick
+        due = max(math.ceil(when / self.resolution), tick + 1)
+        level = ((due ^ tick).bit_length() - 1) // WHEEL_BITS
+        if level >= LEVELS:
+            self.overflow[key] = when
+            return
+        keys = self.wheels[level][(due >> WHEEL_BITS * level) & WHEEL_MASK]
+        if key not in keys:
+            self.filed[level] += 1
+        keys[key] = when
+
+    def _cascade(self, level):
+        slot = (self.tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+        keys = self.wheels[level][slot]
+        self.wheels[level][slot] = {}
+        self.filed[level] -= len(keys)
+        expires = self.expires
+        for key, when in keys.items():
+            if expires.get(key) == when:
+                self._file(key, when)
+
+    def _next_event(self):
+        # The first tick where something could happen: the next full slot
+        # on the fastest wheel that has anything on it, or else the end of
+        # that wheel's turn. Wheels faster than it are empty, so the hand
+        # can jump straight there instead of moving one tick at a time.
+        tick = self.tick
+        for level in range(LEVELS):
+            if not self.filed[level]:
+                continue
+            shift = WHEEL_BITS * level
+            wheel = self.wheels[level]
+            turn = tick >> (shift + WHEEL_BITS) << (shift + WHEEL_BITS)
+            for slot in range(((tick >> shift) & WHEEL_MASK) + 1, WHEEL_SIZE):
+                if wheel[slot]:
+                    return turn | slot << shift
+            return turn + (1 << (shift + WHEEL_BITS))
+        return (tick >> (WHEEL_BITS * LEVELS) << (WHEEL_BITS * LEVELS)) + (
+            1 << (WHEEL_BITS * LEVELS))
+
+    def _advance(self, until):
+        expires = self.expires
+        level0 = self.wheels[0]
+        expired = 0
+        while self.tick < until:
+            self.tick = min(until, self._next_event() - 1)
+            if self.tick == until:
+                break
+            self.tick += 1
+            tick = self.tick
+            if not tick & WHEEL_MASK:
+                if not tick & ((1 << WHEEL_BITS * LEVELS) - 1):
+                    overflow, self.overflow = self.overflow, {}
+                    for key, when in overflow.items():
+                        if expires.get(key) == when:
+                            self._file(key, when)
+                # slowest first, so each level lands on an already
+                # emptied faster one
+                for level in range(LEVELS - 1, 0, -1):
+                    if not tick & ((1 << WHEEL_BITS * level) - 1):
+                        self._cascade(level)
+            slot = tick & WHEEL_MASK
+            keys = level0[slot]
+            if not keys:
+                continue
+            level0[slot] = {}
+            self.filed[0] -= len(keys)
+            for key, when in keys.items():
+                if expires.get(key) == when:
+                    self._expire(key)
+                    expired += 1
+        return expired
+
+    def _expire(self, key):
+        del self.expires[key]
+        value = self.data.pop(key)
+        if self.on_expire is not None:
+            self.on_expire(key, value)
+
+    def purge(self):
+        '''Delete every key whose time is up. Returns how many there were.
+
+        This is the active half of expiry. It runs as part of set() and
+        len() too, so calling it yourself is only needed to get on_expire
+        callbacks promptly while the dict isn't being used.
+        '''
+        return self._advance(self._now_tick())
+
+    # Redis style access
+    # -------------------------------------------------------------------------
+
+    def set(self, key, value, ttl=None):
+        '''Store value, expiring after ttl seconds (None for never).'''
+        now = self.clock()
+        now_tick = int(now / self.resolution)
+        if now_tick != self.tick:
+            self._advance(now_tick)
+        self.data[key] = value
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = now + ttl
+            self._file(key, now + ttl)
+
+    def _set_expiry(self, key, when):
+        self.expires[key] = when
+        self._file(key, when)
+
+    def _live(self, key):
+        # the lazy half: a key found past its time is expired on the spot
+        when = self.expires.get(key)
+        if when is not None and when <= self.clock():
+            self._expire(key)
+            return False
+        return key in self.data
+
+    def expire(self, key, ttl):
+        '''Give an existing key a new ttl. False if there's no such key.'''
+        if not self._live(key):
+            return False
+        self._set_expiry(key, self.clock() + ttl)
+        return True
+
+    def persist(self, key):
+        '''Remove a key's ttl so it never expires.'''
+        if not self._live(key):
+            return False
+        return self.expires.pop(key, None) is not None
+
+    def ttl(self, key):
+        '''Seconds left for key; -1 if it never expires, -2 if it's gone.'''
+        if not self._live(key):
+            return -2
+        when = self.expires.get(key)
+        return -1 if when is None else when - self.clock()
+
+    # Mapping methods
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, key):
+        when = self.expires.get(key)
+        if when is not None and when <= self.clock():
+            self._expire(key)
+            raise KeyError(key)
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value, self.default_ttl)
+
+    def __delitem__(self, key):
+        if not self._live(key):
+            raise KeyError(key)
+        del self.data[key]
+        self.expires.pop(key, None)
+
+    def __contains__(self, key):
+        return self._live(key)
+
+    def __iter__(self):
+        self.purge()
+        return iter(list(self.data))
+
+    def __len__(self):
+        self.purge()
+        return len(self.data)
+
+    def __repr__(self):
+        return '<TTLDict {} keys, {} with a ttl>'.format(
+            len(self.data), len(self.expires))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Two million keys with ttls from a second to two hours. The clock is faked
+# so the benchmark doesn't have to wait two hours.
+
+if __name__ == '__main__':
+    import random
+
+    class FakeClock():
+        now = 1000.0
+
+        def __call__(self):
+            return self.now
+
+    clock = FakeClock()
+    expired = []
+    cache = TTLDict(clock=clock,
+                    on_expire=lambda key, value: expired.append(key))
+    count = 2000000
+    random.seed(1)
+    ttls = [random.choice((1, 10, 60, 600, 7200)) * random.random()
+            for i in range(count)]
+
+    def timed(label, func, ops=count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print('{:28}{:7.2f}s  {:10,.0f} ops/sec'.format(label, elapsed,
+                                                        ops / elapsed))
+
+    def set_all():
+        for key, ttl in enumerate(ttls):
+            cache.set(key, 'value', ttl)
+
+    def get_all():
+        for key in range(count):
+            cache[key]
+
+    def ttl_all():
+        for key in range(count):
+            cache.ttl(key)
+
+    timed('set', set_all)
+    timed('get', get_all)
+    timed('ttl', ttl_all)
+
+    # Move the clock on a tenth of a second at a time, about as often as
+    # Redis looks for expired keys, and let the wheel find them.
+    steps = 72000
+    start = time.perf_counter()
+    for step in range(steps):
+        clock.now += 0.1
+        cache.purge()
+    elapsed = time.perf_counter() - start
+    print('{:28}{:7.2f}s  {:10,} keys expired'.format(
+        'purge 2 hours, 0.1s steps', elapsed, len(expired)))
+    assert not cache.data and len(expired) == count
+
+    # For comparison: finding the expired keys by checking every one
+    expires = {key: clock.now + ttl for key, ttl in enumerate(ttls)}
+    start = time.perf_counter()
+    due = [key for key, when in expires.items() if when <= clock.now + 0.1]
+    elapsed = time.perf_counter() - start
+    print('{:28}{:7.2f}s  so {:,.0f}s for every step'.format(
+        'one full scan', elapsed, elapsed * steps))
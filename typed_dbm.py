@@ -0,0 +1,219 @@
+'''Typed dbm: automatic encoding, decoding and caching'''
+
+
+# noSQL_datastores.py shows that dbm keys and values are always bytes. To get
+# plain strings back it copies every key and value into one dict, then loops
+# again to .decode('utf-8') them into a second dict. That's two full copies of
+# the database in memory just to read it.
+
+# TypedDBM wraps a dbm database so that:
+
+# - keys are str, and values are encoded/decoded for you by a codec:
+#     'str'    - text, utf-8 encoded
+#     'json'   - anything json can store (see json_example.py)
+#     'pickle' - any picklable object (see pickling.py - trusted data only!)
+#     'bytes'  - left alone
+# - decoded values are kept in a small LRU (least recently used) cache, so
+#   reading the same keys over and over skips the database and the decoding
+# - get_many() / set_many() work on several keys at once
+# - iter_items() decodes as it goes, one pair at a time, with no dicts in
+#   between (items() is the usual mapping view, and goes through the cache)
+
+# Cached values are the same objects that get handed back, so treat values
+# from the 'json' and 'pickle' codecs as read only, or store a new value after
+# changing one (db[key] = value) rather than changing it in place.
+
+# see also: noSQL_datastores.py, shelve_module.py
+
+import collections
+import collections.abc
+import dbm
+import json
+import pickle
+
+
+CODECS = {
+    'str': (lambda value: value.encode('utf-8'),
+            lambda data: data.decode('utf-8')),
+    'json': (lambda value: json.dumps(value).encode('utf-8'),
+             json.loads),
+    'pickle': (lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+               pickle.loads),
+    'bytes': (bytes, bytes),
+}
+
+
+class TypedDBM(collections.abc.MutableMapping):
+    '''A dbm database with str keys and encoded values.
+
+    codec is one of the names in CODECS, or an (encode, decode) pair of
+    functions. cache_size is how many decoded values to keep (0 for none).
+    '''
+
+    def __init__(self, filename, flag='r', codec='str', cache_size=1024):
+        self.db = dbm.open(filename, flag)
+        self.encode, self.decode = (CODECS[codec] if isinstance(codec, str)
+                                    else codec)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    # The LRU cache
+    # -------------------------------------------------------------------------
+    # An OrderedDict remembers insertion order (see dictionaries.py), and
+    # move_to_end() marks a key as just used. When the cache is full, the
+    # first item is the least recently used one, so that's what goes.
+
+    def _remember(self, key, value):
+        if not self.cache_size:
+            return
+        cache = self.cache
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.stats['misses'] += 1
+            value = self.decode(self.db[key.encode('utf-8')])
+            self._remember(key, value)
+            return value
+        self.stats['hits'] += 1
+        self.cache.move_to_end(key)
+        return value
+
+    # Writes only drop the old cached value. Caching the caller's object
+    # would hand back something different from what the database holds (a
+    # tuple that json would give back as a list, say), and one the caller
+    # may still change.
+
+    def __setitem__(self, key, value):
+        self.db[key.encode('utf-8')] = self.encode(value)
+        self.cache.pop(key, None)
+
+    def __delitem__(self, key):
+        del self.db[key.encode('utf-8')]
+        self.cache.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.cache or key.encode('utf-8') in self.db
+
+    def __iter__(self):
+        for key in self.db.keys():
+            yield key.decode('utf-8')
+
+    def __len__(self):
+        return len(self.db)
+
+    # Bulk operations
+    # -------------------------------------------------------------------------
+
+    def get_many(self, keys, default=None):
+        '''Return {key: value} for keys; missing keys get default.'''
+        result = {}
+        cache = self.cache
+        db = self.db
+        for key in keys:
+            if key in cache:
+                self.stats['hits'] += 1
+                cache.move_to_end(key)
+                result[key] = cache[key]
+                continue
+            self.stats['misses'] += 1
+            data = db.get(key.encode('utf-8'))
+            if data is None:
+                result[key] = default
+            else:
+                result[key] = value = self.decode(data)
+                self._remember(key, value)
+        return result
+
+    def set_many(self, mapping):
+        encode = self.encode
+        cache = self.cache
+        db = self.db
+        for key, value in mapping.items():
+            db[key.encode('utf-8')] = encode(value)
+            cache.pop(key, None)
+
+    def iter_items(self):
+        '''Yield (key, value) pairs, decoding one at a time.
+
+        This bypasses the cache so a full scan doesn't push out the keys
+        that are actually used often.
+        '''
+        db = self.db
+        decode = self.decode
+        for key in db.keys():
+            yield key.decode('utf-8'), decode(db[key])
+
+    def sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def close(self):
+        self.db.close()
+        self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The two pass read from noSQL_datastores.py against iter_items(), then
+# repeated reads of a few popular keys with and without the cache.
+
+if __name__ == '__main__':
+    import os
+    import random
+    import tempfile
+    import time
+    import tracemalloc
+
+    filename = os.path.join(tempfile.mkdtemp(), 'definitions')
+    count = 50000
+    with TypedDBM(filename, 'n') as db:
+        db.set_many({'word-{}'.format(i): 'definition {}'.format(i) * 5
+                     for i in range(count)})
+
+    def two_pass():
+        test_dict = {}
+        with dbm.open(filename, 'r') as db:
+            for k in db.keys():
+                test_dict[k] = db[k]
+        test_dict_decoded = {}
+        for k, v in test_dict.items():
+            test_dict_decoded[k.decode('utf-8')] = test_dict[k].decode('utf-8')
+        return sum(len(v) for v in test_dict_decoded.values())
+
+    def single_pass():
+        with TypedDBM(filename) as db:
+            return sum(len(v) for k, v in db.iter_items())
+
+    for func in (two_pass, single_pass):
+        start = time.perf_counter()
+        total = func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:12} {:6.3f}s  peak {:6.1f} MB'.format(
+            func.__name__, elapsed, peak / 1e6))
+
+    popular = ['word-{}'.format(random.randrange(200)) for i in range(100000)]
+    for size in (0, 1024):
+        with TypedDBM(filename, cache_size=size) as db:
+            start = time.perf_counter()
+            for key in popular:
+                db[key]
+            elapsed = time.perf_counter() - start
+            print('cache_size={:<5} {:6.3f}s  {}'.format(
+                size, elapsed, dict(db.stats)))
@@ -105,3 +105,11 @@ if __name__ == '__main__':
 
 # The above can be saved as a program and run like so:
 # python3 getlinks.py http://python.org
+
+# This fetches one URL at a time, waiting for each. To follow the links and
+# crawl a whole site, many pages at once, see crawler.py.
+
+# Building the whole soup just to pick out the links is slow on big pages and
+# keeps every tag in memory. link_extractor.py's extract_links(page, url)
+# only looks at <a> tags as the parser streams past them, and returns them
+# resolved against the page's URL.
@@ -59,6 +59,11 @@ print(conn.getheader('Content-Type'))
 
 # The above returns a MIME type: text/plain and text/html are two examples.
 
+# Each urlopen() above downloads the whole page again. To reuse a saved copy
+# while it's still fresh (Cache-Control: max-age) and otherwise only
+# download it if it changed (ETag, Last-Modified, 304 Not Modified), see
+# http_cache.py.
+
 # Other HTML header information can be retrieved too:
 
 for key, value in conn.getheaders():
@@ -426,6 +431,23 @@ app.run(port=9999, debug=True)
 # there are a lot of input arguments. Use the same url pattern as above.
 
 
+# Caching and compressing responses
+# -----------------------------------------------------------------------------
+# Every request above renders its template again, even for the same route and
+# arguments, and sends the page uncompressed. wsgi_cache.py's CacheMiddleware
+# wraps a Flask or Bottle app (both are WSGI apps) to keep rendered pages for
+# a while, answer repeat visits with 304 Not Modified using ETags, and gzip
+# big pages:
+
+# from wsgi_cache import CacheMiddleware
+# cache = CacheMiddleware(app.wsgi_app, ttl=60)
+# app.wsgi_app = cache
+# ...
+# cache.invalidate('/about')              # when the page's data changes
+
+# For Bottle: run(app=CacheMiddleware(bottle.default_app()), port=9999)
+
+
 # Other Frameworks
 # -----------------------------------------------------------------------------
 # If you want to build a website backed by a relational database, you can use
@@ -0,0 +1,403 @@
+'''Web Frameworks: caching and compressing responses (WSGI middleware)'''
+
+
+# The Flask and Bottle examples in web_servers_frameworks.py render their
+# page again for every request, even when the route and arguments are the
+# same as last time and the page hasn't changed, and send it uncompressed.
+
+# Both frameworks are WSGI applications (see web_servers_frameworks.py), so
+# one piece of WSGI "middleware" can sit in front of either. Middleware is
+# itself a WSGI application that calls the real one, and can change the
+# request on the way in or the response on the way out. CacheMiddleware:
+
+# - keeps rendered GET responses in memory for ttl seconds, keyed by the
+#   path and the query arguments. Until then the app isn't called at all.
+#   invalidate('/about') or invalidate(prefix='/home/') throws entries away
+#   early, say when the data behind a page changes.
+# - gives each response an ETag (a hash of the body, unless the app sent its
+#   own). A browser that already has the page sends it back in If-None-Match
+#   and gets a bodiless 304 Not Modified instead of the page.
+# - compresses bodies bigger than min_size bytes with gzip (or brotli if the
+#   brotli package is installed and the browser accepts it). The compressed
+#   copy is cached too, so it's only compressed once.
+
+# Responses with Set-Cookie, Cache-Control: no-store or private, or a Vary
+# header on anything but Accept-Encoding (Flask sends Vary: Cookie for pages
+# that use the session) are never cached, since they can differ from one
+# user to the next. Requests with an Authorization or Cookie header skip
+# the cache both ways (the app may read them without saying so in Vary),
+# unless the response is marked Cache-Control: public. A route can send its
+# own Cache-Control: max-age to override ttl.
+
+# Flask:    app.wsgi_app = CacheMiddleware(app.wsgi_app, ttl=60)
+# Bottle:   run(app=CacheMiddleware(bottle.default_app()), port=9999)
+
+# Everything is in one process's memory: with several server processes each
+# has its own cache, and invalidate() only reaches the one it's called in.
+
+# see also: web_servers_frameworks.py, http_cache.py, ttl_dict.py
+
+import collections
+import gzip
+import hashlib
+import threading
+import time
+import urllib.parse
+
+try:
+    import brotli
+except ImportError:  # pip install brotli
+    brotli = None
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript',
+                'application/xml', 'image/svg+xml')
+
+
+class _Entry():
+    __slots__ = ('status', 'headers', 'body', 'etag', 'encoded', 'expires',
+                 'public')
+
+    def __init__(self, status, headers, body, etag, expires, public):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.encoded = {}        # 'gzip' -> compressed body
+        self.expires = expires
+        self.public = public     # Cache-Control: public
+
+
+def _cache_control(headers):
+    parts = set()
+    for name, value in headers:
+        if name.lower() == 'cache-control':
+            parts.update(part.strip() for part in value.lower().split(','))
+    return parts
+
+
+def _max_age(headers):
+    for name, value in headers:
+        if name.lower() == 'cache-control':
+            for part in value.lower().split(','):
+                part = part.strip()
+                if part in ('no-store', 'private', 'no-cache'):
+                    return 0
+                if part.startswith('max-age='):
+                    try:
+                        return int(part[8:])
+                    except ValueError:
+                        return 0
+    return None
+
+
+def _personal(headers):
+    # Set-Cookie, or a Vary on anything but Accept-Encoding (Flask adds
+    # Vary: Cookie when a page reads the session), means the response
+    # depends on who asked, so it can't be shared with everyone.
+    for name, value in headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return True
+        if name == 'vary' and any(
+                field.strip().lower() not in ('accept-encoding', '')
+                for field in value.split(',')):
+            return True
+    return False
+
+
+class CacheMiddleware():
+
+    def __init__(self, app, ttl=60, min_size=1024, level=6,
+                 max_entries=1000):
+        self.app = app
+        self.ttl = ttl
+        self.min_size = min_size
+        self.level = level
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()    # oldest first
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0,
+                      'compressed': 0, 'bytes_saved': 0}
+
+    @staticmethod
+    def key(environ):
+        '''Path plus query arguments (in any order).'''
+        args = sorted(urllib.parse.parse_qsl(environ.get('QUERY_STRING', ''),
+                                             keep_blank_values=True))
+        return environ.get('PATH_INFO', '/'), urllib.parse.urlencode(args)
+
+    def invalidate(self, path=None, prefix=None):
+        '''Drop the cached responses for a path, or for every path under a
+        prefix, or everything if neither is given.'''
+        with self._lock:
+            for key in list(self.entries):
+                if (path is None and prefix is None or key[0] == path or
+                        prefix is not None and key[0].startswith(prefix)):
+                    del self.entries[key]
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+        key = self.key(environ)
+        now = time.monotonic()
+        # the app may answer a logged in user differently without a Vary
+        personal = 'HTTP_AUTHORIZATION' in environ or 'HTTP_COOKIE' in environ
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self.entries[key]
+                entry = None
+        if entry is not None and (entry.public or not personal):
+            self._count('hits')
+        else:
+            self._count('misses')
+            entry = self._render(environ, key, now, personal)
+        return self._respond(environ, start_response, entry)
+
+    def _render(self, environ, key, now, personal=False):
+        captured = []
+        chunks = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            return chunks.append      # the old style write() callable
+
+        # A HEAD request is rendered as a GET: some frameworks leave the
+        # body out for HEAD, and that empty body mustn't be what's cached.
+        result = self.app(dict(environ, REQUEST_METHOD='GET'), capture)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = captured
+        body = b''.join(chunks)
+        # keep the app's own ETag if it sent one (static files usually do)
+        etag = None
+        for name, value in headers:
+            if name.lower() == 'etag':
+                etag = value
+        if etag is None:
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'etag')]
+        ttl = _max_age(headers)
+        if ttl is None:
+            ttl = self.ttl
+        public = 'public' in _cache_control(headers)
+        entry = _Entry(status, headers, body, etag, now + ttl, public)
+        cacheable = (status.startswith('200') and ttl > 0 and
+                     not _personal(headers) and (public or not personal))
+        if cacheable:
+            with self._lock:
+                self.entries[key] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        else:
+            # still compress it and give it an ETag, just don't keep it
+            entry.expires = now
+        return entry
+
+    def _encoding(self, environ, entry):
+        if len(entry.body) < self.min_size:
+            return None
+        headers = {name.lower(): value for name, value in entry.headers}
+        if 'content-encoding' in headers or not headers.get(
+                'content-type', '').startswith(COMPRESSIBLE):
+            return None
+        accept = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and 'br' in accept:
+            return 'br'
+        if 'gzip' in accept:
+            return 'gzip'
+        return None
+
+    def _compressed(self, entry, encoding):
+        body = entry.encoded.get(encoding)
+        if body is None:
+            if encoding == 'br':
+                body = brotli.compress(entry.body)
+            else:
+                body = gzip.compress(entry.body, self.level, mtime=0)
+            # two threads may both do this the first time; that's harmless
+            entry.encoded[encoding] = body
+            self._count('compressed')
+        return body
+
+    @staticmethod
+    def _matches(if_none_match, etag):
+        # any encoding of the same body counts: it's the same page
+        if not if_none_match:
+            return False
+        etag = etag.removeprefix('W/')
+        for tag in if_none_match.split(','):
+            tag = tag.strip().removeprefix('W/')
+            if tag in ('*', etag) or tag.startswith(etag[:-1] + '-'):
+                return True
+        return False
+
+    def _respond(self, environ, start_response, entry):
+        encoding = self._encoding(environ, entry)
+        # each encoding is a different set of bytes, so a different ETag
+        etag = entry.etag if encoding is None else '{}-{}"'.format(
+            entry.etag[:-1], encoding)
+        # one Vary header: the app's fields (if any) plus Accept-Encoding
+        vary = []
+        headers = []
+        for name, value in entry.headers:
+            if name.lower() == 'vary':
+                vary.extend(field.strip() for field in value.split(',')
+                            if field.strip())
+            else:
+                headers.append((name, value))
+        if 'accept-encoding' not in (field.lower() for field in vary):
+            vary.append('Accept-Encoding')
+        headers += [('ETag', etag), ('Vary', ', '.join(vary))]
+        if entry.status.startswith('200') and self._matches(
+                environ.get('HTTP_IF_NONE_MATCH'), entry.etag):
+            self._count('not_modified')
+            self._count('bytes_saved', len(entry.body))
+            start_response('304 Not Modified', [
+                (name, value) for name, value in headers
+                if name.lower() not in ('content-type', 'content-encoding')])
+            return []
+        body = entry.body
+        if encoding is not None:
+            body = self._compressed(entry, encoding)
+            headers.append(('Content-Encoding', encoding))
+            self._count('bytes_saved', len(entry.body) - len(body))
+        headers.append(('Content-Length', str(len(body))))
+        start_response(entry.status, headers)
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A small WSGI app shaped like the Flask examples (home, about, echo with
+# query arguments, and a template page) with a template that takes a little
+# work to render, served by wsgiref on threads. A pool of client threads
+# hammers it without and then with the middleware, then repeats with
+# If-None-Match like a browser revisiting the pages.
+
+def demo_app(environ, start_response):
+    import html
+    import string
+
+    path = environ['PATH_INFO']
+    args = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING', '')))
+    if path == '/':
+        body = 'Home - Content goes here'
+    elif path == '/about':
+        body = 'About - content goes here'
+    elif path.startswith(('/home/', '/echo/')):
+        thing = path[6:] or args.get('thing', '')
+        # stands in for render_template('flask_test.html', ...)
+        row = string.Template('<tr><td>$n</td><td>$thing</td>'
+                              '<td>$other</td></tr>')
+        rows = ''.join(row.substitute(n=n, thing=html.escape(thing),
+                                      other=html.escape(args.get('other',
+                                                                 '')))
+                       for n in range(300))
+        body = ('<!DOCTYPE HTML><html lang="en"><head><meta charset="UTF-8">'
+                '<title>Flask Example</title></head><body><h1>Hello {} </h1>'
+                '<table>{}</table></body></html>').format(html.escape(thing),
+                                                          rows)
+    else:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found']
+    data = body.encode()
+    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8'),
+                              ('Content-Length', str(len(data)))])
+    return [data]
+
+
+def serve(app, port=0):
+    '''Run a WSGI app on a threaded wsgiref server. Returns the server.'''
+    import socketserver
+    import wsgiref.simple_server
+
+    class Server(socketserver.ThreadingMixIn,
+                 wsgiref.simple_server.WSGIServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    class Handler(wsgiref.simple_server.WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = wsgiref.simple_server.make_server('localhost', port, app,
+                                               Server, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_test(port, paths, requests=2000, threads=8, etags=None):
+    '''Requests/sec and bytes received from threads of clients.'''
+    import http.client
+
+    counts = {'bytes': 0, 'not_modified': 0}
+    lock = threading.Lock()
+
+    def client(number):
+        received = not_modified = 0
+        for i in range(number, requests, threads):
+            path = paths[i % len(paths)]
+            headers = {'Accept-Encoding': 'gzip'}
+            if etags and path in etags:
+                headers['If-None-Match'] = etags[path]
+            conn = http.client.HTTPConnection('localhost', port)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            received += len(response.read())
+            not_modified += response.status == 304
+            if etags is not None and response.getheader('ETag'):
+                etags.setdefault(path, response.getheader('ETag'))
+            conn.close()
+        with lock:
+            counts['bytes'] += received
+            counts['not_modified'] += not_modified
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=client, args=(i,))
+               for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, counts
+
+
+if __name__ == '__main__':
+    paths = ['/', '/about', '/home/lovely', '/echo/?thing=lovely&other=blah',
+             '/echo/?other=blah&thing=lovely', '/home/other']
+
+    plain = serve(demo_app)
+    rate, counts = load_test(plain.server_port, paths)
+    print('without middleware: {:6.0f} requests/sec, {:>10,} bytes'.format(
+        rate, counts['bytes']))
+    plain.shutdown()
+
+    cached = CacheMiddleware(demo_app, ttl=60)
+    server = serve(cached)
+    rate, counts = load_test(server.server_port, paths)
+    print('with middleware:    {:6.0f} requests/sec, {:>10,} bytes'.format(
+        rate, counts['bytes']))
+
+    etags = {}
+    load_test(server.server_port, paths, requests=len(paths), threads=1,
+              etags=etags)
+    rate, counts = load_test(server.server_port, paths, etags=etags)
+    print('revisits (304s):    {:6.0f} requests/sec, {:>10,} bytes, {:,} '
+          'not modified'.format(rate, counts['bytes'],
+                                counts['not_modified']))
+    print(cached.stats)
+
+    cached.invalidate(prefix='/echo/')
+    print('after invalidate(prefix=\'/echo/\'): {} cached'.format(
+        len(cached.entries)))
+    server.shutdown()
@@ -0,0 +1,145 @@
+'''Streaming XML with iterparse()'''
+
+
+# et.ElementTree(file=...) in structured_file_formats.py parses the whole
+# document into a tree before we can look at the first element. That's fine
+# for data/practice.xml, but a feed that's a few GB would need the whole tree
+# in memory at once.
+
+# ElementTree.iterparse() parses the file a piece at a time and reports
+# events as it goes:
+
+#   'start' - an opening tag was read (its attributes are available)
+#   'end'   - the closing tag was read (its text and children are complete)
+
+# iterparse() still builds the tree as it goes, so the trick to keeping
+# memory flat is to throw each element away once we're done with it:
+# remove it from its parent so nothing refers to it anymore. Elements that
+# are still open (the ancestors of whatever we're looking at) are kept, so
+# their tags and attributes can still be read - for example the hours="7-11"
+# of the <breakfast> section an <item> belongs to.
+
+# see also: structured_file_formats.py
+
+import xml.etree.ElementTree as et
+
+
+# Path selectors
+# -----------------------------------------------------------------------------
+# A small subset of XPath:
+#   'menu/breakfast/item' - the full path from the root element
+#   'menu/*/item'         - * matches any single tag
+#   '//item'              - any item, at any depth
+
+def _compile_path(path):
+    anywhere = path.startswith('//')
+    steps = tuple(path.strip('/').split('/'))
+
+    def matches(tags):
+        if anywhere:
+            if len(tags) < len(steps):
+                return False
+            tags = tags[-len(steps):]
+        elif len(tags) != len(steps):
+            return False
+        return all(step == '*' or step == tag
+                   for step, tag in zip(steps, tags))
+    return matches
+
+
+def iterfind(source, path):
+    '''Yield (ancestors, element) for every element matching path.
+
+    source is a filename or a binary file object. ancestors is a list of the
+    open parent elements, outermost first. Each element is complete (text,
+    attributes and children) when it's yielded and is discarded afterwards,
+    so don't hold on to it - copy out what you need.
+    '''
+    matches = _compile_path(path)
+    stack = []   # the currently open elements
+    tags = []    # their tags, for matching
+    inside = 0   # how many open elements matched (their children are kept)
+    for event, elem in et.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            tags.append(elem.tag)
+            if matches(tags):
+                inside += 1
+            continue
+        matched = matches(tags)
+        stack.pop()
+        tags.pop()
+        if matched:
+            inside -= 1
+            yield stack, elem
+        if inside:
+            # part of a matched element that hasn't ended yet - keep it
+            continue
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+
+# Menu records
+# -----------------------------------------------------------------------------
+
+def iter_menu(source, path='menu/*/item'):
+    '''Yield (section, hours, item, price) from practice.xml-style menus.'''
+    for ancestors, item in iterfind(source, path):
+        section = ancestors[-1]
+        yield (section.tag, section.get('hours'),
+               (item.text or '').strip(), item.get('price'))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Write a large menu to a temporary file and compare peak memory (tracemalloc)
+# of building the full tree against streaming it.
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    for record in iter_menu('data/practice.xml'):
+        print(record)
+    # ('breakfast', '7-11', 'breakfast burritos', '$6.00')
+    # ('breakfast', '7-11', 'pancakes', '$4.00')
+    # ('lunch', '11-3', 'hamburger', '$5.00')
+    # ('dinner', '3-10', 'spaghetti', '8.00')
+
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as tmp:
+        tmp.write('<?xml version="1.0"?>\n<menu>\n')
+        for i in range(sections):
+            tmp.write('  <section{} hours="7-11">\n'.format(i))
+            for j in range(100):
+                tmp.write('    <item price="${}.00">dish {}</item>\n'
+                          .format(j, j))
+            tmp.write('  </section{}>\n'.format(i))
+        tmp.write('</menu>\n')
+        big = tmp.name
+
+    def with_tree():
+        root = et.ElementTree(file=big).getroot()
+        return sum(1 for section in root for item in section)
+
+    def with_iterparse():
+        return sum(1 for record in iter_menu(big))
+
+    try:
+        print('file size: {:.1f} MB'.format(os.path.getsize(big) / 1e6))
+        for func in (with_tree, with_iterparse):
+            start = time.perf_counter()
+            count = func()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:15} {:6.2f}s  peak {:8.1f} MB  {} items'.format(
+                func.__name__, elapsed, peak / 1e6, count))
+    finally:
+        os.remove(big)